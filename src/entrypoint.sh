@@ -1,5 +1,10 @@
 #!/bin/sh
 
+# Run the jobs in a resident process instead of cron
+if [ "$SCHEDULER" = "daemon" ]; then
+    exec rcb daemon
+fi
+
 # Dump all env vars so we can source them in cron jobs
 printenv | sed 's/^\(.*\)$/export \1/g' > /env.sh
 
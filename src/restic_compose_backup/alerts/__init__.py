@@ -1,4 +1,8 @@
+import os
 import logging
+import threading
+import time
+from contextlib import contextmanager
 
 from restic_compose_backup.alerts.smtp import SMTPAlert
 from restic_compose_backup.alerts.discord import DiscordWebhookAlert
@@ -10,26 +14,140 @@ ALERT_ERROR = 'ERROR'
 ALERT_TYPES = [ALERT_INFO, ALERT_ERROR]
 BACKENDS = [SMTPAlert, DiscordWebhookAlert]
 
+# Seconds we wait for the alert backends before giving up
+DEFAULT_TIMEOUT = 10
 
-def send(subject: str = None, body: str = None, alert_type: str = 'INFO'):
-    """Send alert to all configured backends"""
-    alert_classes = configured_alert_types()
-    for instance in alert_classes:
-        logger.info('Configured: %s', instance.name)
+
+class AlertDispatcher:
+    """
+    Sends alerts to all configured backends in parallel.
+    The backends are created once and keep their connections open
+    between alerts. Alerts sent inside ``digest()`` are combined into
+    a single message when the block exits.
+    """
+
+    def __init__(self, backends=None, timeout: float = DEFAULT_TIMEOUT):
+        self._backends = backends
+        self.timeout = timeout
+        self._pending = None
+        self._lock = threading.Lock()
+
+    @property
+    def backends(self) -> list:
+        """list: The configured backend instances. Created on first use"""
+        with self._lock:
+            if self._backends is None:
+                self._backends = configured_alert_types(timeout=self.timeout)
+            return self._backends
+
+    def send(self, subject: str = None, body: str = None, alert_type: str = 'INFO'):
+        """Send an alert or queue it if a digest is being collected"""
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append((subject, body, alert_type))
+                return
+
+        self.dispatch(f'[{alert_type}] {subject}', body)
+
+    @contextmanager
+    def digest(self):
+        """Collect the alerts sent inside the block and send them as one message"""
+        with self._lock:
+            nested = self._pending is not None
+            if not nested:
+                self._pending = []
         try:
-            instance.send(
-                subject=f'[{alert_type}] {subject}',
-                body=body,
+            yield self
+        finally:
+            if not nested:
+                with self._lock:
+                    pending, self._pending = self._pending, None
+                self.flush(pending)
+
+    def flush(self, pending: list):
+        if not pending:
+            return
+
+        if len(pending) == 1:
+            subject, body, alert_type = pending[0]
+            self.dispatch(f'[{alert_type}] {subject}', body)
+            return
+
+        alert_type = ALERT_ERROR if any(entry[2] == ALERT_ERROR for entry in pending) else 'INFO'
+        subject = f'[{alert_type}] {len(pending)} alerts: {pending[0][0]}'
+        # Put the beginning of the body last since backends truncate from the start
+        body = '\n\n'.join(f'[{entry[2]}] {entry[0]}\n{entry[1] or ""}' for entry in reversed(pending))
+        self.dispatch(subject, body)
+
+    def dispatch(self, subject: str, body: str):
+        """Send to all backends at the same time waiting at most ``timeout`` seconds"""
+        backends = self.backends
+        if not backends:
+            logger.info("No alerts configured")
+            return
+
+        threads = []
+        for instance in backends:
+            logger.info('Configured: %s', instance.name)
+            thread = threading.Thread(
+                target=send_to_backend,
+                args=(instance, subject, body),
+                name=f'alert-{instance.name}',
+                daemon=True,
             )
-        except Exception as ex:
-            logger.error("Exception raised when sending alert [%s]: %s", instance.name, ex)
-            logger.exception(ex)
+            thread.start()
+            threads.append(thread)
+
+        deadline = time.monotonic() + self.timeout
+        for thread in threads:
+            thread.join(max(0, deadline - time.monotonic()))
+            if thread.is_alive():
+                logger.error("Alert backend [%s] did not respond within %ss", thread.name[6:], self.timeout)
+
+    def close(self):
+        for instance in self._backends or []:
+            instance.close()
+
+
+def send_to_backend(instance, subject: str, body: str):
+    try:
+        instance.send(subject=subject, body=body)
+    except Exception as ex:
+        logger.error("Exception raised when sending alert [%s]: %s", instance.name, ex)
+        logger.exception(ex)
+
+
+def alert_timeout() -> float:
+    """float: The backend timeout from ``ALERT_TIMEOUT``"""
+    try:
+        return float(os.environ.get('ALERT_TIMEOUT') or DEFAULT_TIMEOUT)
+    except ValueError:
+        logger.warning("Invalid ALERT_TIMEOUT, using %s seconds", DEFAULT_TIMEOUT)
+        return DEFAULT_TIMEOUT
+
+
+_dispatcher = None
+
+
+def dispatcher() -> AlertDispatcher:
+    """AlertDispatcher: The dispatcher shared by the process"""
+    global _dispatcher
+    if _dispatcher is None:
+        _dispatcher = AlertDispatcher(timeout=alert_timeout())
+    return _dispatcher
+
+
+def send(subject: str = None, body: str = None, alert_type: str = 'INFO'):
+    """Send alert to all configured backends"""
+    dispatcher().send(subject=subject, body=body, alert_type=alert_type)
+
 
-    if len(alert_classes) == 0:
-        logger.info("No alerts configured")
+def digest():
+    """Combine all alerts sent inside the block into a single message"""
+    return dispatcher().digest()
 
 
-def configured_alert_types():
+def configured_alert_types(timeout: float = DEFAULT_TIMEOUT):
     """Returns a list of configured alert class instances"""
     logger.debug('Getting alert backends')
     entires = []
@@ -38,6 +156,7 @@ def configured_alert_types():
         instance = cls.create_from_env()
         logger.debug("Alert backend '%s' configured: %s", cls.name, instance is not None)
         if instance:
+            instance.timeout = timeout
             entires.append(instance)
 
     return entires
@@ -2,6 +2,8 @@
 
 class BaseAlert:
     name = None
+    #: Seconds a backend waits for the remote service
+    timeout = 10
 
     def create_from_env(self):
         return None
@@ -12,3 +14,7 @@ class BaseAlert:
 
     def send(self, subject: str = None, body: str = None, alert_type: str = None):
         pass
+
+    def close(self):
+        """Release connections kept open between alerts"""
+        pass
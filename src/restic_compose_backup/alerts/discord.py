@@ -1,7 +1,6 @@
 import os
 import logging
 
-import requests
 from restic_compose_backup.alerts.base import BaseAlert
 
 logger = logging.getLogger(__name__)
@@ -10,6 +9,8 @@ logger = logging.getLogger(__name__)
 class DiscordWebhookAlert(BaseAlert):
     name = 'discord_webhook'
     success_codes = [200]
+    #: Pooled connections shared by all webhooks. Created on first use
+    _session = None
 
     def __init__(self, webhook_url):
         self.url = webhook_url
@@ -23,6 +24,14 @@ class DiscordWebhookAlert(BaseAlert):
 
         return None
 
+    @classmethod
+    def session(cls):
+        """requests.Session: The session shared by all webhooks"""
+        if cls._session is None:
+            import requests
+            cls._session = requests.Session()
+        return cls._session
+
     @property
     def properly_configured(self) -> bool:
         return isinstance(self.url, str) and self.url.startswith("https://")
@@ -41,7 +50,7 @@ class DiscordWebhookAlert(BaseAlert):
                 },
             ]
         }
-        response = requests.post(self.url, params={'wait': True}, json=data)
+        response = self.session().post(self.url, params={'wait': True}, json=data, timeout=self.timeout)
         if response.status_code not in self.success_codes:
             logger.error("Discord webhook failed: %s: %s", response.status_code, response.content)
         else:
@@ -1,7 +1,6 @@
 import os
-import smtplib
 import logging
-from email.mime.text import MIMEText
+import threading
 
 from restic_compose_backup.alerts.base import BaseAlert
 
@@ -17,6 +16,8 @@ class SMTPAlert(BaseAlert):
         self.user = user
         self.password = password
         self.to = to
+        self._server = None
+        self._lock = threading.Lock()
 
     @classmethod
     def create_from_env(cls):
@@ -36,21 +37,53 @@ class SMTPAlert(BaseAlert):
     def properly_configured(self) -> bool:
         return self.host and self.port and self.user and self.password and len(self.to) > 0
 
-    def send(self, subject: str = None, body: str = None, alert_type: str = 'INFO'):
-        # send_mail("Hello world!")
-        msg = MIMEText(body)
-        msg['Subject'] = f"[{alert_type}] {subject}"
-        msg['From'] = self.user
-        msg['To'] = ', '.join(self.to)
+    def connection(self):
+        """smtplib.SMTP_SSL: The open connection. Reconnects if the server closed it"""
+        import smtplib
+
+        if self._server is not None:
+            try:
+                if self._server.noop()[0] == 250:
+                    return self._server
+            except smtplib.SMTPException:
+                pass
+            self.close()
 
+        logger.info("Connecting to %s port %s", self.host, self.port)
+        server = smtplib.SMTP_SSL(self.host, self.port, timeout=self.timeout)
         try:
-            logger.info("Connecting to %s port %s", self.host, self.port)
-            server = smtplib.SMTP_SSL(self.host, self.port)
             server.ehlo()
             server.login(self.user, self.password)
-            server.sendmail(self.user, self.to, msg.as_string())
-            logger.info('Email sent')
-        except Exception as ex:
-            logger.exception(ex)
-        finally:
+        except Exception:
             server.close()
+            raise
+
+        self._server = server
+        return server
+
+    def send(self, subject: str = None, body: str = None, alert_type: str = None):
+        from email.mime.text import MIMEText
+
+        msg = MIMEText(body or "")
+        msg['Subject'] = f"[{alert_type}] {subject}" if alert_type else subject
+        msg['From'] = self.user
+        msg['To'] = ', '.join(self.to)
+
+        with self._lock:
+            try:
+                self.connection().sendmail(self.user, self.to, msg.as_string())
+                logger.info('Email sent')
+            except Exception as ex:
+                logger.exception(ex)
+                self.close()
+
+    def close(self):
+        if self._server is None:
+            return
+
+        import smtplib
+        try:
+            self._server.quit()
+        except (smtplib.SMTPException, OSError):
+            self._server.close()
+        self._server = None
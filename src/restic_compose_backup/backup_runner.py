@@ -1,63 +1,118 @@
+import codecs
 import logging
 import os
+from typing import List
 
 from restic_compose_backup import utils
 
 logger = logging.getLogger(__name__)
 
 
+class LineSplitter:
+    """
+    Split a stream of chunks into lines. Bytes are decoded incrementally
+    so multi-byte characters split between chunks are kept intact.
+    """
+
+    def __init__(self, encoding: str = 'utf-8'):
+        self._decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+        self._parts = []
+
+    def feed(self, data) -> List[str]:
+        """Returns the lines completed by this chunk"""
+        # Make log streaming work for docker ce 17 and 18.
+        # For some reason strings are returned instead if bytes.
+        text = self._decoder.decode(data) if isinstance(data, bytes) else data
+        if '\n' not in text:
+            if text:
+                self._parts.append(text)
+            return []
+
+        lines = text.split('\n')
+        if self._parts:
+            lines[0] = ''.join(self._parts) + lines[0]
+        remainder = lines.pop()
+        self._parts = [remainder] if remainder else []
+        return [line.rstrip() for line in lines]
+
+    def flush(self) -> List[str]:
+        """Returns the last line if the stream did not end with a newline"""
+        text = ''.join(self._parts) + self._decoder.decode(b'', final=True)
+        self._parts = []
+        text = text.rstrip()
+        return [text] if text else []
+
+
 def run(image: str = None, command: str = None, volumes: dict = None,
         environment: dict = None, labels: dict = None, source_container_id: str = None):
     logger.info("Starting backup container")
-    client = utils.docker_client()
+    container = start_container(image, command, volumes, environment, labels, source_container_id)
+
+    logger.info("Backup process container: %s", container.name)
+    # logs=True includes output written before we attached
+    stream = container.attach(stdout=True, stderr=True, stream=True, logs=True, demux=True)
+
+    with open('backup.log', 'w') as fd:
+        relay_output(stream, fd)
+
+    container.wait()
+    container.reload()
+    logger.debug("Container ExitCode %s", container.attrs['State']['ExitCode'])
+    container.remove()
 
-    container = client.containers.run(
+    return container.attrs['State']['ExitCode']
+
+
+def start_container(image: str, command: str, volumes: dict, environment: dict,
+                    labels: dict, source_container_id: str):
+    """Start a backup process or worker container sharing the network stack of the backup service"""
+    client = utils.docker_client()
+    return client.containers.run(
         image,
         command,
         labels=labels,
         # auto_remove=True,  # We remove the container further down
         detach=True,
-        environment=environment + ['BACKUP_PROCESS_CONTAINER=true'],
+        # Python block buffers stdout when it's not a tty
+        environment=environment + ['BACKUP_PROCESS_CONTAINER=true', 'PYTHONUNBUFFERED=1'],
         volumes=volumes,
         network_mode=f'container:{source_container_id}',  # Reuse original container's network stack.
         working_dir=os.getcwd(),
-        tty=True,
+        # Without a tty stdout and stderr are kept apart
+        tty=False,
     )
 
-    logger.info("Backup process container: %s", container.name)
-    log_generator = container.logs(stdout=True, stderr=True, stream=True, follow=True)
-
-    def readlines(stream):
-        """Read stream line by line"""
-        while True:
-            line = ""
-            while True:
-                try:
-                    # Make log streaming work for docker ce 17 and 18.
-                    # For some reason strings are returned instead if bytes.
-                    data = next(stream)
-                    if isinstance(data, bytes):
-                        line += data.decode()
-                    elif isinstance(data, str):
-                        line += data
-                    if line.endswith('\n'):
-                        break
-                except StopIteration:
-                    break
-            if line:
-                yield line.rstrip()
-            else:
-                break
 
-    with open('backup.log', 'w') as fd:
-        for line in readlines(log_generator):
-            fd.write(line)
-            fd.write('\n')
-            logger.info(line)
+def remove_container(name: str):
+    """Stop and remove a container"""
+    client = utils.docker_client()
+    try:
+        client.containers.get(name).remove(force=True)
+    finally:
+        client.close()
 
-    container.wait()
-    container.reload()
-    logger.debug("Container ExitCode %s", container.attrs['State']['ExitCode'])
-    container.remove()
 
-    return container.attrs['State']['ExitCode']
+def relay_output(stream, fd):
+    """
+    Write the demultiplexed (stdout, stderr) chunks from the backup process
+    to ``fd`` line by line and log them. Our own log output is written
+    to stdout by the backup process so stderr is logged as errors.
+    """
+    stdout, stderr = LineSplitter(), LineSplitter()
+
+    def write(lines: List[str], level: int):
+        if not lines:
+            return
+        fd.write('\n'.join(lines))
+        fd.write('\n')
+        for line in lines:
+            logger.log(level, line)
+
+    for out, err in stream:
+        if out:
+            write(stdout.feed(out), logging.INFO)
+        if err:
+            write(stderr.feed(err), logging.ERROR)
+
+    write(stdout.flush(), logging.INFO)
+    write(stderr.flush(), logging.ERROR)
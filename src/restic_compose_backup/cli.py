@@ -1,10 +1,18 @@
 import argparse
+import hashlib
+import json
 import os
 import logging
+import signal
+import threading
+import time
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
 
 from restic_compose_backup import (
     alerts,
     backup_runner,
+    enums,
     log,
     restic,
 )
@@ -12,25 +20,65 @@ from restic_compose_backup.config import Config
 from restic_compose_backup.containers import RunningContainers
 from restic_compose_backup import cron, utils
 
+# Modules only needed by some commands are imported where they are used to keep startup fast
+
 logger = logging.getLogger(__name__)
 
+# Status reports the live containers and whether a backup is running, so it always queries docker
+CACHED_DISCOVERY_ACTIONS = ['alert']
+# Commands that never look at the running containers
+NO_DISCOVERY_ACTIONS = ['crontab', 'cleanup', 'forget', 'prune', 'check', 'worker', 'daemon', 'snapshots', 'test']
+# maintenance.TASKS without importing the module
+MAINTENANCE_ACTIONS = ['forget', 'prune', 'check']
+
 
 def main():
     """CLI entrypoint"""
     args = parse_args()
+    if args.action == 'version':
+        import restic_compose_backup
+        print(restic_compose_backup.__version__)
+        return
+
     config = Config()
     log.setup(level=args.log_level or config.log_level)
-    containers = RunningContainers()
 
-    # Ensure log level is propagated to parent container if overridden
-    if args.log_level:
-        containers.this_container.set_config_env('LOG_LEVEL', args.log_level)
+    containers = None
+    if args.action not in NO_DISCOVERY_ACTIONS:
+        # Only read only commands can use cached container discovery
+        cache_ttl = int(config.discovery_cache_ttl) if args.action in CACHED_DISCOVERY_ACTIONS else 0
+        containers = RunningContainers(
+            cache_ttl=cache_ttl, services=config.services, stopping=config.stopping_containers,
+        )
+
+        # Ensure log level is propagated to parent container if overridden
+        if args.log_level:
+            containers.this_container.set_config_env('LOG_LEVEL', args.log_level)
 
+    # Runs until the container is removed. Each backup run sends its own alerts
+    if args.action == 'worker':
+        run_worker(config)
+        return
+
+    if args.action == 'daemon':
+        run_daemon(config)
+        return
+
+    # Alerts raised during the command are sent as a single message when it completes
+    try:
+        with alerts.digest():
+            run_action(args, config, containers)
+    finally:
+        alerts.dispatcher().close()
+
+
+def run_action(args, config, containers):
+    """Run the command selected on the command line"""
     if args.action == 'status':
         status(config, containers)
 
     elif args.action == 'snapshots':
-        snapshots(config, containers)
+        snapshots(config, refresh=args.refresh, path=args.path, tag=args.tag)
 
     elif args.action == 'backup':
         backup(config, containers)
@@ -41,13 +89,15 @@ def main():
     elif args.action == 'cleanup':
         cleanup(config, containers)
 
+    elif args.action in MAINTENANCE_ACTIONS:
+        result = run_maintenance(config, args.action)
+        if result != 0:
+            logger.error('%s exit code: %s', args.action, result)
+            exit(1)
+
     elif args.action == 'alert':
         alert(config, containers)
 
-    elif args.action == 'version':
-        import restic_compose_backup
-        print(restic_compose_backup.__version__)
-
     elif args.action == "crontab":
         crontab(config)
 
@@ -63,40 +113,59 @@ def main():
 
 def status(config, containers):
     """Outputs the backup config for the compose setup"""
+    from restic_compose_backup import maintenance
+
     logger.info("Status for compose project '%s'", containers.project_name)
     logger.info("Repository: '%s'", config.repository)
     logger.info("Backup currently running?: %s", containers.backup_process_running)
+    if containers.backup_worker_container:
+        logger.info("Backup worker: %s", containers.backup_worker_container.name)
     logger.info("Checking docker availability")
 
-    utils.list_containers()
+    utils.ping_docker()
 
     if containers.stale_backup_process_containers:
         utils.remove_containers(containers.stale_backup_process_containers)
 
-    # Check if repository is initialized with restic snapshots
-    if not restic.is_initialized(config.repository):
-        logger.info("Could not get repository info. Attempting to initialize it.")
-        result = restic.init_repo(config.repository)
-        if result == 0:
-            logger.info("Successfully initialized repository: %s", config.repository)
-        else:
-            logger.error("Failed to initialize repository")
+    if containers.stale_backup_worker_containers:
+        utils.remove_containers(containers.stale_backup_worker_containers)
+
+    ensure_initialized(config)
 
     logger.info("%s Detected Config %s", "-" * 25, "-" * 25)
 
+    index = get_snapshot_index(config)
+
     # Start making snapshots
     backup_containers = containers.containers_for_backup()
+    pings = ping_databases(
+        [container.instance for container in backup_containers if container.database_backup_enabled],
+        timeout=int(config.ping_timeout),
+    )
     for container in backup_containers:
         logger.info('service: %s', container.service_name)
+        if index.complete:
+            latest = index.query(path=f'/databases/{container.service_name}') \
+                + index.query(tag=f'service:{container.service_name}')
+            if latest:
+                logger.info(' - last snapshot: %s', max(snapshot['time'] for snapshot in latest)[:19])
 
         if container.volume_backup_enabled:
             for mount in container.filter_mounts():
                 logger.info(' - volume: %s', mount.source)
+            for pattern in container.backup_excludes():
+                logger.info(' - exclude: %s', pattern)
 
         if container.database_backup_enabled:
             instance = container.instance
-            ping = instance.ping()
+            ping = pings[container.id]['exit_code']
             logger.info(' - %s (is_ready=%s)', instance.container_type, ping == 0)
+            for error in instance.dump_label_errors:
+                logger.error(' - invalid dump labels: %s', error)
+            if instance.dump_mode != enums.DUMP_MODE_DEFAULT:
+                logger.info(' - dump mode: %s (concurrency=%s)', instance.dump_mode, instance.dump_concurrency)
+            if instance.dump_compression:
+                logger.info(' - compression: %s', instance.dump_compression)
             if ping != 0:
                 logger.error("Database '%s' in service %s cannot be reached",
                              instance.container_type, container.service_name)
@@ -104,9 +173,107 @@ def status(config, containers):
     if len(backup_containers) == 0:
         logger.info("No containers in the project has 'restic-compose-backup.*' label")
 
+    if pings:
+        logger.info("%s Database Availability %s", "-" * 21, "-" * 21)
+        logger.info('%-24s %-12s %-10s %-8s %s', 'service', 'container', 'type', 'ready', 'latency')
+        for result in pings.values():
+            logger.info(
+                '%-24s %-12s %-10s %-8s %.0fms', result['service'], result['id'][:12], result['type'],
+                result['exit_code'] == 0, result['latency'] * 1000,
+            )
+
+    scheduled = cron.maintenance_schedules(config)
+    history = maintenance.MaintenanceHistory(os.path.join(config.cache_dir, 'maintenance.json'), config.repository)
+    for task in maintenance.TASKS:
+        last = history.last(task)
+        logger.info(
+            'maintenance: %s schedule=%s last_exit_code=%s',
+            task, scheduled.get(task, 'after backup'), last.get('exit_code'),
+        )
+    if history.subset:
+        logger.info(
+            'data check: cycle %s, %.0f%% of %s slices verified',
+            history.subset['cycle'], history.coverage * 100, history.subset['total'],
+        )
+
     logger.info("-" * 67)
 
 
+def ensure_initialized(config):
+    """
+    Make sure the repository is initialized. A successful probe or init is
+    remembered in the cache directory so repeated runs skip the backend
+    round trip. The marker is keyed by a hash of the repository url.
+    """
+    marker = os.path.join(
+        config.cache_dir, 'repositories',
+        hashlib.sha256(config.repository.encode()).hexdigest() + '.json',
+    )
+    if os.path.exists(marker):
+        logger.debug("Repository initialization already verified: %s", marker)
+        return
+
+    if restic.is_initialized(config.repository):
+        probe = 'cat config'
+    else:
+        logger.info("Could not get repository info. Attempting to initialize it.")
+        if restic.init_repo(config.repository) != 0:
+            logger.error("Failed to initialize repository")
+            return
+        logger.info("Successfully initialized repository: %s", config.repository)
+        probe = 'init'
+
+    utils.write_json(marker, {'verified': time.time(), 'probe': probe})
+
+
+def ping_database(instance, timeout: float) -> dict:
+    """Ping a database returning the exit code and latency"""
+    start = time.monotonic()
+    try:
+        result = instance.ping(timeout=timeout)
+    except Exception as ex:
+        logger.exception(ex)
+        result = 1
+
+    return {
+        'id': instance.id,
+        'service': instance.service_name,
+        'type': instance.container_type,
+        'exit_code': result,
+        'latency': time.monotonic() - start,
+    }
+
+
+def ping_databases(instances, timeout: float) -> dict:
+    """Ping all databases at the same time. Returns the ping results by container id so replicas are kept apart"""
+    if not instances:
+        return {}
+
+    with ThreadPoolExecutor(max_workers=len(instances)) as executor:
+        results = list(executor.map(lambda instance: ping_database(instance, timeout), instances))
+
+    return {result['id']: result for result in results}
+
+
+def wait_for_database(instance, timeout: float, retries: int) -> bool:
+    """Ping a database until it's ready backing off between attempts. Returns False if it never was"""
+    delay = 1
+    for attempt in range(1, retries + 1):
+        result = ping_database(instance, timeout)
+        if result['exit_code'] == 0:
+            return True
+
+        if attempt < retries:
+            logger.warning(
+                'Database in service %s not ready (attempt %s/%s). Retrying in %ss',
+                instance.service_name, attempt, retries, delay,
+            )
+            time.sleep(delay)
+            delay = min(delay * 2, 30)
+
+    return False
+
+
 def backup(config, containers):
     """Request a backup to start"""
     # Make sure we don't spawn multiple backup processes
@@ -125,23 +292,36 @@ def backup(config, containers):
     # Map all volumes from the backup container into the backup process container
     volumes = containers.this_container.volumes
 
-    # Map volumes from other containers we are backing up
-    mounts = containers.generate_backup_mounts('/volumes')
+    # Map volumes from other containers we are backing up. The worker always mounts all of them
+    mounts = containers.generate_backup_mounts('/volumes', all_services=utils.is_true(config.backup_worker))
     volumes.update(mounts)
 
+    # A partial backup passes the services on to the backup process
+    environment = containers.this_container.environment
+    if containers.services:
+        environment = environment + ['BACKUP_SERVICES={}'.format(','.join(containers.services))]
+    # Stopped services are gone by the time the backup process looks for them
+    if containers.stopping:
+        environment = environment + ['BACKUP_STOPPING_CONTAINERS={}'.format(json.dumps(containers.stopping))]
+
     logger.debug('Starting backup container with image %s', containers.this_container.image)
     try:
-        result = backup_runner.run(
-            image=containers.this_container.image,
-            command='restic-compose-backup start-backup-process',
-            volumes=volumes,
-            environment=containers.this_container.environment,
-            source_container_id=containers.this_container.id,
-            labels={
-                containers.backup_process_label: 'True',
-                "com.docker.compose.project": containers.project_name,
-            },
-        )
+        if utils.is_true(config.backup_worker):
+            result = backup_in_worker(config, containers, volumes)
+        else:
+            if containers.backup_worker_container:
+                stop_backup_worker(config, containers)
+            result = backup_runner.run(
+                image=containers.this_container.image,
+                command='restic-compose-backup start-backup-process',
+                volumes=volumes,
+                environment=environment,
+                source_container_id=containers.this_container.id,
+                labels={
+                    containers.backup_process_label: 'True',
+                    "com.docker.compose.project": containers.project_name,
+                },
+            )
     except Exception as ex:
         logger.exception(ex)
         alerts.send(
@@ -162,6 +342,146 @@ def backup(config, containers):
         )
 
 
+def backup_worker_lock(config) -> str:
+    """str: Lock file held while a backup uses or replaces the worker"""
+    return os.path.join(config.cache_dir, 'backup-worker.lock')
+
+
+def backup_in_worker(config, containers, volumes: dict) -> int:
+    """
+    Run the backup in the long-lived worker container. The worker is
+    started if it's not running and recreated when the mounts changed.
+    """
+    # The worker must be idle before it can be recreated or handed another backup
+    with utils.file_lock(backup_worker_lock(config)) as locked:
+        if not locked:
+            raise RuntimeError("The backup worker is busy with another backup")
+        return run_in_worker(config, containers, volumes)
+
+
+def run_in_worker(config, containers, volumes: dict) -> int:
+    from restic_compose_backup import worker
+
+    this_container = containers.this_container
+    expected_hash = worker.worker_hash(volumes, this_container.image, this_container.id)
+
+    if containers.stale_backup_worker_containers:
+        utils.remove_containers(containers.stale_backup_worker_containers)
+
+    current = containers.backup_worker_container
+    if current and current.get_label(enums.LABEL_BACKUP_WORKER_HASH) != expected_hash:
+        logger.info('Backup mounts changed. Recreating backup worker %s', current.name)
+        backup_runner.remove_container(current.name)
+        current = None
+
+    if current is None:
+        container = backup_runner.start_container(
+            image=this_container.image,
+            command='restic-compose-backup worker',
+            volumes=volumes,
+            environment=this_container.environment,
+            source_container_id=this_container.id,
+            labels={
+                containers.backup_worker_label: 'True',
+                enums.LABEL_BACKUP_WORKER_HASH: expected_hash,
+                "com.docker.compose.project": containers.project_name,
+            },
+        )
+        logger.info('Started backup worker container: %s', container.name)
+    else:
+        logger.info('Using backup worker container: %s', current.name)
+
+    with open('backup.log', 'w') as fd:
+        return worker.request_backup(
+            int(config.backup_worker_port), fd, services=containers.services, stopping=containers.stopping,
+        )
+
+
+def stop_backup_worker(config, containers):
+    """Remove the backup worker after BACKUP_WORKER was turned off unless it's still running a backup"""
+    with utils.file_lock(backup_worker_lock(config)) as locked:
+        if not locked:
+            logger.warning('Backup worker %s is busy. Not removing it', containers.backup_worker_container.name)
+            return
+        logger.info('Backup worker disabled. Removing %s', containers.backup_worker_container.name)
+        backup_runner.remove_container(containers.backup_worker_container.name)
+
+
+def run_worker(config):
+    """Serve backup requests. Each backup runs in a forked child with fresh discovery"""
+    if not utils.is_true(os.environ.get('BACKUP_PROCESS_CONTAINER')):
+        logger.error("The backup worker can only run in a container started by the backup command")
+        exit(1)
+
+    from restic_compose_backup import worker
+
+    def run_backup(services, stopping):
+        with alerts.digest():
+            start_backup_process(Config(), RunningContainers(services=services, stopping=stopping))
+        return 0
+
+    worker.serve(int(config.backup_worker_port), run_backup)
+
+
+def run_daemon(config):
+    """Run the backup and scheduled maintenance jobs in this process"""
+    from restic_compose_backup import daemon
+    from restic_compose_backup.cron import CronSchedule
+    from restic_compose_backup.registry import ContainerRegistry, is_stopping
+
+    utils.keep_docker_client()
+
+    registry = None
+    if utils.is_true(config.docker_events):
+        registry = ContainerRegistry(os.environ['HOSTNAME'])
+
+    def running_containers(services=None, stopping=None):
+        if registry:
+            return registry.running_containers(services=services, stopping=stopping)
+        return RunningContainers(services=services, stopping=stopping)
+
+    def backup_job(services=None, stopping=None):
+        with alerts.digest():
+            backup(config, running_containers(services=services or config.services, stopping=stopping))
+
+    def maintenance_job(task):
+        with alerts.digest():
+            result = run_maintenance(config, task)
+        if result != 0:
+            logger.error('%s exit code: %s', task, result)
+
+    schedule = cron.clean_schedule(config.cron_schedule) or config.default_crontab_schedule
+    jobs = [daemon.Job('backup', CronSchedule(schedule), backup_job)]
+    for task, schedule in cron.maintenance_schedules(config).items():
+        jobs.append(daemon.Job(task, CronSchedule(schedule), lambda task=task: maintenance_job(task)))
+
+    scheduler = daemon.Scheduler(jobs)
+
+    def on_container_event(action, container, attributes):
+        """Back up the volumes of a service while it's being stopped or recreated"""
+        if not is_stopping(action, attributes) or not container.volume_backup_enabled:
+            return
+        # Only containers in the backup plan
+        if not any(c.id == container.id for c in registry.running_containers().containers_for_backup()):
+            return
+        logger.info('Service %s is stopping. Backing up its volumes', container.service_name)
+        # The container has usually exited or was removed by the time the backup runs
+        data = container.to_dict()
+        scheduler.trigger(
+            f'backup-{container.service_name}',
+            lambda: backup_job(services=[container.service_name], stopping=[data]),
+        )
+
+    if registry:
+        if utils.is_true(config.backup_on_stop):
+            registry.listeners.append(on_container_event)
+        registry.start()
+
+    signal.signal(signal.SIGTERM, scheduler.stop)
+    signal.signal(signal.SIGINT, scheduler.stop)
+    scheduler.run_forever()
+
+
 def start_backup_process(config, containers):
     """The actual backup process running inside the spawned container"""
     if not utils.is_true(os.environ.get('BACKUP_PROCESS_CONTAINER')):
@@ -178,7 +498,30 @@ def start_backup_process(config, containers):
         )
         exit(1)
 
-    status(config, containers)
+    from restic_compose_backup.metrics import BackupMetrics
+
+    backup_metrics = BackupMetrics(containers.project_name)
+    success = False
+    try:
+        with backup_metrics.phase('status') as phase:
+            # Still failed if status raises
+            phase['exit_code'] = 1
+            status(config, containers)
+            phase['exit_code'] = 0
+        success = run_backup(config, containers, backup_metrics)
+    finally:
+        backup_metrics.finish(success)
+        backup_metrics.log()
+        backup_metrics.write(config.metrics_dir)
+
+    if not success:
+        exit(1)
+
+    logger.info('Backup completed')
+
+
+def run_backup(config, containers, backup_metrics) -> bool:
+    """Run each phase of the backup recording metrics. Returns True on success"""
     errors = False
 
     # Did we actually get any volumes mounted?
@@ -191,78 +534,334 @@ def start_backup_process(config, containers):
     # Warn if there is nothing to do
     if len(containers.containers_for_backup()) == 0 and not has_volumes:
         logger.error("No containers for backup found")
-        exit(1)
+        return False
 
     if has_volumes:
-        try:
-            logger.info('Backing up volumes')
-            vol_result = restic.backup_files(config.repository, source='/volumes')
-            logger.debug('Volume backup exit code: %s', vol_result)
-            if vol_result != 0:
-                logger.error('Volume backup exited with non-zero code: %s', vol_result)
-                errors = True
-        except Exception as ex:
-            logger.error('Exception raised during volume backup')
-            logger.exception(ex)
-            errors = True
-
-    # back up databases
-    logger.info('Backing up databases')
-    for container in containers.containers_for_backup():
-        if container.database_backup_enabled:
+        with backup_metrics.phase('volumes') as phase:
             try:
-                instance = container.instance
-                logger.info('Backing up %s in service %s', instance.container_type, instance.service_name)
-                result = instance.backup()
-                logger.debug('Exit code: %s', result)
-                if result != 0:
-                    logger.error('Backup command exited with non-zero code: %s', result)
+                logger.info('Backing up volumes')
+                vol_result = backup_volumes(config, containers, metrics=backup_metrics)
+                logger.debug('Volume backup exit code: %s', vol_result)
+                if vol_result != 0:
+                    logger.error('Volume backup exited with non-zero code: %s', vol_result)
                     errors = True
             except Exception as ex:
+                logger.error('Exception raised during volume backup')
                 logger.exception(ex)
+                vol_result = 1
                 errors = True
+            phase['exit_code'] = vol_result
+
+    # back up databases
+    with backup_metrics.phase('databases') as phase:
+        db_errors = backup_databases(config, containers, metrics=backup_metrics)
+        phase['exit_code'] = int(db_errors)
+        if db_errors:
+            errors = True
+
+    # Add the new snapshots to the index even if some of the backups failed.
+    # The index is only built by the snapshots command so backups never list the whole repository
+    index = get_snapshot_index(config)
+    if index.complete and index.update(backup_metrics.snapshot_ids) == 0:
+        index.save()
 
     if errors:
         logger.error('Exit code: %s', errors)
-        exit(1)
+        return False
+
+    if containers.services:
+        logger.info('Partial backup of %s. Skipping maintenance', ', '.join(containers.services))
+        return True
+
+    from restic_compose_backup import maintenance
+
+    # Only run maintenance if backup was successful. Scheduled tasks run from their own cron entry
+    scheduled = cron.maintenance_schedules(config)
+    for task in maintenance.TASKS:
+        if task in scheduled:
+            logger.info('Skipping %s scheduled at %s', task, scheduled[task])
+            continue
+
+        result = run_maintenance(config, task, metrics=backup_metrics)
+        logger.debug('%s exit code: %s', task, result)
+        if result != 0:
+            logger.error('%s exit code: %s', task, result)
+            return False
+
+    return True
+
+
+def backup_volumes(config, containers, metrics=None) -> int:
+    """
+    Back up the mounted volumes as one or more restic snapshots depending
+    on the volume backup mode using a bounded worker pool. With the change
+    index enabled units unchanged since their last successful backup are skipped.
+    """
+    units = volume_backup_units(config, containers)
+    if not units:
+        return 0
+
+    from restic_compose_backup import volume_index
+
+    index = None
+    if utils.is_true(config.volume_change_index):
+        index = volume_index.VolumeIndex(os.path.join(config.cache_dir, 'volume_index.json'), config.repository)
+
+    exclude_file = write_exclude_file(config, containers)
+    lock = threading.Lock()
+    skipped = []
+
+    def run(unit):
+        path, tags = unit
+        if not os.path.isdir(path):
+            logger.warning('Mount %s not found in backup process container', path)
+            return 0
+
+        marker = None
+        if index:
+            marker = volume_index.scan(path)
+            if not index.changed(path, marker):
+                skipped.append(path)
+                return 0
+
+        logger.info('Backing up %s', path)
+        start = time.monotonic()
+        stats = {}
+        try:
+            result = restic.backup_files(
+                config.repository,
+                source=path,
+                tags=tags,
+                exclude_file=exclude_file,
+                progress_interval=int(config.progress_interval),
+                stats=stats,
+            )
+        except Exception as ex:
+            logger.exception(ex)
+            result = 1
 
-    # Only run cleanup if backup was successful
-    result = cleanup(config, container)
-    logger.debug('cleanup exit code: %s', result)
-    if result != 0:
-        logger.error('cleanup exit code: %s', result)
-        exit(1)
+        if metrics:
+            metrics.add_target(path, 'volume', time.monotonic() - start, result)
+            metrics.add_summary(path, stats.get('summary'))
 
-    # Test the repository for errors
-    logger.info("Checking the repository for errors")
-    result = restic.check(config.repository)
-    if result != 0:
-        logger.error('Check exit code: %s', result)
-        exit(1)
+        if result != 0:
+            logger.error('Backup of %s exited with non-zero code: %s', path, result)
+        elif index:
+            with lock:
+                index.update(path, marker)
+                index.save()
 
-    logger.info('Backup completed')
+        return result
+
+    workers = min(int(config.volume_backup_concurrency), len(units))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(run, units))
+
+    if index:
+        logger.info('Skipped %s unchanged out of %s', len(skipped), len(units))
+        for path in sorted(skipped):
+            logger.info(' - unchanged: %s', path)
+
+    return 0 if all(result == 0 for result in results) else 1
+
+
+def write_exclude_file(config, containers) -> str:
+    """str: Write restic excludes for paths inside mounts to a file returning the path or None"""
+    excludes = containers.generate_backup_excludes('/volumes')
+    if not excludes:
+        return None
+
+    path = os.path.join(config.cache_dir, 'excludes.txt')
+    os.makedirs(config.cache_dir, exist_ok=True)
+    with open(path, 'w') as fd:
+        fd.write('\n'.join(excludes) + '\n')
+
+    logger.info('Excluding %s paths inside mounts', len(excludes))
+    for pattern in excludes:
+        logger.debug(' - exclude: %s', pattern)
+
+    return path
+
+
+def volume_backup_units(config, containers) -> list:
+    """list: (path, tags) of each separate volume backup for the configured mode"""
+    mode = config.volume_backup_mode
+    # The change index needs separate snapshots to skip anything
+    if mode == enums.VOLUME_BACKUP_MODE_SINGLE and utils.is_true(config.volume_change_index):
+        mode = enums.VOLUME_BACKUP_MODE_MOUNT
+    # A partial /volumes snapshot would replace the full one in the forget policy
+    if mode == enums.VOLUME_BACKUP_MODE_SINGLE and containers.services:
+        mode = enums.VOLUME_BACKUP_MODE_SERVICE
+
+    if mode == enums.VOLUME_BACKUP_MODE_SINGLE:
+        return [('/volumes', [])]
+
+    units = {}
+    for container in containers.containers_for_backup():
+        if not container.volume_backup_enabled:
+            continue
+
+        tags = [f'service:{container.service_name}']
+        if mode == enums.VOLUME_BACKUP_MODE_SERVICE:
+            units[f'/volumes/{container.service_name}'] = tags
+        else:
+            for mount in container.volumes_for_backup(source_prefix='/volumes').values():
+                units[mount['bind']] = tags
+
+    return sorted(units.items())
+
+
+def backup_databases(config, containers, metrics=None) -> bool:
+    """
+    Back up all databases using a bounded worker pool.
+    Returns True if one or more backups failed.
+    """
+    instances = [
+        container.instance
+        for container in containers.containers_for_backup()
+        if container.database_backup_enabled
+    ]
+    if not instances:
+        return False
+
+    workers = min(int(config.db_backup_concurrency), len(instances))
+    logger.info('Backing up %s databases using %s worker(s)', len(instances), workers)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(lambda instance: backup_database(instance, config, metrics=metrics), instances))
+
+    errors = False
+    logger.info('%s Database Backups %s', '-' * 25, '-' * 25)
+    for result in results:
+        logger.info(
+            'service: %s (%s) exit_code=%s duration=%.1fs',
+            result['service'], result['type'], result['exit_code'], result['duration'],
+        )
+        if result['exit_code'] != 0:
+            errors = True
+        if metrics:
+            metrics.add_target(result['service'], result['type'], result['duration'], result['exit_code'])
+
+    return errors
+
+
+def backup_database(instance, config, metrics=None) -> dict:
+    """Back up a single database returning the exit code and duration"""
+    logger.info('Backing up %s in service %s', instance.container_type, instance.service_name)
+    start = time.monotonic()
+    try:
+        if not wait_for_database(instance, int(config.ping_timeout), int(config.ping_retries)):
+            raise RuntimeError(f'Database in service {instance.service_name} cannot be reached')
+        result = instance.backup(metrics=metrics)
+        logger.debug('Exit code: %s', result)
+        if result != 0:
+            logger.error('Backup command for service %s exited with non-zero code: %s',
+                         instance.service_name, result)
+    except Exception as ex:
+        logger.exception(ex)
+        result = 1
+
+    return {
+        'service': instance.service_name,
+        'type': instance.container_type,
+        'exit_code': result,
+        'duration': time.monotonic() - start,
+    }
 
 
 def cleanup(config, containers):
     """Run forget / prune to minimize storage space"""
-    logger.info('Forget outdated snapshots')
-    forget_result = restic.forget(
-        config.repository,
-        config.keep_daily,
-        config.keep_weekly,
-        config.keep_monthly,
-        config.keep_yearly,
+    forget_result = run_maintenance(config, 'forget')
+    prune_result = run_maintenance(config, 'prune')
+    return forget_result or prune_result
+
+
+def run_maintenance(config, task: str, metrics=None) -> int:
+    """Run a maintenance task recording the outcome in the maintenance history"""
+    from restic_compose_backup.maintenance import MaintenanceHistory
+
+    history = MaintenanceHistory(os.path.join(config.cache_dir, 'maintenance.json'), config.repository)
+    start = time.monotonic()
+    extra = {}
+    with metrics.phase(task) if metrics else nullcontext({}) as phase:
+        if task == 'forget':
+            logger.info('Forget outdated snapshots')
+            removed = []
+            result = restic.forget(
+                config.repository,
+                config.keep_daily,
+                config.keep_weekly,
+                config.keep_monthly,
+                config.keep_yearly,
+                removed=removed,
+            )
+            index = get_snapshot_index(config)
+            index.remove(removed)
+            index.save()
+        elif task == 'prune':
+            logger.info('Prune stale data freeing storage space')
+            result = restic.prune(config.repository)
+        elif task == 'check':
+            result = check(config, history, extra)
+        else:
+            raise ValueError(f"Unknown maintenance task: {task}")
+        phase['exit_code'] = result
+
+    history.record(task, result, time.monotonic() - start, **extra)
+    history.save()
+    return result
+
+
+def check(config, history, extra: dict) -> int:
+    """Check the repository reading the slices of pack data that are due if enabled"""
+    with_cache = utils.is_true(config.check_with_cache)
+    total = int(config.check_data_subsets)
+    if not total:
+        logger.info("Checking the repository for errors")
+        return restic.check(config.repository, with_cache=with_cache)
+
+    result = 0
+    verified = extra['subsets'] = []
+    for number in history.due_subsets(total, period=int(config.check_data_period) * 86400):
+        subset = f'{number}/{total}'
+        logger.info("Checking the repository for errors reading data subset %s", subset)
+        # restic repeats the structure check on every run and reads one subset per run.
+        # Only the first run downloads the metadata, the others use the local cache.
+        result = restic.check(config.repository, read_data_subset=subset, with_cache=with_cache or bool(verified))
+        if result != 0:
+            break
+
+        # Save after every slice so an interrupted check resumes where it stopped
+        history.advance_subset(total)
+        history.save()
+        verified.append(subset)
+
+    logger.info(
+        'Data check cycle %s: %.0f%% of %s slices verified',
+        history.subset['cycle'], history.coverage * 100, total,
     )
-    logger.info('Prune stale data freeing storage space')
-    prune_result = restic.prune(config.repository)
-    return forget_result and prune_result
+    return result
+
+
+def snapshots(config, refresh=False, path=None, tag=None):
+    """Display the latest snapshots from the snapshot index"""
+    from restic_compose_backup import snapshot_index
+
+    index = get_snapshot_index(config)
+    if refresh or not index.complete:
+        logger.info('Rebuilding the snapshot index')
+        if index.rebuild() != 0:
+            logger.error('Unable to list snapshots in %s', config.repository)
+            exit(1)
+        index.save()
 
+    print(snapshot_index.format_table(index.query(path=path, tag=tag, last=True)))
 
-def snapshots(config, containers):
-    """Display restic snapshots"""
-    stdout, stderr = restic.snapshots(config.repository, last=True)
-    for line in stdout.decode().split('\n'):
-        print(line)
+
+def get_snapshot_index(config):
+    """SnapshotIndex: The snapshot index in the cache directory"""
+    from restic_compose_backup.snapshot_index import SnapshotIndex
+
+    return SnapshotIndex(os.path.join(config.cache_dir, 'snapshots.json'), config.repository)
 
 
 def alert(config, containers):
@@ -288,8 +887,13 @@ def parse_args():
             'snapshots',
             'backup',
             'start-backup-process',
+            'worker',
+            'daemon',
             'alert',
             'cleanup',
+            'forget',
+            'prune',
+            'check',
             'version',
             'crontab',
             'test',
@@ -301,6 +905,21 @@ def parse_args():
         choices=list(log.LOG_LEVELS.keys()),
         help="Log level"
     )
+    parser.add_argument(
+        '--refresh',
+        action='store_true',
+        help="Rebuild the snapshot index from the repository",
+    )
+    parser.add_argument(
+        '--path',
+        default=None,
+        help="Only show snapshots of this path such as /volumes/web",
+    )
+    parser.add_argument(
+        '--tag',
+        default=None,
+        help="Only show snapshots with this tag such as service:web",
+    )
     return parser.parse_args()
 
 
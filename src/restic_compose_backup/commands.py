@@ -1,15 +1,27 @@
+import os
+import time
+import signal
 import logging
-from typing import List, Tuple
+import threading
+from collections import deque
+from typing import Callable, List, Mapping, Tuple
 from subprocess import Popen, PIPE
 
 logger = logging.getLogger(__name__)
 
+# Number of output lines kept from each stream of a command
+TAIL_LINES = 200
+# Max seconds between checks for exit, timeout and cancellation
+POLL_INTERVAL = 0.1
+# Seconds a terminated command gets to exit before it is killed
+TERMINATE_GRACE = 10
+
 
 def test():
     return run(['ls', '/volumes'])
 
 
-def ping_mysql(host, port, username) -> int:
+def ping_mysql(host, port, username, env: Mapping[str, str] = None, timeout: float = None) -> int:
     """Check if the mysql is up and can be reached"""
     return run([
         'mysqladmin',
@@ -20,10 +32,10 @@ def ping_mysql(host, port, username) -> int:
         port,
         '--user',
         username,
-    ])
+    ] + connect_timeout_args(timeout), env=env, timeout=timeout)
 
 
-def ping_mariadb(host, port, username) -> int:
+def ping_mariadb(host, port, username, env: Mapping[str, str] = None, timeout: float = None) -> int:
     """Check if the mariadb is up and can be reached"""
     return run([
         'mysqladmin',
@@ -34,41 +46,235 @@ def ping_mariadb(host, port, username) -> int:
         port,
         '--user',
         username,
-    ])
+    ] + connect_timeout_args(timeout), env=env, timeout=timeout)
+
+
+def connect_timeout_args(timeout: float = None) -> List[str]:
+    """list: mysqladmin arguments giving up connecting after ``timeout`` seconds"""
+    if not timeout:
+        return []
+    return [f'--connect-timeout={max(1, int(timeout))}']
 
 
-def ping_postgres(host, port, username, password) -> int:
+def list_mysql_databases(host, port, username, env: Mapping[str, str] = None) -> List[str]:
+    """List all databases in a mysql/mariadb server. Raises RuntimeError if the listing fails"""
+    return list_databases([
+        'mysql',
+        '--host',
+        host,
+        '--port',
+        port,
+        '--user',
+        username,
+        '--batch',
+        '--skip-column-names',
+        '--execute',
+        'SHOW DATABASES',
+    ], env=env)
+
+
+def list_databases(cmd: List[str], env: Mapping[str, str] = None) -> List[str]:
+    """Run a command printing one database name per line"""
+    databases = []
+    result = execute(cmd, env=env, on_stdout=databases.append)
+    if result.returncode != 0:
+        raise RuntimeError("Unable to list databases (exit code {}): {}".format(
+            result.returncode, '\n'.join(result.stderr).strip()))
+
+    return [name.strip() for name in databases if name.strip()]
+
+
+def list_postgres_databases(host, port, username, database, env: Mapping[str, str] = None) -> List[str]:
+    """List all databases in a postgres server accepting connections. Raises RuntimeError if the listing fails"""
+    return list_databases([
+        'psql',
+        f'--host={host}',
+        f'--port={port}',
+        f'--username={username}',
+        f'--dbname={database or "postgres"}',
+        '--no-align',
+        '--tuples-only',
+        '--command',
+        'SELECT datname FROM pg_database WHERE datallowconn AND NOT datistemplate',
+    ], env=env)
+
+
+def ping_postgres(host, port, username, env: Mapping[str, str] = None, timeout: float = None) -> int:
     """Check if postgres can be reached"""
     return run([
         "pg_isready",
         f"--host={host}",
         f"--port={port}",
         f"--username={username}",
-    ])
+    ] + ([f"--timeout={max(1, int(timeout))}"] if timeout else []), env=env, timeout=timeout)
 
 
-def run(cmd: List[str]) -> int:
-    """Run a command with parameters"""
-    logger.debug('cmd: %s', ' '.join(cmd))
-    child = Popen(cmd, stdout=PIPE, stderr=PIPE)
-    stdoutdata, stderrdata = child.communicate()
+class CommandResult:
+    """The outcome and resource usage of a finished command"""
+
+    def __init__(self, cmd: List[str]):
+        self.cmd = cmd
+        self.returncode = None
+        #: The last lines written to stdout and stderr
+        self.stdout = deque(maxlen=TAIL_LINES)
+        self.stderr = deque(maxlen=TAIL_LINES)
+        self.wall_time = 0.0
+        #: User + system cpu time in seconds
+        self.cpu_time = 0.0
+        #: Peak resident set size in KiB
+        self.max_rss = 0
+        self.timed_out = False
+        self.cancelled = False
+
+    @property
+    def name(self) -> str:
+        """str: Short name of the command. Includes the sub command for restic"""
+        if self.cmd[0] == 'restic':
+            args = [arg for arg in self.cmd[3:] if not arg.startswith('-')]
+            return 'restic {}'.format(args[0]) if args else 'restic'
+        return self.cmd[0]
 
-    if stdoutdata.strip():
-        log_std('stdout', stdoutdata.decode(),
-                logging.DEBUG if child.returncode == 0 else logging.ERROR)
+    def log_usage(self, level: int = logging.DEBUG):
+        logger.log(
+            level, "%s: exit code %s in %.1fs (cpu %.1fs, max rss %.1f MiB)",
+            self.name, self.returncode, self.wall_time, self.cpu_time, self.max_rss / 1024,
+        )
 
-    if stderrdata.strip():
-        log_std('stderr', stderrdata.decode(), logging.ERROR)
 
-    logger.debug("returncode %s", child.returncode)
-    return child.returncode
+def run(cmd: List[str], env: Mapping[str, str] = None, on_stdout: Callable[[str], None] = None,
+        timeout: float = None, cancel: threading.Event = None, log_usage: bool = False) -> int:
+    """
+    Run a command with parameters.
+    Variables in ``env`` are only set for the child process.
+    See ``execute`` for the other arguments.
+    """
+    result = execute(cmd, env=env, on_stdout=on_stdout, timeout=timeout, cancel=cancel)
 
+    if result.stdout and on_stdout is None:
+        log_std('stdout', '\n'.join(result.stdout),
+                logging.DEBUG if result.returncode == 0 else logging.ERROR)
 
-def run_capture_std(cmd: List[str]) -> Tuple[str, str]:
-    """Run a command with parameters and return stdout, stderr"""
+    if result.stderr:
+        log_std('stderr', '\n'.join(result.stderr), logging.ERROR)
+
+    result.log_usage(logging.INFO if log_usage else logging.DEBUG)
+    return result.returncode
+
+
+def execute(cmd: List[str], env: Mapping[str, str] = None, on_stdout: Callable[[str], None] = None,
+            timeout: float = None, cancel: threading.Event = None, stdin=None) -> CommandResult:
+    """
+    Run a command streaming its output line by line.
+    Only the last ``TAIL_LINES`` lines of stdout and stderr are kept.
+
+    Args:
+        env: Variables only set for the child process
+        on_stdout: Called with each line written to stdout as soon as it arrives
+        timeout: Seconds before the command is terminated
+        cancel: Event terminating the command when set
+        stdin: File object or descriptor the command reads from.
+               It is closed in this process once the command is started.
+    """
     logger.debug('cmd: %s', ' '.join(cmd))
-    child = Popen(cmd, stdout=PIPE, stderr=PIPE)
-    return child.communicate()
+    result = CommandResult(cmd)
+    start = time.monotonic()
+    try:
+        child = Popen(cmd, stdin=stdin, stdout=PIPE, stderr=PIPE, env=child_env(env))
+    finally:
+        if isinstance(stdin, int):
+            os.close(stdin)
+        elif stdin is not None:
+            stdin.close()
+
+    def read(stream, lines, callback=None):
+        for line in stream:
+            line = line.decode(errors='replace').rstrip('\n')
+            lines.append(line)
+            if callback:
+                callback(line)
+
+    readers = [
+        threading.Thread(target=read, args=(child.stdout, result.stdout, on_stdout), daemon=True),
+        threading.Thread(target=read, args=(child.stderr, result.stderr), daemon=True),
+    ]
+    for reader in readers:
+        reader.start()
+
+    deadline = start + timeout if timeout else None
+    terminated_at = None
+    delay = 0.005
+    while True:
+        pid, status, rusage = os.wait4(child.pid, os.WNOHANG)
+        if pid:
+            break
+
+        now = time.monotonic()
+        if terminated_at is None:
+            if deadline and now > deadline:
+                logger.error('%s timed out after %ss', result.name, timeout)
+                result.timed_out = True
+            elif cancel and cancel.is_set():
+                logger.error('%s cancelled', result.name)
+                result.cancelled = True
+
+            # Popen.terminate() and kill() poll and may reap the child we wait for below.
+            # The pid can't be reused until we reap it, so signalling it directly is safe.
+            if result.timed_out or result.cancelled:
+                os.kill(child.pid, signal.SIGTERM)
+                terminated_at = now
+        elif now - terminated_at > TERMINATE_GRACE:
+            os.kill(child.pid, signal.SIGKILL)
+
+        # Back off so short commands return quickly without busy waiting on long ones
+        if cancel:
+            cancel.wait(delay)
+        else:
+            time.sleep(delay)
+        delay = min(delay * 2, POLL_INTERVAL)
+
+    # We reaped the child ourselves to get the resource usage
+    child.returncode = exit_code(status)
+    for reader in readers:
+        reader.join(timeout=TERMINATE_GRACE)
+    child.stdout.close()
+    child.stderr.close()
+
+    result.returncode = child.returncode
+    result.wall_time = time.monotonic() - start
+    result.cpu_time = rusage.ru_utime + rusage.ru_stime
+    result.max_rss = rusage.ru_maxrss
+    logger.debug("returncode %s", result.returncode)
+    return result
+
+
+def exit_code(status: int) -> int:
+    """int: Convert a wait status to a returncode like subprocess does"""
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def run_capture_std(cmd: List[str], env: Mapping[str, str] = None) -> Tuple[str, str]:
+    """
+    Run a command with parameters and return stdout, stderr.
+    All of stdout is returned while only the last ``TAIL_LINES`` lines of stderr are kept.
+    """
+    stdout = []
+    result = execute(cmd, env=env, on_stdout=stdout.append)
+    result.log_usage()
+    return '\n'.join(stdout), '\n'.join(result.stderr)
+
+
+def child_env(env: Mapping[str, str] = None) -> dict:
+    """
+    Build the environment for a child process.
+    Returns None (inherit our environment) when there is nothing to add
+    so the process environment is never modified or copied needlessly.
+    """
+    if not env:
+        return None
+
+    return {**os.environ, **env}
 
 
 def log_std(source: str, data: str, level: int):
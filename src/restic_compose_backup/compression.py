@@ -0,0 +1,71 @@
+"""
+Optional compression stage for database dumps streamed into restic.
+
+The compression is configured per container with the
+``restic-compose-backup.dump.compression`` label using the format
+``<algorithm>[:<level>][:rsyncable]``. Examples::
+
+    zstd
+    zstd:19
+    gzip:6:rsyncable
+"""
+from typing import List
+
+# algorithm: (command, file extension, (min level, max level), default level)
+COMPRESSORS = {
+    'gzip': (['gzip', '--stdout'], '.gz', (1, 9), 6),
+    'zstd': (['zstd', '--stdout', '--quiet'], '.zst', (1, 19), 3),
+}
+DISABLED_VALUES = ['', 'none', 'false', 'False']
+
+
+class Compression:
+    """Compression settings for a dump stream"""
+
+    def __init__(self, algorithm: str, level: int = None, rsyncable: bool = False):
+        if algorithm not in COMPRESSORS:
+            raise ValueError("Unknown compression algorithm: {}".format(algorithm))
+
+        _, _, (min_level, max_level), default_level = COMPRESSORS[algorithm]
+        level = default_level if level is None else level
+        if not min_level <= level <= max_level:
+            raise ValueError("Compression level for {} must be between {} and {}".format(
+                algorithm, min_level, max_level))
+
+        self.algorithm = algorithm
+        self.level = level
+        self.rsyncable = rsyncable
+
+    @classmethod
+    def parse(cls, value: str) -> 'Compression':
+        """Compression: Parse a label value. Returns None if compression is disabled"""
+        if value is None or value.strip() in DISABLED_VALUES:
+            return None
+
+        algorithm, *options = [part.strip() for part in value.strip().split(':')]
+        level, rsyncable = None, False
+        for option in options:
+            if option.isdigit():
+                level = int(option)
+            elif option == 'rsyncable':
+                rsyncable = True
+            else:
+                raise ValueError("Unknown compression option: {}".format(option))
+
+        return cls(algorithm, level=level, rsyncable=rsyncable)
+
+    @property
+    def command(self) -> List[str]:
+        """list: The command compressing stdin to stdout"""
+        command = COMPRESSORS[self.algorithm][0] + [f'-{self.level}']
+        if self.rsyncable:
+            command.append('--rsyncable')
+        return command
+
+    @property
+    def extension(self) -> str:
+        """str: File extension appended to the dump filename"""
+        return COMPRESSORS[self.algorithm][1]
+
+    def __str__(self):
+        return "{}:{}{}".format(self.algorithm, self.level, ':rsyncable' if self.rsyncable else '')
@@ -1,8 +1,12 @@
 import os
+import json
+
+from restic_compose_backup import cron, enums
 
 
 class Config:
     default_backup_command = "source /env.sh && rcb backup > /proc/1/fd/1"
+    default_maintenance_command = "source /env.sh && rcb {task} > /proc/1/fd/1"
     default_crontab_schedule = "0 2 * * *"
 
     """Bag for config values"""
@@ -23,15 +27,144 @@ class Config:
         self.keep_monthly = os.environ.get('KEEP_MONTHLY') or "12"
         self.keep_yearly = os.environ.get('KEEP_YEARLY') or "3"
 
+        # Separate cron schedules for maintenance. Unscheduled tasks run after each backup
+        self.forget_schedule = os.environ.get('FORGET_SCHEDULE')
+        self.prune_schedule = os.environ.get('PRUNE_SCHEDULE')
+        self.check_schedule = os.environ.get('CHECK_SCHEDULE')
+        self.maintenance_command = os.environ.get('MAINTENANCE_COMMAND') or self.default_maintenance_command
+
+        # Number of slices of pack data read in rotation by check. 0 only checks the structure
+        self.check_data_subsets = os.environ.get('CHECK_DATA_SUBSETS') or "0"
+        # Days all slices must be read within. 0 reads one slice per check
+        self.check_data_period = os.environ.get('CHECK_DATA_PERIOD') or "0"
+        # Use the local restic cache when checking the repository
+        self.check_with_cache = os.environ.get('CHECK_WITH_CACHE') or False
+
+        # Seconds before a database ping gives up and attempts made before a dump starts
+        self.ping_timeout = os.environ.get('PING_TIMEOUT') or "5"
+        self.ping_retries = os.environ.get('PING_RETRIES') or "3"
+
+        # Run backups in a long-lived worker container listening on this port on localhost
+        self.backup_worker = os.environ.get('BACKUP_WORKER') or False
+        self.backup_worker_port = os.environ.get('BACKUP_WORKER_PORT') or "8765"
+
+        # Comma separated services to back up. All services are backed up by default
+        self.backup_services = os.environ.get('BACKUP_SERVICES')
+        # Set by the backup command: json data of containers that were being stopped
+        self.backup_stopping_containers = os.environ.get('BACKUP_STOPPING_CONTAINERS')
+
+        # Keep the containers up to date from docker events in the daemon
+        # optionally backing up the volumes of a service when it's stopped
+        self.docker_events = os.environ.get('DOCKER_EVENTS') or False
+        self.backup_on_stop = os.environ.get('BACKUP_ON_STOP') or False
+
+        # Number of database backups running at the same time
+        self.db_backup_concurrency = os.environ.get('DB_BACKUP_CONCURRENCY') or "1"
+
+        # Relay database dumps through the backup process collecting throughput metrics
+        self.stream_relay = os.environ.get('STREAM_RELAY') or False
+        self.stream_pipe_size = os.environ.get('STREAM_PIPE_SIZE')
+
+        # Volume snapshot granularity and number of volume backups running at the same time
+        self.volume_backup_mode = os.environ.get('VOLUME_BACKUP_MODE') or enums.VOLUME_BACKUP_MODE_SINGLE
+        self.volume_backup_concurrency = os.environ.get('VOLUME_BACKUP_CONCURRENCY') or "1"
+
+        # Seconds between progress messages during volume backups
+        self.progress_interval = os.environ.get('PROGRESS_INTERVAL') or "60"
+
+        # Skip volume mounts that are unchanged since the last backup
+        self.volume_change_index = os.environ.get('VOLUME_CHANGE_INDEX') or False
+
+        # Seconds container discovery results are reused by read only commands
+        self.discovery_cache_ttl = os.environ.get('DISCOVERY_CACHE_TTL') or "0"
+
+        # Directory for persistent state and metrics
+        self.cache_dir = os.environ.get('XDG_CACHE_HOME') or '/cache'
+
+        # Directory the backup report and prometheus textfile are written to
+        self.metrics_dir = os.environ.get('METRICS_DIR') or os.path.join(self.cache_dir, 'metrics')
+
         if check:
             self.check()
 
+    @property
+    def services(self):
+        """list: The services from ``BACKUP_SERVICES`` or None for all services"""
+        if not self.backup_services:
+            return None
+        return [name.strip() for name in self.backup_services.split(',') if name.strip()]
+
+    @property
+    def stopping_containers(self):
+        """list: Raw data of the containers being stopped when the backup was requested"""
+        if not self.backup_stopping_containers:
+            return None
+        return json.loads(self.backup_stopping_containers)
+
     def check(self):
         if not self.repository:
             raise ValueError("RESTIC_REPOSITORY env var not set")
 
+        # An invalid schedule would silently move the task back into every backup run
+        for name, schedule in [('FORGET_SCHEDULE', self.forget_schedule),
+                               ('PRUNE_SCHEDULE', self.prune_schedule),
+                               ('CHECK_SCHEDULE', self.check_schedule)]:
+            if schedule and schedule.strip() and not cron.clean_schedule(schedule):
+                raise ValueError(f"{name} is not a valid cron schedule: '{schedule}'")
+
         if not self.password:
             raise ValueError("RESTIC_REPOSITORY env var not set")
 
+        if not self.db_backup_concurrency.isdigit() or int(self.db_backup_concurrency) < 1:
+            raise ValueError("DB_BACKUP_CONCURRENCY must be a positive integer")
+
+        if not self.ping_timeout.isdigit() or int(self.ping_timeout) < 1:
+            raise ValueError("PING_TIMEOUT must be a positive number of seconds")
+
+        if not self.ping_retries.isdigit() or int(self.ping_retries) < 1:
+            raise ValueError("PING_RETRIES must be a positive integer")
+
+        if not self.backup_worker_port.isdigit():
+            raise ValueError("BACKUP_WORKER_PORT must be a port number")
+
+        if self.volume_backup_mode not in enums.VOLUME_BACKUP_MODES:
+            raise ValueError("VOLUME_BACKUP_MODE must be one of {}".format(', '.join(enums.VOLUME_BACKUP_MODES)))
+
+        if not self.volume_backup_concurrency.isdigit() or int(self.volume_backup_concurrency) < 1:
+            raise ValueError("VOLUME_BACKUP_CONCURRENCY must be a positive integer")
+
+        if not self.progress_interval.isdigit():
+            raise ValueError("PROGRESS_INTERVAL must be a number of seconds")
+
+        if not self.discovery_cache_ttl.isdigit():
+            raise ValueError("DISCOVERY_CACHE_TTL must be a number of seconds")
+
+        if not self.check_data_subsets.isdigit():
+            raise ValueError("CHECK_DATA_SUBSETS must be a number of slices")
+
+        if not self.check_data_period.isdigit():
+            raise ValueError("CHECK_DATA_PERIOD must be a number of days")
+
+        if '{task}' not in self.maintenance_command:
+            raise ValueError("MAINTENANCE_COMMAND must contain {task}")
+
+        if self.stream_pipe_size and not self.stream_pipe_size.isdigit():
+            raise ValueError("STREAM_PIPE_SIZE must be a number of bytes")
+
+
+_config = None
+
+
+def get_config() -> Config:
+    """Config: The config shared by the process. Created on first use"""
+    global _config
+    if _config is None:
+        _config = Config()
+    return _config
+
 
-config = Config()
+def __getattr__(name):
+    # The shared config used to be created when this module was imported
+    if name == 'config':
+        return get_config()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
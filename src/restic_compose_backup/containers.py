@@ -1,10 +1,13 @@
 import os
+import time
 import logging
 from pathlib import Path
 from typing import List
 
 from restic_compose_backup import enums, utils
-from restic_compose_backup.config import config
+from restic_compose_backup.compression import Compression
+from restic_compose_backup.filters import MountFilter
+from restic_compose_backup.config import get_config
 
 logger = logging.getLogger(__name__)
 
@@ -13,14 +16,25 @@ VOLUME_TYPE_VOLUME = "volume"
 
 
 class Container:
-    """Represents a docker container"""
+    """
+    Represents a docker container.
+    Labels, env vars and mounts are parsed once when the container is created.
+    """
     container_type = None
+    #: Values supported by the dump mode label
+    dump_modes = [enums.DUMP_MODE_DEFAULT]
+    __slots__ = (
+        '_data', '_state', '_config', '_labels', '_env', '_mounts', '_mount_filter', '_filtered_mounts', '_instance',
+        '_volume_backup_enabled', '_mysql_backup_enabled', '_mariadb_backup_enabled', '_postgresql_backup_enabled',
+        '_dump_compression', '_dump_concurrency', '_dump_jobs', '_dump_label_errors',
+    )
 
     def __init__(self, data: dict):
         self._data = data
         self._state = data.get('State')
         self._config = data.get('Config')
-        self._mounts = [Mount(mnt, container=self) for mnt in data.get('Mounts')]
+        self._mounts = [Mount(mnt, container=self) for mnt in data.get('Mounts') or []]
+        self._instance = None
 
         if not self._state:
             raise ValueError('Container meta missing State')
@@ -31,29 +45,73 @@ class Container:
         if self._labels is None:
             raise ValueError('Container meta missing Config->Labels')
 
-        self._include = self._parse_pattern(self.get_label(enums.LABEL_VOLUMES_INCLUDE))
-        self._exclude = self._parse_pattern(self.get_label(enums.LABEL_VOLUMES_EXCLUDE))
+        self._env = {key: value for key, _, value in (entry.partition('=') for entry in self._config.get('Env') or [])}
+
+        self._mount_filter = MountFilter(
+            include=self._parse_pattern(self.get_label(enums.LABEL_VOLUMES_INCLUDE)),
+            exclude=self._parse_pattern(self.get_label(enums.LABEL_VOLUMES_EXCLUDE)),
+        )
+        self._filtered_mounts = None
+
+        self._volume_backup_enabled = utils.is_true(self.get_label(enums.LABEL_VOLUMES_ENABLED))
+        self._mysql_backup_enabled = utils.is_true(self.get_label(enums.LABEL_MYSQL_ENABLED))
+        self._mariadb_backup_enabled = utils.is_true(self.get_label(enums.LABEL_MARIADB_ENABLED))
+        self._postgresql_backup_enabled = utils.is_true(self.get_label(enums.LABEL_POSTGRES_ENABLED))
+        self._parse_dump_labels()
+
+    def _parse_dump_labels(self):
+        """Parse the database dump labels. Invalid values are collected in ``dump_label_errors``"""
+        self._dump_label_errors = []
+
+        def parse(name, func, default):
+            try:
+                return func()
+            except ValueError as ex:
+                self._dump_label_errors.append("{}={}: {}".format(name, self.get_label(name), ex))
+                return default
+
+        self._dump_compression = parse(
+            enums.LABEL_DUMP_COMPRESSION, lambda: Compression.parse(self.get_label(enums.LABEL_DUMP_COMPRESSION)), None)
+        self._dump_concurrency = parse(
+            enums.LABEL_DUMP_CONCURRENCY, lambda: self.get_positive_int_label(enums.LABEL_DUMP_CONCURRENCY, 1), 1)
+        self._dump_jobs = parse(
+            enums.LABEL_DUMP_JOBS, lambda: self.get_positive_int_label(enums.LABEL_DUMP_JOBS, 2), 2)
 
     @property
     def instance(self) -> 'Container':
         """Container: Get a service specific subclass instance"""
         # TODO: Do this smarter in the future (simple registry)
-        if self.database_backup_enabled:
+        if not self.database_backup_enabled:
+            return self
+
+        if self._instance is None:
             from restic_compose_backup import containers_db
             if self.mariadb_backup_enabled:
-                return containers_db.MariadbContainer(self._data)
-            if self.mysql_backup_enabled:
-                return containers_db.MysqlContainer(self._data)
-            if self.postgresql_backup_enabled:
-                return containers_db.PostgresContainer(self._data)
-        else:
-            return self
+                self._instance = self._specialize(containers_db.MariadbContainer)
+            elif self.mysql_backup_enabled:
+                self._instance = self._specialize(containers_db.MysqlContainer)
+            elif self.postgresql_backup_enabled:
+                self._instance = self._specialize(containers_db.PostgresContainer)
+
+        return self._instance
+
+    def _specialize(self, cls) -> 'Container':
+        """Container: Create a subclass instance sharing the already parsed state"""
+        instance = cls.__new__(cls)
+        for name in Container.__slots__:
+            setattr(instance, name, getattr(self, name))
+        instance._instance = instance
+        return instance
 
     @property
     def id(self) -> str:
         """str: The id of the container"""
         return self._data.get('Id')
 
+    def to_dict(self) -> dict:
+        """dict: The raw data needed to create this container again in another process"""
+        return {key: self._data.get(key) for key in ('Id', 'Name', 'State', 'Config', 'Mounts')}
+
     @property
     def hostname(self) -> str:
         """12 character hostname based on id"""
@@ -79,6 +137,11 @@ class Container:
         """str: The unique backup process label for this project"""
         return f"{enums.LABEL_BACKUP_PROCESS}-{self.project_name}"
 
+    @property
+    def backup_worker_label(self) -> str:
+        """str: The unique backup worker label for this project"""
+        return f"{enums.LABEL_BACKUP_WORKER}-{self.project_name}"
+
     @property
     def project_name(self) -> str:
         """str: Name of the compose setup"""
@@ -104,21 +167,21 @@ class Container:
 
     def get_config_env(self, name) -> str:
         """Get a config environment variable by name"""
-        # convert to dict and fetch env var by name
-        data = {i[0:i.find('=')]: i[i.find('=') + 1:] for i in self.environment}
-        return data.get(name)
+        return self._env.get(name)
 
     def set_config_env(self, name, value):
         """Set an environment variable"""
         env = self.environment
         new_value = f'{name}={value}'
         for i, entry in enumerate(env):
-            if f'{name}=' in entry:
+            if entry.startswith(f'{name}='):
                 env[i] = new_value
                 break
         else:
             env.append(new_value)
 
+        self._env[name] = str(value)
+
     @property
     def volumes(self) -> dict:
         """
@@ -137,45 +200,72 @@ class Container:
     @property
     def backup_enabled(self) -> bool:
         """Is backup enabled for this container?"""
-        return any([
-            self.volume_backup_enabled,
-            self.database_backup_enabled,
-        ])
+        return self._volume_backup_enabled or self.database_backup_enabled
 
     @property
     def volume_backup_enabled(self) -> bool:
         """bool: If the ``restic-compose-backup.volumes`` label is set"""
-        return utils.is_true(self.get_label(enums.LABEL_VOLUMES_ENABLED))
+        return self._volume_backup_enabled
 
     @property
     def database_backup_enabled(self) -> bool:
         """bool: Is database backup enabled in any shape or form?"""
-        return any([
-            self.mysql_backup_enabled,
-            self.mariadb_backup_enabled,
-            self.postgresql_backup_enabled,
-        ])
+        return self._mysql_backup_enabled or self._mariadb_backup_enabled or self._postgresql_backup_enabled
 
     @property
     def mysql_backup_enabled(self) -> bool:
         """bool: If the ``restic-compose-backup.mysql`` label is set"""
-        return utils.is_true(self.get_label(enums.LABEL_MYSQL_ENABLED))
+        return self._mysql_backup_enabled
 
     @property
     def mariadb_backup_enabled(self) -> bool:
         """bool: If the ``restic-compose-backup.mariadb`` label is set"""
-        return utils.is_true(self.get_label(enums.LABEL_MARIADB_ENABLED))
+        return self._mariadb_backup_enabled
 
     @property
     def postgresql_backup_enabled(self) -> bool:
         """bool: If the ``restic-compose-backup.postgres`` label is set"""
-        return utils.is_true(self.get_label(enums.LABEL_POSTGRES_ENABLED))
+        return self._postgresql_backup_enabled
+
+    @property
+    def dump_compression(self) -> Compression:
+        """Compression: The compression applied to database dumps or None"""
+        return self._dump_compression
+
+    @property
+    def dump_mode(self) -> str:
+        """str: How databases in the service are dumped"""
+        return (self.get_label(enums.LABEL_DUMP_MODE) or enums.DUMP_MODE_DEFAULT).strip()
+
+    @property
+    def dump_concurrency(self) -> int:
+        """int: Number of database dumps running at the same time within the service"""
+        return self._dump_concurrency
+
+    @property
+    def dump_jobs(self) -> int:
+        """int: Number of parallel jobs used by a single directory format dump"""
+        return self._dump_jobs
+
+    @property
+    def dump_label_errors(self) -> List[str]:
+        """list: Problems with the dump labels including an unsupported dump mode"""
+        errors = list(self._dump_label_errors)
+        if self.dump_mode not in self.dump_modes:
+            errors.append("Unknown dump mode '{}'. Supported modes: {}".format(
+                self.dump_mode, ', '.join(self.dump_modes)))
+        return errors
 
     @property
     def is_backup_process_container(self) -> bool:
         """Is this container the running backup process?"""
         return self.get_label(self.backup_process_label) == 'True'
 
+    @property
+    def is_backup_worker_container(self) -> bool:
+        """Is this container the long-lived backup worker?"""
+        return self.get_label(self.backup_worker_label) == 'True'
+
     @property
     def is_running(self) -> bool:
         """bool: Is the container running?"""
@@ -187,36 +277,29 @@ class Container:
 
     def get_label(self, name, default=None):
         """Get a label by name"""
-        return self._labels.get(name, None)
+        return self._labels.get(name, default)
+
+    def get_positive_int_label(self, name, default: int) -> int:
+        """Get a label holding a positive integer"""
+        value = self.get_label(name)
+        if value is None:
+            return default
+
+        value = str(value).strip()
+        if not value.isdigit() or int(value) < 1:
+            raise ValueError("{} must be a positive integer".format(name))
+
+        return int(value)
 
     def filter_mounts(self):
         """Get all mounts for this container matching include/exclude filters"""
-        filtered = []
-
         if not self.volume_backup_enabled:
-            return filtered
-
-        if self._include:
-            for mount in self._mounts:
-                for pattern in self._include:
-                    if pattern in mount.source:
-                        break
-                else:
-                    continue
+            return []
 
-                filtered.append(mount)
-
-        elif self._exclude:
-            for mount in self._mounts:
-                for pattern in self._exclude:
-                    if pattern in mount.source:
-                        break
-                else:
-                    filtered.append(mount)
-        else:
-            return self._mounts
+        if self._filtered_mounts is None:
+            self._filtered_mounts = [mount for mount in self._mounts if self._mount_filter.match(mount)]
 
-        return filtered
+        return self._filtered_mounts
 
     def volumes_for_backup(self, source_prefix='/volumes', mode='ro'):
         """Get volumes configured for backup"""
@@ -230,15 +313,28 @@ class Container:
 
         return volumes
 
+    def backup_excludes(self, source_prefix='/volumes') -> List[str]:
+        """list: restic exclude patterns for paths inside the mounts configured for backup"""
+        excludes = []
+        for mount in self.filter_mounts():
+            path = Path(source_prefix) / self.service_name / Path(utils.strip_root(mount.destination))
+            excludes.extend(str(path / pattern) for pattern in self._mount_filter.excludes_inside(mount))
+
+        return excludes
+
     def get_credentials(self) -> dict:
         """dict: get credentials for the service"""
         raise NotImplementedError("Base container class don't implement this")
 
-    def ping(self) -> bool:
-        """Check the availability of the service"""
+    def credentials_env(self, creds: dict) -> dict:
+        """dict: environment variables passing credentials to the client tools"""
         raise NotImplementedError("Base container class don't implement this")
 
-    def backup(self):
+    def ping(self, timeout: float = None) -> int:
+        """Check the availability of the service giving up after ``timeout`` seconds"""
+        raise NotImplementedError("Base container class don't implement this")
+
+    def backup(self, metrics=None):
         """Back up this service"""
         raise NotImplementedError("Base container class don't implement this")
 
@@ -258,7 +354,7 @@ class Container:
         if len(value) == 0:
             return None
 
-        return value.split(',')
+        return [pattern.strip() for pattern in value.split(',') if pattern.strip()]
 
     def __eq__(self, other):
         """Compare container by id"""
@@ -279,35 +375,25 @@ class Container:
 
 class Mount:
     """Represents a volume mount (volume or bind)"""
+    __slots__ = ('_data', '_container', 'type', 'name', 'source', 'destination')
+
     def __init__(self, data, container=None):
         self._data = data
         self._container = container
+        #: bind/volume
+        self.type = data.get('Type')
+        #: Name of the mount
+        self.name = data.get('Name')
+        #: Source of the mount. Volume name or path
+        self.source = data.get('Source')
+        #: Destination path for the volume mount in the container
+        self.destination = data.get('Destination')
 
     @property
     def container(self) -> Container:
         """The container this mount belongs to"""
         return self._container
 
-    @property
-    def type(self) -> str:
-        """bind/volume"""
-        return self._data.get('Type')
-
-    @property
-    def name(self) -> str:
-        """Name of the mount"""
-        return self._data.get('Name')
-
-    @property
-    def source(self) -> str:
-        """Source of the mount. Volume name or path"""
-        return self._data.get('Source')
-
-    @property
-    def destination(self) -> str:
-        """Destination path for the volume mount in the container"""
-        return self._data.get('Destination')
-
     def __repr__(self) -> str:
         return str(self)
 
@@ -326,25 +412,58 @@ class Mount:
 
 class RunningContainers:
 
-    def __init__(self):
-        all_containers = utils.list_containers()
+    def __init__(self, cache_ttl: int = 0, containers_data: List[dict] = None, services: List[str] = None,
+                 stopping: List[dict] = None):
+        """
+        Args:
+            cache_ttl (int): Seconds cached discovery results can be used
+            containers_data (list): Raw container data to use instead of discovery
+            services (list): Only back up these services
+            stopping (list): Raw data of containers that were being stopped when the backup
+                was requested. They are backed up even if they exited or were removed since.
+        """
+        self.services = services
+        self.stopping = stopping or []
         self.containers = []
         self.this_container = None
         self.backup_process_container = None
+        self.backup_worker_container = None
         self.stale_backup_process_containers = []
+        self.stale_backup_worker_containers = []
+
+        hostname = os.environ['HOSTNAME']
+        config = get_config()
+        cache_path = os.path.join(config.cache_dir, 'discovery.json')
+        cache_key = f'{hostname}-{config.swarm_mode}'
+        all_containers = containers_data
+        if all_containers is None and cache_ttl:
+            all_containers = load_discovery_cache(cache_path, cache_key, cache_ttl)
+        if all_containers is None:
+            all_containers = discover_containers(hostname)
+            if cache_ttl:
+                save_discovery_cache(cache_path, cache_key, all_containers)
+
+        # The data captured before the container stopped replaces whatever is left of it
+        stopping_ids = {data.get('Id') for data in self.stopping}
+        if stopping_ids:
+            all_containers = [data for data in all_containers if data.get('Id') not in stopping_ids] + self.stopping
 
         # Find the container we are running in.
         # If we don't have this information we cannot continue
         for container_data in all_containers:
-            if container_data.get('Id').startswith(os.environ['HOSTNAME']):
+            if container_data.get('Id').startswith(hostname):
                 self.this_container = Container(container_data)
+                break
 
         if not self.this_container:
             raise ValueError("Cannot find metadata for backup container")
 
         # Gather all running containers in the current compose setup
         for container_data in all_containers:
-            container = Container(container_data)
+            if container_data.get('Id') == self.this_container.id:
+                container = self.this_container
+            else:
+                container = Container(container_data)
 
             # Gather stale backup process containers
             if (self.this_container.image == container.image
@@ -352,14 +471,23 @@ class RunningContainers:
                     and container.is_backup_process_container):
                 self.stale_backup_process_containers.append(container)
 
+            # Gather backup workers that exited. They are never reused
+            if not container.is_running and container.is_backup_worker_container:
+                self.stale_backup_worker_containers.append(container)
+
             # We only care about running containers after this point
-            if not container.is_running:
+            if not container.is_running and container.id not in stopping_ids:
                 continue
 
             # Detect running backup process container
             if container.is_backup_process_container:
                 self.backup_process_container = container
 
+            # The backup worker is never backed up
+            if container.is_backup_worker_container:
+                self.backup_worker_container = container
+                continue
+
             # --- Determine what containers should be evaludated
 
             # If not swarm mode we need to filter in compose project
@@ -387,24 +515,41 @@ class RunningContainers:
         """str: The backup process label for this project"""
         return self.this_container.backup_process_label
 
+    @property
+    def backup_worker_label(self) -> str:
+        """str: The backup worker label for this project"""
+        return self.this_container.backup_worker_label
+
     @property
     def backup_process_running(self) -> bool:
         """Is the backup process container running?"""
         return self.backup_process_container is not None
 
-    def containers_for_backup(self):
-        """Obtain all containers with backup enabled"""
-        return [container for container in self.containers if container.backup_enabled]
+    def containers_for_backup(self, all_services: bool = False):
+        """Obtain all containers with backup enabled. Limited to ``services`` unless ``all_services`` is set"""
+        services = None if all_services else self.services
+        return [
+            container for container in self.containers
+            if container.backup_enabled and (not services or container.service_name in services)
+        ]
 
-    def generate_backup_mounts(self, dest_prefix='/volumes') -> dict:
+    def generate_backup_mounts(self, dest_prefix='/volumes', all_services: bool = False) -> dict:
         """Generate mounts for backup for the entire compose setup"""
         mounts = {}
-        for container in self.containers_for_backup():
+        for container in self.containers_for_backup(all_services=all_services):
             if container.volume_backup_enabled:
                 mounts.update(container.volumes_for_backup(source_prefix=dest_prefix, mode='ro'))
 
         return mounts
 
+    def generate_backup_excludes(self, dest_prefix='/volumes') -> List[str]:
+        """Generate restic exclude patterns for the entire compose setup"""
+        excludes = []
+        for container in self.containers_for_backup():
+            excludes.extend(container.backup_excludes(source_prefix=dest_prefix))
+
+        return excludes
+
     def get_service(self, name) -> Container:
         """Container: Get a service by name"""
         for container in self.containers:
@@ -412,3 +557,49 @@ class RunningContainers:
                 return container
 
         return None
+
+
+def discover_containers(hostname: str) -> List[dict]:
+    """
+    Fetch the raw data of the containers relevant for this backup container
+    pushing as much filtering as possible to the docker api.
+    The first entry is always our own container if it was found.
+    """
+    this_containers = [
+        data for data in utils.list_containers(filters={'id': hostname})
+        if data.get('Id').startswith(hostname)
+    ]
+    if not this_containers:
+        return []
+
+    this_container = Container(this_containers[0])
+    if get_config().swarm_mode:
+        # Running containers in all stacks and every backup process container
+        candidates = utils.list_containers(filters={'status': 'running'})
+        candidates += utils.list_containers(filters={'label': this_container.backup_process_label})
+    else:
+        # Everything in our compose project including stale backup process containers
+        candidates = utils.list_containers(
+            filters={'label': f'com.docker.compose.project={this_container.project_name}'},
+        )
+
+    unique = {this_container.id: this_containers[0]}
+    for data in candidates:
+        unique.setdefault(data.get('Id'), data)
+
+    return list(unique.values())
+
+
+def load_discovery_cache(path: str, key: str, ttl: int) -> List[dict]:
+    """list: Cached container data if younger than ttl seconds or None"""
+    data = utils.read_json(path)
+    if data.get('key') != key or time.time() - data.get('time', 0) > ttl:
+        return None
+
+    logger.debug('Using cached container discovery from %s', path)
+    return data.get('containers')
+
+
+def save_discovery_cache(path: str, key: str, containers: List[dict]):
+    """Write the container data to the discovery cache"""
+    utils.write_json(path, {'key': key, 'time': time.time(), 'containers': containers})
@@ -1,14 +1,105 @@
+import os
+import shutil
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
+
 from restic_compose_backup.containers import Container
 from restic_compose_backup.config import Config
+
 from restic_compose_backup import (
     commands,
+    enums,
     restic,
+    utils,
 )
-from restic_compose_backup import utils
+
+logger = logging.getLogger(__name__)
+
+# Schemas never included in per-database dumps
+MYSQL_SYSTEM_DATABASES = ['information_schema', 'performance_schema', 'mysql', 'sys']
+
+
+def backup_dump(container: Container, config: Config, filename: str, command: list, creds: dict,
+                metrics=None) -> int:
+    """
+    Stream a dump command into restic applying the compression
+    configured for the container and the stream relay settings.
+    """
+    compression = container.dump_compression
+    if compression:
+        filename += compression.extension
+
+    stats = {}
+    result = restic.backup_from_stdin(
+        config.repository,
+        filename,
+        command,
+        env=container.credentials_env(creds),
+        transform_command=compression.command if compression else None,
+        relay=utils.is_true(config.stream_relay),
+        pipe_size=int(config.stream_pipe_size) if config.stream_pipe_size else None,
+        metrics_file=os.path.join(config.cache_dir, 'stream_metrics.jsonl'),
+        stats=stats,
+    )
+    if metrics:
+        metrics.add_summary(container.service_name, stats.get('summary'))
+    return result
+
+
+def backup_dumps(container: Container, config: Config, dumps: List[Tuple[str, list]], creds: dict,
+                 metrics=None) -> int:
+    """
+    Stream multiple dumps into restic running ``dump_concurrency`` of them at the same time.
+    ``dumps`` is a list of (filename, command) tuples. Returns 0 if all dumps succeeded.
+    """
+    if not dumps:
+        logger.warning('No databases found for dumping in service %s', container.service_name)
+        return 0
+
+    def run(dump):
+        filename, command = dump
+        logger.info('Backing up %s in service %s', filename, container.service_name)
+        try:
+            return backup_dump(container, config, filename, command, creds, metrics=metrics)
+        except Exception as ex:
+            logger.exception(ex)
+            return 1
+
+    with ThreadPoolExecutor(max_workers=container.dump_concurrency) as executor:
+        results = list(executor.map(run, dumps))
+
+    for (filename, _), result in zip(dumps, results):
+        if result != 0:
+            logger.error('Dump of %s exited with non-zero code: %s', filename, result)
+
+    return 0 if all(result == 0 for result in results) else 1
+
+
+def check_dump_labels(container: Container) -> bool:
+    """bool: Are the dump labels of the container valid. Logs an error for each problem"""
+    errors = container.dump_label_errors
+    for error in errors:
+        logger.error("Not dumping %s in service %s: %s", container.container_type, container.service_name, error)
+    return not errors
+
+
+def list_mysql_databases(container: Container) -> List[str]:
+    """list: Names of all databases in a mysql/mariadb service excluding system schemas"""
+    creds = container.get_credentials()
+    databases = commands.list_mysql_databases(
+        creds['host'],
+        creds['port'],
+        creds['username'],
+        env=container.credentials_env(creds),
+    )
+    return [name for name in databases if name not in MYSQL_SYSTEM_DATABASES]
 
 
 class MariadbContainer(Container):
     container_type = 'mariadb'
+    dump_modes = [enums.DUMP_MODE_DEFAULT, enums.DUMP_MODE_PER_DATABASE]
+    __slots__ = ()
 
     def get_credentials(self) -> dict:
         """dict: get credentials for the service"""
@@ -19,18 +110,26 @@ class MariadbContainer(Container):
             'port': "3306",
         }
 
-    def ping(self) -> bool:
-        """Check the availability of the service"""
+    def credentials_env(self, creds: dict) -> dict:
+        """dict: environment variables passing the password to the client tools"""
+        return {'MYSQL_PWD': creds['password'] or ''}
+
+    def ping(self, timeout: float = None) -> int:
+        """Check the availability of the service giving up after ``timeout`` seconds"""
         creds = self.get_credentials()
+        return commands.ping_mariadb(
+            creds['host'],
+            creds['port'],
+            creds['username'],
+            env=self.credentials_env(creds),
+            timeout=timeout,
+        )
 
-        with utils.environment('MYSQL_PWD', creds['password']):
-            return commands.ping_mariadb(
-                creds['host'],
-                creds['port'],
-                creds['username'],
-            )
+    def list_databases(self) -> List[str]:
+        """list: Names of all databases excluding system schemas"""
+        return list_mysql_databases(self)
 
-    def dump_command(self) -> list:
+    def dump_command(self, database: str = None) -> list:
         """list: create a dump command restic and use to send data through stdin"""
         creds = self.get_credentials()
         return [
@@ -38,23 +137,35 @@ class MariadbContainer(Container):
             f"--host={creds['host']}",
             f"--port={creds['port']}",
             f"--user={creds['username']}",
-            "--all-databases",
-        ]
+        ] + (["--databases", database] if database else ["--all-databases"])
 
-    def backup(self):
+    def backup(self, metrics=None):
         config = Config()
         creds = self.get_credentials()
 
-        with utils.environment('MYSQL_PWD', creds['password']):
-            return restic.backup_from_stdin(
-                config.repository,
-                f'/databases/{self.service_name}/all_databases.sql',
-                self.dump_command(),
-            )
+        if not check_dump_labels(self):
+            return 1
+
+        if self.dump_mode == enums.DUMP_MODE_PER_DATABASE:
+            return backup_dumps(self, config, [
+                (f'/databases/{self.service_name}/{database}.sql', self.dump_command(database=database))
+                for database in self.list_databases()
+            ], creds, metrics=metrics)
+
+        return backup_dump(
+            self,
+            config,
+            f'/databases/{self.service_name}/all_databases.sql',
+            self.dump_command(),
+            creds,
+            metrics=metrics,
+        )
 
 
 class MysqlContainer(Container):
     container_type = 'mysql'
+    dump_modes = [enums.DUMP_MODE_DEFAULT, enums.DUMP_MODE_PER_DATABASE]
+    __slots__ = ()
 
     def get_credentials(self) -> dict:
         """dict: get credentials for the service"""
@@ -65,18 +176,26 @@ class MysqlContainer(Container):
             'port': "3306",
         }
 
-    def ping(self) -> bool:
-        """Check the availability of the service"""
+    def credentials_env(self, creds: dict) -> dict:
+        """dict: environment variables passing the password to the client tools"""
+        return {'MYSQL_PWD': creds['password'] or ''}
+
+    def ping(self, timeout: float = None) -> int:
+        """Check the availability of the service giving up after ``timeout`` seconds"""
         creds = self.get_credentials()
+        return commands.ping_mysql(
+            creds['host'],
+            creds['port'],
+            creds['username'],
+            env=self.credentials_env(creds),
+            timeout=timeout,
+        )
 
-        with utils.environment('MYSQL_PWD', creds['password']):
-            return commands.ping_mysql(
-                creds['host'],
-                creds['port'],
-                creds['username'],
-            )
+    def list_databases(self) -> List[str]:
+        """list: Names of all databases excluding system schemas"""
+        return list_mysql_databases(self)
 
-    def dump_command(self) -> list:
+    def dump_command(self, database: str = None) -> list:
         """list: create a dump command restic and use to send data through stdin"""
         creds = self.get_credentials()
         return [
@@ -84,23 +203,35 @@ class MysqlContainer(Container):
             f"--host={creds['host']}",
             f"--port={creds['port']}",
             f"--user={creds['username']}",
-            "--all-databases",
-        ]
+        ] + (["--databases", database] if database else ["--all-databases"])
 
-    def backup(self):
+    def backup(self, metrics=None):
         config = Config()
         creds = self.get_credentials()
 
-        with utils.environment('MYSQL_PWD', creds['password']):
-            return restic.backup_from_stdin(
-                config.repository,
-                f'/databases/{self.service_name}/all_databases.sql',
-                self.dump_command(),
-            )
+        if not check_dump_labels(self):
+            return 1
+
+        if self.dump_mode == enums.DUMP_MODE_PER_DATABASE:
+            return backup_dumps(self, config, [
+                (f'/databases/{self.service_name}/{database}.sql', self.dump_command(database=database))
+                for database in self.list_databases()
+            ], creds, metrics=metrics)
+
+        return backup_dump(
+            self,
+            config,
+            f'/databases/{self.service_name}/all_databases.sql',
+            self.dump_command(),
+            creds,
+            metrics=metrics,
+        )
 
 
 class PostgresContainer(Container):
     container_type = 'postgres'
+    dump_modes = [enums.DUMP_MODE_DEFAULT, enums.DUMP_MODE_PER_DATABASE, enums.DUMP_MODE_DIRECTORY]
+    __slots__ = ()
 
     def get_credentials(self) -> dict:
         """dict: get credentials for the service"""
@@ -112,35 +243,139 @@ class PostgresContainer(Container):
             'database': self.get_config_env('POSTGRES_DB'),
         }
 
-    def ping(self) -> bool:
-        """Check the availability of the service"""
+    def credentials_env(self, creds: dict) -> dict:
+        """dict: environment variables passing the password to the client tools"""
+        return {'PGPASSWORD': creds['password'] or ''}
+
+    def ping(self, timeout: float = None) -> int:
+        """Check the availability of the service giving up after ``timeout`` seconds"""
         creds = self.get_credentials()
         return commands.ping_postgres(
             creds['host'],
             creds['port'],
             creds['username'],
-            creds['password'],
+            env=self.credentials_env(creds),
+            timeout=timeout,
         )
 
-    def dump_command(self) -> list:
+    def list_databases(self) -> List[str]:
+        """list: Names of all databases accepting connections excluding templates"""
+        creds = self.get_credentials()
+        return commands.list_postgres_databases(
+            creds['host'],
+            creds['port'],
+            creds['username'],
+            creds['database'],
+            env=self.credentials_env(creds),
+        )
+
+    def dump_command(self, database: str = None) -> list:
         """list: create a dump command restic and use to send data through stdin"""
-        # NOTE: Backs up a single database from POSTGRES_DB env var
+        # NOTE: Backs up the POSTGRES_DB database unless another database is passed in
         creds = self.get_credentials()
         return [
             "pg_dump",
             f"--host={creds['host']}",
             f"--port={creds['port']}",
             f"--username={creds['username']}",
-            creds['database'],
+            database or creds['database'],
+        ]
+
+    @property
+    def globals_filename(self) -> str:
+        """str: Path of the globals dump. Kept in its own directory so no database dump can overwrite it"""
+        return f'/databases/{self.service_name}/globals/globals.sql'
+
+    def dump_globals_command(self) -> list:
+        """list: create a command dumping roles and tablespaces"""
+        creds = self.get_credentials()
+        return [
+            "pg_dumpall",
+            f"--host={creds['host']}",
+            f"--port={creds['port']}",
+            f"--username={creds['username']}",
+            "--globals-only",
         ]
 
-    def backup(self):
+    def dump_directory_command(self, database: str, path: str) -> list:
+        """list: create a command dumping a database in directory format using parallel jobs"""
+        creds = self.get_credentials()
+        return [
+            "pg_dump",
+            f"--host={creds['host']}",
+            f"--port={creds['port']}",
+            f"--username={creds['username']}",
+            "--format=directory",
+            f"--jobs={self.dump_jobs}",
+            f"--file={path}",
+            database,
+        ]
+
+    def backup(self, metrics=None):
         config = Config()
         creds = self.get_credentials()
 
-        with utils.environment('PGPASSWORD', creds['password']):
-            return restic.backup_from_stdin(
-                config.repository,
-                f"/databases/{self.service_name}/{creds['database']}.sql",
-                self.dump_command(),
-            )
+        if not check_dump_labels(self):
+            return 1
+
+        if self.dump_mode == enums.DUMP_MODE_PER_DATABASE:
+            return backup_dumps(self, config, [
+                (self.globals_filename, self.dump_globals_command()),
+            ] + [
+                (f'/databases/{self.service_name}/{database}.sql', self.dump_command(database=database))
+                for database in self.list_databases()
+            ], creds, metrics=metrics)
+
+        if self.dump_mode == enums.DUMP_MODE_DIRECTORY:
+            return self.backup_directories(config, creds, metrics=metrics)
+
+        return backup_dump(
+            self,
+            config,
+            f"/databases/{self.service_name}/{creds['database']}.sql",
+            self.dump_command(),
+            creds,
+            metrics=metrics,
+        )
+
+    def backup_directories(self, config: Config, creds: dict, metrics=None) -> int:
+        """
+        Dump each database in directory format into a staging directory
+        and back up the directory with restic. The staging directory
+        uses the same path as the dump in restic.
+        """
+        globals_result = backup_dump(
+            self,
+            config,
+            self.globals_filename,
+            self.dump_globals_command(),
+            creds,
+            metrics=metrics,
+        )
+
+        def run(database):
+            path = f'/databases/{self.service_name}/{database}'
+            logger.info('Backing up %s in service %s', path, self.service_name)
+            # pg_dump refuses to write into an existing directory
+            shutil.rmtree(path, ignore_errors=True)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            try:
+                result = commands.run(self.dump_directory_command(database, path), env=self.credentials_env(creds))
+                if result == 0:
+                    stats = {}
+                    result = restic.backup_files(config.repository, source=path, stats=stats)
+                    if metrics:
+                        metrics.add_summary(self.service_name, stats.get('summary'))
+                if result != 0:
+                    logger.error('Dump of %s exited with non-zero code: %s', path, result)
+                return result
+            except Exception as ex:
+                logger.exception(ex)
+                return 1
+            finally:
+                shutil.rmtree(path, ignore_errors=True)
+
+        with ThreadPoolExecutor(max_workers=self.dump_concurrency) as executor:
+            results = list(executor.map(run, self.list_databases()))
+
+        return 0 if globals_result == 0 and all(result == 0 for result in results) else 1
@@ -9,56 +9,157 @@
 # │ │ │ │ │
 # * * * * * command to execute
 """
+from datetime import datetime, timedelta
+
 QUOTE_CHARS = ['"', "'"]
 
+MONTH_NAMES = ['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec']
+DAY_NAMES = ['sun', 'mon', 'tue', 'wed', 'thu', 'fri', 'sat']
+MACROS = {
+    '@yearly': '0 0 1 1 *',
+    '@annually': '0 0 1 1 *',
+    '@monthly': '0 0 1 * *',
+    '@weekly': '0 0 * * 0',
+    '@daily': '0 0 * * *',
+    '@midnight': '0 0 * * *',
+    '@hourly': '0 * * * *',
+}
+
+
+class CronSchedule:
+    """
+    A parsed cron expression supporting lists, ranges, steps,
+    month and day names and the @daily style macros.
+    """
+
+    def __init__(self, expression: str):
+        self.expression = expression
+        parts = MACROS.get(expression.strip(), expression).split()
+        if len(parts) != 5:
+            raise ValueError(f"Cron expression must have 5 fields: '{expression}'")
+
+        minute, hour, day, month, weekday = parts
+        self.minutes = parse_field(minute, 0, 59)
+        self.hours = parse_field(hour, 0, 23)
+        self.days = parse_field(day, 1, 31)
+        self.months = parse_field(month, 1, 12, names=MONTH_NAMES)
+        # 7 is also sunday
+        self.weekdays = {value % 7 for value in parse_field(weekday, 0, 7, names=DAY_NAMES)}
+        # Like cron a day matches either field when both are restricted
+        self.any_day = day.startswith('*')
+        self.any_weekday = weekday.startswith('*')
+
+    def __str__(self):
+        return self.expression
+
+    def matches_day(self, value: datetime) -> bool:
+        day_match = value.day in self.days
+        weekday_match = (value.weekday() + 1) % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day_match and weekday_match
+        return day_match or weekday_match
+
+    def next_after(self, value: datetime) -> datetime:
+        """datetime: The first matching minute after ``value``"""
+        current = value.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        # Impossible dates such as 30 feb are found by the year limit
+        limit = current + timedelta(days=366 * 5)
+        while current < limit:
+            if current.month not in self.months:
+                current = (current.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self.matches_day(current):
+                current = current.replace(hour=0, minute=0) + timedelta(days=1)
+            elif current.hour not in self.hours:
+                current = current.replace(minute=0) + timedelta(hours=1)
+            elif current.minute not in self.minutes:
+                current += timedelta(minutes=1)
+            else:
+                return current
+
+        raise ValueError(f"Cron expression never matches: '{self.expression}'")
+
+
+def parse_field(value: str, minimum: int, maximum: int, names: list = None) -> set:
+    """set: The values matched by a cron field such as ``*/15``, ``1-5`` or ``mon,wed``"""
+
+    def parse_value(text: str) -> int:
+        text = text.lower()
+        if names and text in names:
+            return names.index(text) + minimum
+        if not text.isdigit():
+            raise ValueError(f"Invalid cron value: '{text}'")
+        return int(text)
+
+    values = set()
+    for part in value.split(','):
+        step = 1
+        if '/' in part:
+            part, step_text = part.split('/', 1)
+            if not step_text.isdigit() or int(step_text) < 1:
+                raise ValueError(f"Invalid cron step: '{step_text}'")
+            step = int(step_text)
+
+        if part == '*':
+            start, end = minimum, maximum
+        elif '-' in part:
+            start, end = (parse_value(text) for text in part.split('-', 1))
+        else:
+            start = parse_value(part)
+            end = maximum if step > 1 else start
+
+        if start < minimum or end > maximum or start > end:
+            raise ValueError(f"Cron field out of range {minimum}-{maximum}: '{value}'")
+
+        values.update(range(start, end + 1, step))
+
+    return values
+
 
 def generate_crontab(config):
-    """Generate a crontab entry for running backup job"""
+    """Generate crontab entries for the backup job and scheduled maintenance tasks"""
     command = config.cron_command.strip()
-    schedule = config.cron_schedule
+    schedule = clean_schedule(config.cron_schedule) or config.default_crontab_schedule
+    lines = [f'{schedule} {command}\n']
 
-    if schedule:
-        schedule = schedule.strip()
-        schedule = strip_quotes(schedule)
-        if not validate_schedule(schedule):
-            schedule = config.default_crontab_schedule
-    else:
-        schedule = config.default_crontab_schedule
+    for task, schedule in maintenance_schedules(config).items():
+        command = config.maintenance_command.strip().replace('{task}', task)
+        lines.append(f'{schedule} {command}\n')
 
-    return f'{schedule} {command}\n'
+    return ''.join(lines)
 
 
-def validate_schedule(schedule: str):
-    """Validate crontab format"""
-    parts = schedule.split()
-    if len(parts) != 5:
-        return False
+def maintenance_schedules(config) -> dict:
+    """dict: Valid schedules of the maintenance tasks running separately from backups"""
+    schedules = {
+        'forget': clean_schedule(config.forget_schedule),
+        'prune': clean_schedule(config.prune_schedule),
+        'check': clean_schedule(config.check_schedule),
+    }
+    return {task: schedule for task, schedule in schedules.items() if schedule}
+
+
+def clean_schedule(schedule: str):
+    """Strip whitespace and quotes from a schedule returning None if it's not valid"""
+    if not schedule or not schedule.strip():
+        return None
 
-    for p in parts:
-        if p != '*' and not p.isdigit():
-            return False
+    schedule = strip_quotes(schedule.strip())
+    if not validate_schedule(schedule):
+        return None
 
-    minute, hour, day, month, weekday = parts
+    return schedule
+
+
+def validate_schedule(schedule: str):
+    """Validate crontab format"""
     try:
-        validate_field(minute, 0, 59)
-        validate_field(hour, 0, 23)
-        validate_field(day, 1, 31)
-        validate_field(month, 1, 12)
-        validate_field(weekday, 0, 6)
+        CronSchedule(schedule)
     except ValueError:
         return False
 
     return True
 
 
-def validate_field(value, min, max):
-    if value == '*':
-        return
-
-    i = int(value)
-    return min <= i <= max
-
-
 def strip_quotes(value: str):
     """Strip enclosing single or double quotes if present"""
     if value[0] in QUOTE_CHARS:
@@ -0,0 +1,92 @@
+"""
+Resident scheduler running the backup and maintenance jobs in-process.
+
+Compared to crond starting a shell and a new ``rcb`` process for every
+trigger, the daemon keeps the interpreter, imports and the docker
+client warm between runs.
+"""
+import logging
+import threading
+from datetime import datetime
+from typing import Callable, List
+
+from restic_compose_backup.cron import CronSchedule
+
+logger = logging.getLogger(__name__)
+
+
+class Job:
+    """A named callable triggered by a cron schedule"""
+
+    def __init__(self, name: str, schedule: CronSchedule, func: Callable[[], object]):
+        self.name = name
+        self.schedule = schedule
+        self.func = func
+        self.next_run = schedule.next_after(datetime.now())
+
+    def run(self):
+        run_job(self.name, self.func)
+        # Triggers missed while the job was running are merged into one
+        self.next_run = self.schedule.next_after(datetime.now())
+        logger.info("Next run of job '%s' at %s", self.name, self.next_run)
+
+
+def run_job(name: str, func: Callable[[], object]):
+    """Run a job logging failures instead of raising them"""
+    logger.info("Running job '%s'", name)
+    start = datetime.now()
+    try:
+        func()
+    except SystemExit as ex:
+        # Commands exit on failure. The daemon must keep running
+        logger.error("Job '%s' exited with code %s", name, ex.code)
+    except Exception as ex:
+        logger.error("Job '%s' failed", name)
+        logger.exception(ex)
+    finally:
+        logger.info("Job '%s' finished in %s", name, datetime.now() - start)
+
+
+class Scheduler:
+    """Runs jobs one at a time in the order they are due"""
+
+    def __init__(self, jobs: List[Job]):
+        self.jobs = jobs
+        self.stop_event = threading.Event()
+        # Held while a job runs so jobs never overlap
+        self.lock = threading.Lock()
+
+    def run_forever(self):
+        for job in self.jobs:
+            logger.info("Scheduled job '%s' (%s). Next run at %s", job.name, job.schedule, job.next_run)
+
+        while not self.stop_event.is_set():
+            job = min(self.jobs, key=lambda job: job.next_run)
+            delay = (job.next_run - datetime.now()).total_seconds()
+            # Wake up at least every minute so clock changes are noticed
+            if delay > 0:
+                self.stop_event.wait(min(delay, 60))
+                continue
+
+            with self.lock:
+                job.run()
+
+        logger.info("Scheduler stopped")
+
+    def trigger(self, name: str, func: Callable[[], object]) -> bool:
+        """Run a job right away in the background unless another job is running"""
+        if not self.lock.acquire(blocking=False):
+            logger.warning("Not running job '%s'. Another job is running", name)
+            return False
+
+        def run():
+            try:
+                run_job(name, func)
+            finally:
+                self.lock.release()
+
+        threading.Thread(target=run, name=name, daemon=True).start()
+        return True
+
+    def stop(self, *args):
+        self.stop_event.set()
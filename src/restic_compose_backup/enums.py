@@ -8,4 +8,22 @@ LABEL_MYSQL_ENABLED = 'restic-compose-backup.mysql'
 LABEL_POSTGRES_ENABLED = 'restic-compose-backup.postgres'
 LABEL_MARIADB_ENABLED = 'restic-compose-backup.mariadb'
 
+LABEL_DUMP_COMPRESSION = 'restic-compose-backup.dump.compression'
+LABEL_DUMP_MODE = 'restic-compose-backup.dump.mode'
+LABEL_DUMP_CONCURRENCY = 'restic-compose-backup.dump.concurrency'
+LABEL_DUMP_JOBS = 'restic-compose-backup.dump.jobs'
+
+# Dump modes
+DUMP_MODE_DEFAULT = 'default'
+DUMP_MODE_PER_DATABASE = 'per-database'
+DUMP_MODE_DIRECTORY = 'directory'
+
 LABEL_BACKUP_PROCESS = 'restic-compose-backup.process'
+LABEL_BACKUP_WORKER = 'restic-compose-backup.worker'
+LABEL_BACKUP_WORKER_HASH = 'restic-compose-backup.worker.hash'
+
+# Volume backup modes
+VOLUME_BACKUP_MODE_SINGLE = 'single'
+VOLUME_BACKUP_MODE_SERVICE = 'service'
+VOLUME_BACKUP_MODE_MOUNT = 'mount'
+VOLUME_BACKUP_MODES = [VOLUME_BACKUP_MODE_SINGLE, VOLUME_BACKUP_MODE_SERVICE, VOLUME_BACKUP_MODE_MOUNT]
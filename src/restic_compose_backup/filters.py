@@ -0,0 +1,85 @@
+"""
+Include/exclude filters for volume mounts.
+
+Patterns come from the ``restic-compose-backup.volumes.include`` and
+``restic-compose-backup.volumes.exclude`` labels and are compiled once
+per container. Each pattern is matched against both the source and the
+destination of a mount:
+
+* ``re:<expression>``: regular expression matching the entire path
+* patterns containing ``*``, ``?`` or ``[``: glob matching the entire path
+* anything else: substring match
+
+Absolute exclude patterns pointing inside a mount destination such as
+``/srv/media/cache`` cannot exclude the mount itself. They are instead
+turned into restic ``--exclude`` patterns for files inside the mount.
+"""
+import re
+import fnmatch
+from typing import List
+
+REGEX_PREFIX = 're:'
+GLOB_CHARS = ('*', '?', '[')
+
+
+class Pattern:
+    """A compiled mount pattern"""
+    __slots__ = ('value', 'kind', '_regex')
+
+    def __init__(self, value: str):
+        self.value = value
+        self._regex = None
+        if value.startswith(REGEX_PREFIX):
+            self.kind = 'regex'
+            self._regex = re.compile(value[len(REGEX_PREFIX):])
+        elif any(char in value for char in GLOB_CHARS):
+            self.kind = 'glob'
+            self._regex = re.compile(fnmatch.translate(value))
+        else:
+            self.kind = 'substring'
+
+    def match(self, path: str) -> bool:
+        """bool: Does the pattern match the path?"""
+        if not path:
+            return False
+        if self._regex is None:
+            return self.value in path
+        return self._regex.fullmatch(path) is not None
+
+    def inside(self, destination: str) -> bool:
+        """bool: Does the pattern point to something inside the destination path?"""
+        if self.kind == 'regex' or not destination:
+            return False
+        return self.value.startswith(destination.rstrip('/') + '/')
+
+    def __repr__(self):
+        return "<Pattern {} {}>".format(self.kind, self.value)
+
+
+class MountFilter:
+    """Compiled include and exclude patterns for the mounts of a container"""
+    __slots__ = ('include', 'exclude')
+
+    def __init__(self, include: List[str] = None, exclude: List[str] = None):
+        self.include = [Pattern(value) for value in include or []]
+        self.exclude = [Pattern(value) for value in exclude or []]
+
+    def match(self, mount) -> bool:
+        """bool: Should the mount be backed up?"""
+        paths = (mount.source, mount.destination)
+        if self.include and not any(pattern.match(path) for pattern in self.include for path in paths):
+            return False
+
+        return not any(pattern.match(path) for pattern in self.exclude for path in paths)
+
+    def excludes_inside(self, mount) -> List[str]:
+        """
+        list: Exclude patterns pointing inside the mount destination
+        with the destination prefix removed. Example: ``cache/*``
+        """
+        prefix = mount.destination.rstrip('/') + '/' if mount.destination else ''
+        return [
+            pattern.value[len(prefix):]
+            for pattern in self.exclude
+            if pattern.inside(mount.destination)
+        ]
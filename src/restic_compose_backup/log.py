@@ -3,7 +3,7 @@ import os
 import sys
 
 logger = logging.getLogger('restic_compose_backup')
-HOSTNAME = os.environ['HOSTNAME']
+HOSTNAME = os.environ.get('HOSTNAME')
 
 DEFAULT_LOG_LEVEL = logging.INFO
 LOG_LEVELS = {
@@ -0,0 +1,104 @@
+"""
+Run history for the repository maintenance tasks.
+
+Forget, prune and check can run on their own schedules instead of
+after every backup. The outcome of each run is stored in the cache
+directory together with the position of the rotating data check so
+every slice of the repository is read once per cycle.
+"""
+import time
+import logging
+from typing import List
+
+from restic_compose_backup import utils
+
+logger = logging.getLogger(__name__)
+
+TASKS = ['forget', 'prune', 'check']
+
+
+class MaintenanceHistory:
+    """Last run of each maintenance task and the next data check slice"""
+
+    def __init__(self, path: str, repository: str):
+        self.path = path
+        self.repository = repository
+        self.tasks = {}
+        self.subset = {}
+        self.load()
+
+    def load(self):
+        # History for another repository says nothing about this one
+        data = utils.read_json(self.path, self.repository)
+        self.tasks = data.get('tasks') or {}
+        # Checks recorded a single ``subset`` before several slices could be read per check
+        check = self.tasks.get('check') or {}
+        if 'subset' in check:
+            subset = check.pop('subset')
+            check.setdefault('subsets', [subset] if subset else [])
+        self.subset = data.get('subset') or {}
+
+    def save(self):
+        data = {
+            'repository': self.repository,
+            'tasks': self.tasks,
+            'subset': self.subset,
+        }
+        utils.write_json(self.path, data, indent=2)
+
+    def last(self, task: str) -> dict:
+        """dict: The last run of a task or an empty dict"""
+        return self.tasks.get(task) or {}
+
+    def record(self, task: str, exit_code: int, duration: float, **extra):
+        """Record the outcome of a task. Successful runs also update ``last_success``"""
+        now = time.time()
+        entry = self.tasks.setdefault(task, {})
+        entry.update(last_run=now, exit_code=exit_code, duration=round(duration, 3), **extra)
+        if exit_code == 0:
+            entry['last_success'] = now
+
+    def next_subset(self, total: int) -> int:
+        """
+        int: The 1-based data check slice to read next.
+        The rotation starts over if the number of slices changed.
+        """
+        if self.subset.get('total') != total:
+            self.subset = {'total': total, 'next': 1, 'cycle': 1, 'cycle_started': time.time(), 'verified': {}}
+        return self.subset['next']
+
+    def due_subsets(self, total: int, period: float = 0) -> List[int]:
+        """
+        list: The slices the next check should read.
+
+        Without a period a single slice is read per check. With a period
+        in seconds enough slices are read to keep up with the time passed
+        since the cycle started, so all data is read within the period
+        even if checks run less often than there are slices.
+        """
+        current = self.next_subset(total)
+        if not period:
+            return [current]
+
+        elapsed = time.time() - self.subset.setdefault('cycle_started', time.time())
+        target = min(total, int(total * elapsed / period))
+        last = max(current, target)
+        return list(range(current, last + 1))
+
+    def advance_subset(self, total: int):
+        """Move the rotation to the next slice after a successful check"""
+        current = self.next_subset(total)
+        self.subset.setdefault('verified', {})[str(current)] = time.time()
+        if current >= total:
+            self.subset.update(next=1, cycle=self.subset.get('cycle', 1) + 1, cycle_started=time.time())
+            logger.info('All %s data check slices verified, starting cycle %s', total, self.subset['cycle'])
+        else:
+            self.subset['next'] = current + 1
+
+    @property
+    def coverage(self) -> float:
+        """float: Fraction of the data read in the current cycle"""
+        total = self.subset.get('total')
+        if not total:
+            return 0.0
+        return (self.subset['next'] - 1) / total
@@ -0,0 +1,158 @@
+"""
+Timing and size metrics for a backup run.
+
+The metrics are written as a json report and a prometheus
+textfile collector file when the backup process completes.
+"""
+import os
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+from restic_compose_backup import utils
+
+logger = logging.getLogger(__name__)
+
+PROMETHEUS_FILE = 'restic_compose_backup.prom'
+REPORT_FILE = 'backup_report.json'
+
+
+class BackupMetrics:
+    """Collects the duration and outcome of each phase and target of a backup run"""
+
+    def __init__(self, project: str):
+        self.project = project
+        self.started = time.time()
+        self.duration = 0.0
+        self.success = False
+        #: name -> {'duration', 'exit_code'}
+        self.phases = {}
+        #: name -> {'type', 'duration', 'exit_code', 'bytes_added'}
+        self.targets = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name: str):
+        """
+        Time a phase of the backup process. The yielded dict
+        can be used to record the exit code of the phase::
+
+            with metrics.phase('check') as phase:
+                phase['exit_code'] = restic.check(repository)
+        """
+        record = {'duration': 0.0, 'exit_code': None}
+        start = time.monotonic()
+        try:
+            yield record
+        finally:
+            record['duration'] = time.monotonic() - start
+            with self._lock:
+                self.phases[name] = record
+
+    def add_target(self, name: str, target_type: str, duration: float, exit_code: int):
+        """Record the outcome of backing up a volume or database"""
+        with self._lock:
+            target = self.targets.setdefault(name, {'bytes_added': 0})
+            target.update(type=target_type, duration=duration, exit_code=exit_code)
+
+    def add_summary(self, name: str, summary: dict):
+        """Add the data added to the repository and the snapshot from a restic backup summary"""
+        if not summary:
+            return
+
+        with self._lock:
+            target = self.targets.setdefault(name, {'bytes_added': 0})
+            target['bytes_added'] += summary.get('data_added') or 0
+            if summary.get('snapshot_id'):
+                target.setdefault('snapshots', []).append(summary['snapshot_id'])
+
+    @property
+    def snapshot_ids(self) -> list:
+        """list: Ids of the snapshots created in this run"""
+        return [snapshot_id for target in self.targets.values() for snapshot_id in target.get('snapshots', [])]
+
+    @property
+    def bytes_added(self) -> int:
+        return sum(target.get('bytes_added', 0) for target in self.targets.values())
+
+    def finish(self, success: bool):
+        self.success = success
+        self.duration = time.time() - self.started
+
+    def report(self) -> dict:
+        """dict: The metrics as json serializable data"""
+        return {
+            'project': self.project,
+            'started': self.started,
+            'duration': self.duration,
+            'success': self.success,
+            'bytes_added': self.bytes_added,
+            'phases': self.phases,
+            'targets': self.targets,
+        }
+
+    def prometheus(self) -> str:
+        """str: The metrics in the prometheus text exposition format"""
+        project = {'project': self.project}
+        lines = []
+
+        def metric(name, help_text, samples):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} gauge')
+            for labels, value in samples:
+                if value is None:
+                    continue
+                label_str = ','.join(f'{key}="{escape(val)}"' for key, val in labels.items())
+                lines.append(f'{name}{{{label_str}}} {value}')
+
+        metric('rcb_backup_last_run_timestamp_seconds', 'Start time of the last backup run',
+               [(project, round(self.started, 3))])
+        metric('rcb_backup_success', 'Whether the last backup run succeeded',
+               [(project, int(self.success))])
+        metric('rcb_backup_duration_seconds', 'Duration of the last backup run',
+               [(project, round(self.duration, 3))])
+        metric('rcb_backup_bytes_added', 'Bytes added to the repository by the last backup run',
+               [(project, self.bytes_added)])
+        metric('rcb_backup_phase_duration_seconds', 'Duration of each phase of the last backup run',
+               [({**project, 'phase': name}, round(phase['duration'], 3)) for name, phase in self.phases.items()])
+        metric('rcb_backup_phase_exit_code', 'Exit code of each phase of the last backup run',
+               [({**project, 'phase': name}, phase['exit_code']) for name, phase in self.phases.items()])
+        metric('rcb_backup_target_duration_seconds', 'Duration of the backup of each volume and database',
+               [({**project, 'target': name, 'type': target.get('type')}, round(target.get('duration', 0), 3))
+                for name, target in self.targets.items()])
+        metric('rcb_backup_target_exit_code', 'Exit code of the backup of each volume and database',
+               [({**project, 'target': name, 'type': target.get('type')}, target.get('exit_code'))
+                for name, target in self.targets.items()])
+        metric('rcb_backup_target_bytes_added', 'Bytes added to the repository for each volume and database',
+               [({**project, 'target': name, 'type': target.get('type')}, target.get('bytes_added', 0))
+                for name, target in self.targets.items()])
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self, directory: str):
+        """Write the json report and prometheus file. Files are replaced atomically"""
+        try:
+            os.makedirs(directory, exist_ok=True)
+            utils.write_atomic(os.path.join(directory, REPORT_FILE), json.dumps(self.report(), indent=2))
+            utils.write_atomic(os.path.join(directory, PROMETHEUS_FILE), self.prometheus())
+        except OSError as ex:
+            logger.warning('Unable to write metrics to %s: %s', directory, ex)
+            return
+
+        logger.info('Backup metrics written to %s', directory)
+
+    def log(self):
+        logger.info('%s Backup Metrics %s', '-' * 25, '-' * 25)
+        for name, phase in self.phases.items():
+            logger.info('phase: %s duration=%.1fs exit_code=%s', name, phase['duration'], phase['exit_code'])
+        for name, target in self.targets.items():
+            logger.info('target: %s (%s) duration=%.1fs exit_code=%s bytes_added=%s', name, target.get('type'),
+                        target.get('duration', 0), target.get('exit_code'), target.get('bytes_added', 0))
+        logger.info('total: duration=%.1fs bytes_added=%s', self.duration, self.bytes_added)
+
+
+def escape(value) -> str:
+    """str: Escape a prometheus label value"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -0,0 +1,102 @@
+"""
+Progress tracking for ``restic backup --json``
+"""
+import json
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class BackupProgress:
+    """
+    Consumes the json lines printed by ``restic backup --json``
+    while the backup is running. Status messages are kept as the
+    latest progress and logged every ``interval`` seconds. The final
+    summary message is kept as structured data.
+    """
+
+    def __init__(self, name: str, interval: int = 60):
+        self.name = name
+        self.interval = interval
+        self.status = {}
+        self.summary = None
+        self.errors = 0
+        self._last_logged = time.monotonic()
+
+    def __call__(self, line: str):
+        """Handle a line of output"""
+        try:
+            message = json.loads(line)
+        except ValueError:
+            logger.debug(line)
+            return
+
+        message_type = message.get('message_type')
+        if message_type == 'status':
+            self.status = message
+            if self.interval and time.monotonic() - self._last_logged >= self.interval:
+                self.log_status()
+        elif message_type == 'summary':
+            self.summary = message
+        elif message_type == 'error':
+            self.errors += 1
+            logger.error('%s: %s', self.name, message.get('error', {}).get('message') or message)
+        elif message_type == 'verbose_status':
+            logger.debug('%s: %s %s', self.name, message.get('action'), message.get('item'))
+
+    @property
+    def elapsed(self) -> float:
+        """float: Seconds elapsed reported by restic"""
+        return self.status.get('seconds_elapsed') or 0
+
+    @property
+    def files_per_second(self) -> float:
+        return self.status.get('files_done', 0) / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def bytes_per_second(self) -> float:
+        return self.status.get('bytes_done', 0) / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def eta(self) -> float:
+        """float: Estimated seconds remaining or None if unknown"""
+        if 'seconds_remaining' in self.status:
+            return self.status['seconds_remaining']
+
+        remaining = self.status.get('total_bytes', 0) - self.status.get('bytes_done', 0)
+        if remaining > 0 and self.bytes_per_second:
+            return remaining / self.bytes_per_second
+
+        return None
+
+    def log_status(self):
+        self._last_logged = time.monotonic()
+        eta = self.eta
+        logger.info(
+            '%s: %.1f%% done, %s/%s files, %.2f/%.2f GiB, %.1f files/s, %.2f MiB/s, ETA %s',
+            self.name,
+            self.status.get('percent_done', 0) * 100,
+            self.status.get('files_done', 0),
+            self.status.get('total_files', 0),
+            self.status.get('bytes_done', 0) / 2 ** 30,
+            self.status.get('total_bytes', 0) / 2 ** 30,
+            self.files_per_second,
+            self.bytes_per_second / 2 ** 20,
+            '{}s'.format(int(eta)) if eta is not None else 'unknown',
+        )
+
+    def log_summary(self):
+        if not self.summary:
+            return
+
+        logger.info(
+            '%s: snapshot %s, %s new, %s changed, %s unmodified files, %.2f MiB added in %.1fs',
+            self.name,
+            self.summary.get('snapshot_id'),
+            self.summary.get('files_new'),
+            self.summary.get('files_changed'),
+            self.summary.get('files_unmodified'),
+            self.summary.get('data_added', 0) / 2 ** 20,
+            self.summary.get('total_duration', 0),
+        )
@@ -0,0 +1,121 @@
+"""
+Container registry maintained from the docker events stream.
+
+Resident processes would otherwise list and inspect every container
+each time they need the backup plan. The registry lists the containers
+once and then only inspects the containers docker reports changes for.
+"""
+import logging
+import threading
+from typing import Callable, List
+
+from restic_compose_backup import utils
+from restic_compose_backup.config import get_config
+from restic_compose_backup.containers import Container, RunningContainers, discover_containers
+
+logger = logging.getLogger(__name__)
+
+# Events changing the state or configuration of a container
+UPDATE_ACTIONS = ['create', 'start', 'restart', 'kill', 'die', 'stop', 'pause', 'unpause', 'update', 'rename']
+# Signals of a kill event stopping the container. ``docker kill -s HUP`` and such only signal the process
+STOP_SIGNALS = ['2', '3', '9', '15', 'SIGINT', 'SIGQUIT', 'SIGKILL', 'SIGTERM', 'INT', 'QUIT', 'KILL', 'TERM']
+
+
+def is_stopping(action: str, attributes: dict) -> bool:
+    """bool: Is the event a kill stopping the container"""
+    if action != 'kill':
+        return False
+    signal = attributes.get('signal')
+    # Older docker versions don't report the signal
+    return signal is None or str(signal).upper() in STOP_SIGNALS
+
+
+class ContainerRegistry:
+    """Raw container data by id kept up to date from docker events"""
+
+    def __init__(self, hostname: str):
+        self.hostname = hostname
+        #: Called with the event action, the container and the event attributes after the registry is updated
+        self.listeners: List[Callable[[str, Container, dict], None]] = []
+        self._data = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.sync()
+
+    def sync(self):
+        """Replace the registry with a full listing"""
+        data = discover_containers(self.hostname)
+        with self._lock:
+            self._data = {entry['Id']: entry for entry in data}
+        logger.debug('Container registry synced: %s containers', len(data))
+
+    def running_containers(self, services: List[str] = None, stopping: List[dict] = None) -> RunningContainers:
+        """RunningContainers: The backup plan from the registry without querying docker"""
+        with self._lock:
+            data = list(self._data.values())
+        return RunningContainers(containers_data=data, services=services, stopping=stopping)
+
+    @property
+    def event_filters(self) -> dict:
+        filters = {'type': 'container'}
+        if not get_config().swarm_mode:
+            this_container = self.running_containers().this_container
+            filters['label'] = f'com.docker.compose.project={this_container.project_name}'
+        return filters
+
+    def handle(self, event: dict, client=None):
+        """Apply a container event to the registry and notify the listeners"""
+        action = event.get('Action') or event.get('status')
+        container_id = event.get('id') or event.get('Actor', {}).get('ID')
+        if not container_id:
+            return
+
+        if action == 'destroy':
+            with self._lock:
+                self._data.pop(container_id, None)
+            return
+
+        if action not in UPDATE_ACTIONS:
+            return
+
+        import docker
+
+        try:
+            data = client.api.inspect_container(container_id)
+        except docker.errors.NotFound:
+            return
+
+        with self._lock:
+            self._data[container_id] = data
+
+        container = Container(data)
+        attributes = event.get('Actor', {}).get('Attributes') or {}
+        for listener in self.listeners:
+            try:
+                listener(action, container, attributes)
+            except Exception as ex:
+                logger.exception(ex)
+
+    def start(self):
+        """Follow docker events in a background thread"""
+        self._thread = threading.Thread(target=self.watch, name='container-events', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def watch(self):
+        while not self._stop.is_set():
+            try:
+                with utils.docker_session() as client:
+                    events = client.events(decode=True, filters=self.event_filters)
+                    # Events sent before we subscribed are covered by a new listing
+                    self.sync()
+                    for event in events:
+                        if self._stop.is_set():
+                            break
+                        self.handle(event, client=client)
+            except Exception as ex:
+                logger.error('Docker event stream failed: %s', ex)
+                self._stop.wait(5)
@@ -1,10 +1,12 @@
 """
 Restic commands
 """
+import os
+import json
 import logging
-from typing import List, Tuple
+from typing import List, Mapping, Tuple
 from subprocess import Popen, PIPE
-from restic_compose_backup import commands
+from restic_compose_backup import commands, progress, stream
 
 logger = logging.getLogger(__name__)
 
@@ -19,41 +21,116 @@ def init_repo(repository: str):
     ]))
 
 
-def backup_files(repository: str, source='/volumes'):
-    return commands.run(restic(repository, [
-        "--verbose",
-        "backup",
-        source,
-    ]))
+def backup_files(repository: str, source='/volumes', tags: List[str] = None, exclude_file: str = None,
+                 progress_interval: int = 60, stats: dict = None):
+    """
+    Back up a path streaming the json progress from restic.
+    Progress is logged every ``progress_interval`` seconds and the
+    summary of the backup is stored in ``stats`` as ``summary``.
+    """
+    args = ["backup", "--json"]
+    for tag in tags or []:
+        args += ["--tag", tag]
+    if exclude_file:
+        args += ["--exclude-file", exclude_file]
+
+    backup_progress = progress.BackupProgress(source, interval=progress_interval)
+    result = commands.run(restic(repository, args + [source]), on_stdout=backup_progress, log_usage=True)
+    backup_progress.log_summary()
+
+    if stats is not None:
+        stats.update(summary=backup_progress.summary, errors=backup_progress.errors)
+
+    return result
 
 
-def backup_from_stdin(repository: str, filename: str, source_command: List[str]):
+def backup_from_stdin(repository: str, filename: str, source_command: List[str],
+                      env: Mapping[str, str] = None, transform_command: List[str] = None,
+                      relay: bool = False, pipe_size: int = None, metrics_file: str = None,
+                      stats: dict = None):
     """
     Backs up from stdin running the source_command passed in.
     It will appear in restic with the filename (including path) passed in.
+    Variables in ``env`` are only passed to the source command.
+
+    If a ``transform_command`` (such as a compressor) is passed in the
+    data is piped through it before reaching restic.
+
+    When relaying (always the case with a transform) the data is moved
+    between the processes by us, optionally with enlarged pipe buffers.
+    Throughput statistics are then logged, stored in ``stats`` and
+    appended to ``metrics_file``.
+
+    The restic backup summary is stored in ``stats`` as ``summary``.
     """
     dest_command = restic(repository, [
         'backup',
+        '--json',
         '--stdin',
         '--stdin-filename',
         filename,
     ])
 
     # pipe source command into dest command
-    source_process = Popen(source_command, stdout=PIPE, bufsize=65536)
-    dest_process = Popen(dest_command, stdin=source_process.stdout, stdout=PIPE, stderr=PIPE, bufsize=65536)
-    stdout, stderr = dest_process.communicate()
-
-    # Ensure both processes exited with code 0
-    source_exit, dest_exit = source_process.poll(), dest_process.poll()
-    exit_code = 0 if (source_exit == 0 and dest_exit == 0) else 1
-
-    if stdout:
-        commands.log_std('stdout', stdout, logging.DEBUG if exit_code == 0 else logging.ERROR)
-
-    if stderr:
-        commands.log_std('stderr', stderr, logging.ERROR)
-
+    source_process = Popen(source_command, stdout=PIPE, bufsize=65536, env=commands.child_env(env))
+    processes = [source_process]
+    relays = []
+    dest_stdin = source_process.stdout
+
+    if transform_command or relay:
+        upstream = source_process.stdout
+        if transform_command:
+            transform_process = Popen(transform_command, stdin=PIPE, stdout=PIPE)
+            processes.append(transform_process)
+            relays.append(stream.Relay(upstream, transform_process.stdin, pipe_size=pipe_size, name='source'))
+            upstream = transform_process.stdout
+
+        dest_stdin, write_fd = os.pipe()
+        relays.append(stream.Relay(upstream, open(write_fd, 'wb', buffering=0), pipe_size=pipe_size, name='restic'))
+        for item in relays:
+            item.start()
+
+    backup_progress = progress.BackupProgress(filename, interval=0)
+    result = commands.execute(dest_command, stdin=dest_stdin, on_stdout=backup_progress)
+    backup_progress.log_summary()
+
+    for item in relays:
+        item.join()
+
+    # Ensure all processes exited with code 0
+    exit_codes = [process.wait() for process in processes] + [result.returncode]
+    exit_code = 0 if all(code == 0 for code in exit_codes) else 1
+    if exit_code != 0:
+        logger.error('Pipeline exit codes: %s', exit_codes)
+
+    if stats is not None:
+        stats.update(summary=backup_progress.summary, errors=backup_progress.errors)
+
+    if relays:
+        bytes_in, bytes_out = relays[0].bytes, relays[-1].bytes
+        logger.info(
+            '%s: %s bytes in, %s bytes out (ratio %.2f)',
+            filename, bytes_in, bytes_out, bytes_out / bytes_in if bytes_in else 0,
+        )
+        for item in relays:
+            item.log_stats()
+
+        record = {
+            'filename': filename,
+            'exit_code': exit_code,
+            'bytes_in': bytes_in,
+            'bytes_out': bytes_out,
+            'relays': [item.stats() for item in relays],
+        }
+        if stats is not None:
+            stats.update(record)
+        if metrics_file:
+            stream.write_metrics(metrics_file, record)
+
+    if result.stderr:
+        commands.log_std('stderr', '\n'.join(result.stderr), logging.ERROR)
+
+    result.log_usage()
     return exit_code
 
 
@@ -65,19 +142,36 @@ def snapshots(repository: str, last=True) -> Tuple[str, str]:
     return commands.run_capture_std(restic(repository, args))
 
 
+def snapshots_json(repository: str, ids: List[str] = None) -> Tuple[int, List[dict]]:
+    """Returns the exit code and the snapshots listed by ``restic snapshots --json``"""
+    lines = []
+    result = commands.run(restic(repository, ["snapshots", "--json"] + (ids or [])), on_stdout=lines.append)
+    if result != 0:
+        return result, []
+
+    try:
+        return result, json.loads(''.join(lines) or '[]')
+    except ValueError as ex:
+        logger.error('Unable to parse snapshot listing: %s', ex)
+        return 1, []
+
+
 def is_initialized(repository: str) -> bool:
     """
-    Checks if a repository is initialized using snapshots command.
-    Note that this cannot separate between uninitalized repo
-    and other errors, but this method is reccomended by the restic
-    community.
+    Checks if a repository is initialized by reading its config file.
+    This is a single small request to the backend compared to listing
+    snapshots. Note that this cannot separate between an uninitialized
+    repository and other errors.
     """
-    return commands.run(restic(repository, ["snapshots", '--last'])) == 0
+    return commands.run(restic(repository, ["cat", "config"])) == 0
 
 
-def forget(repository: str, daily: str, weekly: str, monthly: str, yearly: str):
-    return commands.run(restic(repository, [
+def forget(repository: str, daily: str, weekly: str, monthly: str, yearly: str, removed: List[str] = None):
+    """Forget snapshots outside the keep policy. Ids of forgotten snapshots are added to ``removed``"""
+    lines = []
+    result = commands.run(restic(repository, [
         'forget',
+        '--json',
         '--group-by',
         'paths',
         '--keep-daily',
@@ -88,20 +182,37 @@ def forget(repository: str, daily: str, weekly: str, monthly: str, yearly: str):
         monthly,
         '--keep-yearly',
         yearly,
-    ]))
+    ]), on_stdout=lines.append, log_usage=True)
+
+    if removed is not None:
+        try:
+            groups = json.loads(''.join(lines) or '[]')
+        except ValueError as ex:
+            logger.warning('Unable to parse forget output: %s', ex)
+            groups = []
+        for group in groups or []:
+            removed.extend(snapshot['id'] for snapshot in group.get('remove') or [])
+
+    return result
 
 
 def prune(repository: str):
     return commands.run(restic(repository, [
         'prune',
-    ]))
+    ]), log_usage=True)
 
 
-def check(repository: str):
-    return commands.run(restic(repository, [
-        "check",
-        # "--with-cache",
-    ]))
+def check(repository: str, read_data_subset: str = None, with_cache: bool = False):
+    """
+    Check the repository optionally reading a subset of the pack data such as ``2/5``.
+    ``with_cache`` uses the local cache instead of downloading all metadata again.
+    """
+    args = ["check"]
+    if with_cache:
+        args.append("--with-cache")
+    if read_data_subset:
+        args.append(f"--read-data-subset={read_data_subset}")
+    return commands.run(restic(repository, args), log_usage=True)
 
 
 def restic(repository: str, args: List[str]):
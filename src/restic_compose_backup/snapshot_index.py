@@ -0,0 +1,112 @@
+"""
+Local index of the snapshots in the repository.
+
+Listing snapshots on remote backends holding thousands of them is slow.
+The index is built once from ``restic snapshots --json`` and kept up to
+date by fetching only the snapshots created by our own backups and
+dropping the ones removed by forget.
+"""
+import logging
+from typing import List
+
+from restic_compose_backup import restic, utils
+
+logger = logging.getLogger(__name__)
+
+# Snapshot fields kept in the index
+FIELDS = ['id', 'short_id', 'time', 'hostname', 'paths', 'tags']
+
+
+class SnapshotIndex:
+    """Snapshot metadata by snapshot id for a single repository"""
+
+    def __init__(self, path: str, repository: str):
+        self.path = path
+        self.repository = repository
+        self.snapshots = {}
+        self.complete = False
+        self.load()
+
+    def load(self):
+        """Load the index. Snapshots recorded for another repository are discarded"""
+        data = utils.read_json(self.path, self.repository)
+        self.snapshots = data.get('snapshots', {})
+        self.complete = data.get('complete', False)
+
+    def save(self):
+        """Persist the index"""
+        data = {'repository': self.repository, 'complete': self.complete, 'snapshots': self.snapshots}
+        utils.write_json(self.path, data)
+
+    def rebuild(self) -> int:
+        """Replace the index with a full listing of the repository"""
+        result, snapshots = restic.snapshots_json(self.repository)
+        if result == 0:
+            self.snapshots = {}
+            self.add(snapshots)
+            self.complete = True
+        return result
+
+    def update(self, ids: List[str]) -> int:
+        """Fetch only the given snapshots. The full listing is used if the index was never built"""
+        if not self.complete:
+            return self.rebuild()
+
+        ids = [snapshot_id for snapshot_id in ids if snapshot_id and snapshot_id not in self.snapshots]
+        if not ids:
+            return 0
+
+        result, snapshots = restic.snapshots_json(self.repository, ids=ids)
+        if result == 0:
+            self.add(snapshots)
+        return result
+
+    def add(self, snapshots: List[dict]):
+        for snapshot in snapshots:
+            self.snapshots[snapshot['id']] = {field: snapshot.get(field) for field in FIELDS}
+
+    def remove(self, ids: List[str]):
+        for snapshot_id in ids:
+            self.snapshots.pop(snapshot_id, None)
+
+    def query(self, path: str = None, tag: str = None, last: bool = False) -> List[dict]:
+        """
+        Snapshots sorted by time optionally filtered by path prefix and tag.
+        With ``last`` only the latest snapshot of each set of paths is returned
+        like ``restic snapshots --last``.
+        """
+        snapshots = sorted(self.snapshots.values(), key=lambda snapshot: snapshot['time'])
+        if path:
+            path = path.rstrip('/')
+            snapshots = [
+                snapshot for snapshot in snapshots
+                if any(p == path or p.startswith(path + '/') for p in snapshot['paths'] or [])
+            ]
+        if tag:
+            snapshots = [snapshot for snapshot in snapshots if tag in (snapshot['tags'] or [])]
+        if last:
+            latest = {}
+            for snapshot in snapshots:
+                latest[tuple(sorted(snapshot['paths'] or []))] = snapshot
+            snapshots = sorted(latest.values(), key=lambda snapshot: snapshot['time'])
+
+        return snapshots
+
+
+def format_table(snapshots: List[dict]) -> str:
+    """str: Snapshots as a table similar to the restic output"""
+    rows = [('ID', 'Time', 'Host', 'Tags', 'Paths')]
+    for snapshot in snapshots:
+        rows.append((
+            snapshot['short_id'] or snapshot['id'][:8],
+            snapshot['time'][:19].replace('T', ' '),
+            snapshot['hostname'] or '',
+            ','.join(snapshot['tags'] or []),
+            ' '.join(snapshot['paths'] or []),
+        ))
+
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    lines = ['  '.join(value.ljust(width) for value, width in zip(row, widths)).rstrip() for row in rows]
+    lines.insert(1, '-' * max(len(line) for line in lines))
+    lines.append(f'{len(snapshots)} snapshots')
+    return '\n'.join(lines)
@@ -0,0 +1,170 @@
+"""
+Helpers for streaming data between processes
+"""
+import os
+import json
+import time
+import fcntl
+import struct
+import select
+import termios
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Not exposed by the fcntl module before python 3.10
+F_SETPIPE_SZ = getattr(fcntl, 'F_SETPIPE_SZ', 1031)
+F_GETPIPE_SZ = getattr(fcntl, 'F_GETPIPE_SZ', 1032)
+
+
+class Relay(threading.Thread):
+    """
+    Copies all data from one pipe to another in a background thread.
+    Both file objects are closed when the source reaches EOF or the
+    destination is closed.
+
+    The data is moved with ``os.splice`` when available so it never
+    passes through user space. The relay also collects throughput
+    statistics telling us which side of the pipe is the bottleneck:
+
+    * ``read_stall``: seconds spent waiting for the source to produce data
+    * ``write_stall``: seconds spent waiting for the destination to consume data
+    * ``peak_fill``: the highest number of bytes waiting in the source pipe
+    """
+
+    def __init__(self, src, dst, buffer_size: int = 65536, pipe_size: int = None, name: str = 'relay'):
+        super().__init__(daemon=True)
+        self.src = src
+        self.dst = dst
+        self.name = name
+        self.buffer_size = buffer_size
+        self.pipe_size = pipe_size
+        self.bytes = 0
+        self.duration = 0.0
+        self.read_stall = 0.0
+        self.write_stall = 0.0
+        self.peak_fill = 0
+
+    def run(self):
+        started = time.monotonic()
+        try:
+            src, dst = self.src.fileno(), self.dst.fileno()
+            if self.pipe_size:
+                # Both pipes keep their current size if the resize fails
+                self.pipe_size = set_pipe_size(src, self.pipe_size)
+                if self.pipe_size:
+                    set_pipe_size(dst, self.pipe_size)
+                    self.buffer_size = max(self.buffer_size, self.pipe_size)
+
+            transfer = self._splice if hasattr(os, 'splice') else self._copy
+            readable, writable = select.poll(), select.poll()
+            readable.register(src, select.POLLIN)
+            writable.register(dst, select.POLLOUT)
+
+            while True:
+                start = time.monotonic()
+                readable.poll()
+                self.read_stall += time.monotonic() - start
+
+                fill = pipe_fill(src)
+                self.peak_fill = max(self.peak_fill, fill)
+
+                start = time.monotonic()
+                writable.poll()
+                self.write_stall += time.monotonic() - start
+
+                moved = transfer(src, dst)
+                if moved == 0:
+                    break
+
+                self.bytes += moved
+        except BrokenPipeError:
+            logger.error("Relay %s: destination closed after %s bytes", self.name, self.bytes)
+        except Exception:
+            logger.exception("Relay %s: failed after %s bytes", self.name, self.bytes)
+        finally:
+            self.duration = time.monotonic() - started
+            # Closing the source ensures the writing process receives SIGPIPE
+            # instead of blocking forever if the destination went away
+            self.dst.close()
+            self.src.close()
+
+    def _splice(self, src: int, dst: int) -> int:
+        """Move data between the pipes in kernel space"""
+        return os.splice(src, dst, self.buffer_size)
+
+    def _copy(self, src: int, dst: int) -> int:
+        """Fallback copying data through user space"""
+        data = os.read(src, self.buffer_size)
+        view = memoryview(data)
+        while view:
+            written = os.write(dst, view)
+            view = view[written:]
+        return len(data)
+
+    @property
+    def rate(self) -> float:
+        """float: Bytes per second"""
+        return self.bytes / self.duration if self.duration else 0.0
+
+    @property
+    def bottleneck(self) -> str:
+        """str: The side of the pipe we mostly waited for"""
+        return 'source' if self.read_stall >= self.write_stall else 'destination'
+
+    def stats(self) -> dict:
+        """dict: The collected statistics for this relay"""
+        return {
+            'name': self.name,
+            'bytes': self.bytes,
+            'duration': round(self.duration, 3),
+            'bytes_per_second': round(self.rate),
+            'read_stall': round(self.read_stall, 3),
+            'write_stall': round(self.write_stall, 3),
+            'peak_fill': self.peak_fill,
+            'pipe_size': self.pipe_size,
+            'bottleneck': self.bottleneck,
+        }
+
+    def log_stats(self):
+        logger.info(
+            "Relay %s: %s bytes in %.1fs (%.2f MiB/s), read stall %.1fs, write stall %.1fs, "
+            "peak fill %s bytes, bottleneck: %s",
+            self.name, self.bytes, self.duration, self.rate / 2 ** 20,
+            self.read_stall, self.write_stall, self.peak_fill, self.bottleneck,
+        )
+
+
+def set_pipe_size(fd: int, size: int) -> int:
+    """
+    Attempt to resize a pipe buffer returning the actual size.
+    The size is capped by ``/proc/sys/fs/pipe-max-size`` for unprivileged users.
+    Returns None if the size of the pipe is unknown.
+    """
+    try:
+        return fcntl.fcntl(fd, F_SETPIPE_SZ, size)
+    except OSError as ex:
+        logger.warning("Unable to set pipe size to %s bytes: %s", size, ex)
+        try:
+            return fcntl.fcntl(fd, F_GETPIPE_SZ)
+        except OSError:
+            return None
+
+
+def pipe_fill(fd: int) -> int:
+    """int: Number of bytes waiting to be read from a pipe"""
+    try:
+        return struct.unpack('i', fcntl.ioctl(fd, termios.FIONREAD, b'\0' * 4))[0]
+    except OSError:
+        return 0
+
+
+def write_metrics(path: str, record: dict):
+    """Append a metrics record as a json line to a file"""
+    try:
+        with open(path, 'a') as fd:
+            fd.write(json.dumps({'time': int(time.time()), **record}))
+            fd.write('\n')
+    except OSError as ex:
+        logger.warning("Unable to write metrics to %s: %s", path, ex)
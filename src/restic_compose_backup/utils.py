@@ -1,13 +1,18 @@
 import os
+import json
+import fcntl
 import logging
-from typing import List
 from contextlib import contextmanager
-import docker
+from typing import List
 
 logger = logging.getLogger(__name__)
 
 TRUE_VALUES = ['1', 'true', 'True', True, 1]
 
+# Resident processes keep one docker client open. Stored with the pid so forked children make their own
+_shared_client = None
+_keep_client = False
+
 
 def docker_client():
     """
@@ -17,6 +22,9 @@ def docker_client():
         DOCKER_TLS_VERIFY=1
         DOCKER_CERT_PATH=''
     """
+    # Importing docker is slow. Only pay for it when we talk to docker
+    import docker
+
     # NOTE: Remove this fallback in 1.0
     if not os.environ.get('DOCKER_HOST'):
         os.environ['DOCKER_HOST'] = 'unix://tmp/docker.sock'
@@ -24,20 +32,53 @@ def docker_client():
     return docker.from_env()
 
 
-def list_containers() -> List[dict]:
+def keep_docker_client():
+    """Reuse a single docker client for the rest of the process instead of one per call"""
+    global _keep_client
+    _keep_client = True
+
+
+@contextmanager
+def docker_session():
+    """Yield a docker client. It's closed afterwards unless the process keeps its client"""
+    global _shared_client
+    if not _keep_client:
+        client = docker_client()
+        try:
+            yield client
+        finally:
+            client.close()
+        return
+
+    if _shared_client is None or _shared_client[0] != os.getpid():
+        _shared_client = (os.getpid(), docker_client())
+    yield _shared_client[1]
+
+
+def list_containers(filters: dict = None) -> List[dict]:
     """
-    List all containers.
+    List all containers. Filters are applied by the docker api.
+
+    Args:
+        filters (dict): Docker api filters such as ``{'label': 'key=value'}``
 
     Returns:
         List of raw container json data from the api
     """
-    client = docker_client()
-    all_containers = client.containers.list(all=True)
-    client.close()
+    with docker_session() as client:
+        all_containers = client.containers.list(all=True, filters=filters, ignore_removed=True)
     return [c.attrs for c in all_containers]
 
 
+def ping_docker() -> bool:
+    """Check if the docker api can be reached"""
+    with docker_session() as client:
+        return client.ping()
+
+
 def get_swarm_nodes():
+    import docker
+
     client = docker_client()
     # NOTE: If not a swarm node docker.errors.APIError is raised
     #       503 Server Error: Service Unavailable
@@ -80,15 +121,67 @@ def strip_root(path):
     return path
 
 
-@contextmanager
-def environment(name, value):
-    """Tempset env var"""
-    old_val = os.environ.get(name)
-    os.environ[name] = value
+def read_json(path: str, repository: str = None) -> dict:
+    """
+    Read a json state file returning an empty dict if it's missing or unreadable.
+    State recorded for another repository than ``repository`` is discarded.
+    """
+    try:
+        with open(path) as fd:
+            data = json.load(fd)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as ex:
+        logger.warning("Ignoring unreadable file %s: %s", path, ex)
+        return {}
+
+    if not isinstance(data, dict):
+        logger.warning("Ignoring unexpected content in %s", path)
+        return {}
+
+    if repository is not None and data.get('repository') != repository:
+        return {}
+
+    return data
+
+
+def write_json(path: str, data, indent: int = None) -> bool:
+    """Atomically write a json state file creating its directory. Returns False if it couldn't be written"""
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_atomic(path, json.dumps(data, indent=indent))
+    except (OSError, TypeError, ValueError) as ex:
+        logger.warning("Unable to write %s: %s", path, ex)
+        return False
+
+    return True
+
+
+def write_atomic(path: str, data: str):
+    """Write a file through a temporary file so readers never see partial content"""
+    tmp_path = f'{path}.{os.getpid()}.tmp'
     try:
-        yield
+        with open(tmp_path, 'w') as fd:
+            fd.write(data)
+        os.replace(tmp_path, path)
     finally:
-        if old_val is None:
-            del os.environ[name]
-        else:
-            os.environ[name] = old_val
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+@contextmanager
+def file_lock(path: str):
+    """
+    Try to take an exclusive lock on ``path`` for the duration of the block.
+    Yields False without waiting if another process holds the lock.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a') as fd:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+
+        # The lock is released when the file is closed
+        yield True
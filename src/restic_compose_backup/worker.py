@@ -0,0 +1,139 @@
+"""
+Long-lived backup worker.
+
+Instead of starting a new backup process container for every backup
+the worker container stays up with the volumes mounted and listens
+on localhost in the network stack it shares with the backup service.
+Each backup request runs in a forked child so no state leaks between
+runs while imports and interpreter startup are paid only once.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import hashlib
+import logging
+import traceback
+from typing import Callable, List
+
+from restic_compose_backup import commands
+from restic_compose_backup.backup_runner import LineSplitter
+
+logger = logging.getLogger(__name__)
+
+# Sent after the output of a run. The null byte never appears in log output
+EXIT_MARKER = '\x00rcb-exit-code:'
+# Request line optionally followed by comma separated service names.
+# The next line holds the json data of the containers being stopped
+REQUEST_BACKUP = 'backup'
+# Upper limit for the container data sent with a request
+MAX_REQUEST_SIZE = 2 ** 20
+
+
+def worker_hash(volumes: dict, image: str, source_container_id: str) -> str:
+    """
+    str: Hash identifying the worker configuration. The worker container
+    must be recreated when the mounts, image or backup service change.
+    """
+    data = json.dumps([volumes, image, source_container_id], sort_keys=True)
+    return hashlib.sha256(data.encode()).hexdigest()[:16]
+
+
+def serve(port: int, run_backup: Callable[[List[str], List[dict]], int]):
+    """Accept backup requests on localhost handling one at a time"""
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(('127.0.0.1', port))
+    server.listen(1)
+    logger.info('Backup worker listening on port %s', port)
+
+    while True:
+        conn, _ = server.accept()
+        with conn:
+            try:
+                with conn.makefile('rb') as reader:
+                    request = reader.readline(4096).decode(errors='replace').split()
+                    stopping = reader.readline(MAX_REQUEST_SIZE)
+                if not request or request[0] != REQUEST_BACKUP:
+                    logger.warning('Ignoring invalid worker request')
+                    continue
+
+                services = request[1].split(',') if len(request) > 1 else None
+                stopping = json.loads(stopping) if stopping.strip() else None
+                logger.info('Starting backup run')
+                exit_code = run_forked(conn, lambda: run_backup(services, stopping))
+                logger.info('Backup run exit code: %s', exit_code)
+                conn.sendall(f'{EXIT_MARKER}{exit_code}\n'.encode())
+            except (OSError, ValueError) as ex:
+                logger.error('Backup request failed: %s', ex)
+
+
+def run_forked(conn: socket.socket, run_backup: Callable[[], int]) -> int:
+    """Run a backup in a child process writing its output to the connection"""
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid == 0:
+        exit_code = 1
+        try:
+            os.dup2(conn.fileno(), 1)
+            os.dup2(conn.fileno(), 2)
+            exit_code = run_backup() or 0
+        except SystemExit as ex:
+            exit_code = ex.code if isinstance(ex.code, int) else int(ex.code is not None)
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(exit_code)
+
+    _, status = os.waitpid(pid, 0)
+    return commands.exit_code(status)
+
+
+def connect(port: int, timeout: float = 30) -> socket.socket:
+    """Connect to the worker waiting for it to start listening"""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return socket.create_connection(('127.0.0.1', port), timeout=timeout)
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.2)
+
+
+def request_backup(port: int, fd, timeout: float = 30, services: List[str] = None,
+                   stopping: List[dict] = None) -> int:
+    """Run a backup in the worker relaying the output to ``fd`` and the log. Returns the exit code"""
+    with connect(port, timeout=timeout) as sock:
+        # Backups can take hours
+        sock.settimeout(None)
+        request = f"{REQUEST_BACKUP} {','.join(services)}" if services else REQUEST_BACKUP
+        sock.sendall(f'{request}\n{json.dumps(stopping or [])}\n'.encode())
+
+        splitter = LineSplitter()
+        exit_code = None
+        while True:
+            data = sock.recv(65536)
+            lines = splitter.feed(data) if data else splitter.flush()
+            for line in lines:
+                # Output without a trailing newline ends up on the line of the marker
+                line, marker, code = line.partition(EXIT_MARKER)
+                if marker:
+                    exit_code = int(code)
+                    if not line:
+                        continue
+                fd.write(line)
+                fd.write('\n')
+                logger.info(line)
+            if not data:
+                break
+
+    if exit_code is None:
+        logger.error('Backup worker closed the connection without an exit code')
+        return 1
+
+    return exit_code
@@ -0,0 +1,80 @@
+"""
+Micro-benchmark for container discovery and filtering.
+
+Generates thousands of synthetic containers and measures the time
+spent building RunningContainers and evaluating the backup flags,
+mounts and credentials of every container.
+
+Usage::
+
+    python benchmark.py [number of containers] [rounds]
+"""
+import os
+import sys
+import time
+from unittest import mock
+
+os.environ.setdefault('RESTIC_REPOSITORY', 'test')
+os.environ['HOSTNAME'] = '{:064x}'.format(0)[:12]
+
+from restic_compose_backup.containers import RunningContainers  # noqa: E402
+import fixtures  # noqa: E402
+
+LABELS = [
+    {'restic-compose-backup.volumes': 'true', 'restic-compose-backup.volumes.exclude': 'cache,tmp'},
+    {'restic-compose-backup.mysql': 'true'},
+    {'restic-compose-backup.postgres': 'true'},
+    {'some.other.label': 'value'},
+]
+
+
+def synthetic_containers(count: int) -> list:
+    """Generate raw data for count containers with labels, env vars and mounts"""
+    containers = [{'id': '{:064x}'.format(0), 'service': 'backup'}]
+    for i in range(1, count):
+        containers.append({
+            'id': '{:064x}'.format(i),
+            'service': 'service_{}'.format(i),
+            'labels': {**LABELS[i % len(LABELS)], **{'label_{}'.format(n): str(n) for n in range(20)}},
+            'mounts': [
+                {'Source': '/srv/{}/{}'.format(i, name), 'Destination': '/srv/{}'.format(name), 'Type': 'bind'}
+                for name in ['data', 'cache', 'media', 'tmp']
+            ],
+        })
+
+    data = fixtures.containers(containers=containers)()
+    for entry in data:
+        entry['Config']['Env'] = ['VAR_{}=value'.format(n) for n in range(30)] + [
+            'MYSQL_USER=user', 'MYSQL_PASSWORD=password',
+            'POSTGRES_USER=user', 'POSTGRES_PASSWORD=password', 'POSTGRES_DB=db',
+        ]
+    return data
+
+
+def evaluate(containers: RunningContainers):
+    """Access everything the status and backup commands read from each container"""
+    for container in containers.containers_for_backup():
+        container.filter_mounts()
+        if container.database_backup_enabled:
+            container.instance.get_credentials()
+    containers.generate_backup_mounts()
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    data = synthetic_containers(count)
+
+    timings = []
+    with mock.patch('restic_compose_backup.utils.list_containers', return_value=data):
+        for _ in range(rounds):
+            start = time.perf_counter()
+            evaluate(RunningContainers())
+            timings.append(time.perf_counter() - start)
+
+    print('{} containers, {} rounds: best {:.1f} ms, mean {:.1f} ms'.format(
+        count, rounds, min(timings) * 1000, sum(timings) / len(timings) * 1000))
+
+
+if __name__ == '__main__':
+    main()
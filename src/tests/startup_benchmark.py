@@ -0,0 +1,52 @@
+"""
+Benchmark for the startup time of the rcb command.
+
+Runs ``python -X importtime`` on the cli module and lists the slowest
+imports, then times a few runs of the version command.
+
+Usage::
+
+    python startup_benchmark.py [number of modules] [rounds]
+"""
+import subprocess
+import sys
+import time
+
+
+def import_times() -> list:
+    """List of (cumulative us, self us, module) for every module imported by the cli"""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import restic_compose_backup.cli'],
+        capture_output=True, text=True, check=True,
+    )
+    timings = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, module = line[len('import time:'):].split('|')
+        timings.append((int(cumulative_us), int(self_us), module.strip()))
+    return timings
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 15
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    timings = import_times()
+    total = next(t for t in timings if t[2] == 'restic_compose_backup.cli')[0]
+    print('import restic_compose_backup.cli: {:.1f} ms'.format(total / 1000))
+    for cumulative, self_us, module in sorted(timings, reverse=True)[:count]:
+        print('  {:>8.1f} ms {:>8.1f} ms  {}'.format(cumulative / 1000, self_us / 1000, module))
+
+    runs = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-m', 'restic_compose_backup.cli', 'version'], capture_output=True, check=True)
+        runs.append(time.perf_counter() - start)
+
+    print('rcb version, {} rounds: best {:.1f} ms, mean {:.1f} ms'.format(
+        rounds, min(runs) * 1000, sum(runs) / len(runs) * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -198,3 +198,870 @@ class ResticBackupTests(unittest.TestCase):
         with mock.patch(list_containers_func, fixtures.containers(containers=containers)):
             cnt = RunningContainers()
             self.assertTrue(cnt.backup_process_running)
+
+    def test_backup_databases_concurrently(self):
+        """Database backups run in a worker pool and errors are aggregated"""
+        from restic_compose_backup import cli
+
+        def database(name, exit_code):
+            container = mock.Mock(database_backup_enabled=True)
+            container.instance.service_name = name
+            container.instance.container_type = 'mysql'
+            container.instance.backup.return_value = exit_code
+            container.instance.ping.return_value = 0
+            return container
+
+        containers = mock.Mock()
+        containers.containers_for_backup.return_value = [database('a', 0), database('b', 0)]
+        config = mock.Mock(db_backup_concurrency='2', ping_timeout='1', ping_retries='1')
+        self.assertFalse(cli.backup_databases(config, containers))
+
+        containers.containers_for_backup.return_value = [database('a', 0), database('b', 1)]
+        self.assertTrue(cli.backup_databases(config, containers))
+
+    def test_child_env(self):
+        """Credentials are passed to the child only without touching os.environ"""
+        from restic_compose_backup import commands
+
+        self.assertIsNone(commands.child_env(None))
+        env = commands.child_env({'MYSQL_PWD': 'secret'})
+        self.assertEqual(env['MYSQL_PWD'], 'secret')
+        self.assertEqual(env['RESTIC_REPOSITORY'], os.environ['RESTIC_REPOSITORY'])
+        self.assertNotIn('MYSQL_PWD', os.environ)
+
+    def test_compression_parse(self):
+        """Parse the dump compression label"""
+        from restic_compose_backup.compression import Compression
+
+        self.assertIsNone(Compression.parse(None))
+        self.assertIsNone(Compression.parse('none'))
+        self.assertEqual(Compression.parse('zstd').command, ['zstd', '--stdout', '--quiet', '-3'])
+        gzip = Compression.parse('gzip:9:rsyncable')
+        self.assertEqual(gzip.command, ['gzip', '--stdout', '-9', '--rsyncable'])
+        self.assertEqual(gzip.extension, '.gz')
+        with self.assertRaises(ValueError):
+            Compression.parse('gzip:42')
+        with self.assertRaises(ValueError):
+            Compression.parse('lzma')
+
+    def test_invalid_dump_labels(self):
+        """An invalid dump label only fails the dump of that service"""
+        from restic_compose_backup import cli, containers_db
+        from restic_compose_backup.config import get_config
+
+        containers = self.createContainers()
+        containers += [
+            {
+                'service': 'mysql',
+                'labels': {
+                    'restic-compose-backup.mysql': 'true',
+                    'restic-compose-backup.dump.compression': 'zstd:25',
+                    'restic-compose-backup.dump.concurrency': 'many',
+                },
+            },
+            {'service': 'web', 'labels': {'restic-compose-backup.volumes': True}},
+        ]
+        with mock.patch(list_containers_func, fixtures.containers(containers=containers)):
+            cnt = RunningContainers()
+        mysql = cnt.get_service('mysql').instance
+        self.assertIsNone(mysql.dump_compression)
+        self.assertEqual(mysql.dump_concurrency, 1)
+        self.assertEqual(len(mysql.dump_label_errors), 2)
+        self.assertEqual(cnt.get_service('web').dump_label_errors, [])
+
+        mysql_id = cnt.get_service('mysql').id
+        ping = {mysql_id: {'service': 'mysql', 'id': mysql_id, 'type': 'mysql', 'exit_code': 0, 'latency': 0.01}}
+        with mock.patch('restic_compose_backup.utils.ping_docker'), \
+                mock.patch.object(cli, 'ensure_initialized'), \
+                mock.patch.object(cli, 'get_snapshot_index', return_value=mock.Mock(complete=False)), \
+                mock.patch.object(cli, 'ping_databases', return_value=ping), \
+                self.assertLogs('restic_compose_backup.cli', 'ERROR') as logs:
+            cli.status(get_config(), cnt)
+        self.assertTrue(any('zstd:25' in line for line in logs.output))
+
+        with mock.patch('restic_compose_backup.containers_db.backup_dump', return_value=0) as backup_dump:
+            with self.assertLogs('restic_compose_backup.containers_db', 'ERROR'):
+                self.assertEqual(mysql.backup(), 1)
+        backup_dump.assert_not_called()
+        self.assertIsInstance(mysql, containers_db.MysqlContainer)
+
+    def test_stream_relay(self):
+        """Relay copies data between processes counting bytes"""
+        import subprocess
+        from restic_compose_backup import stream
+
+        source = subprocess.Popen(['printf', 'hello world'], stdout=subprocess.PIPE)
+        dest = subprocess.Popen(['cat'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        relay = stream.Relay(source.stdout, dest.stdin)
+        relay.start()
+        relay.join()
+        self.assertEqual(dest.stdout.read(), b'hello world')
+        self.assertEqual(relay.bytes, 11)
+        self.assertEqual(relay.stats()['bytes'], 11)
+        dest.stdout.close()
+        source.wait()
+        dest.wait()
+
+        # Pipes keep their size when the resize fails
+        source = subprocess.Popen(['printf', 'hello world'], stdout=subprocess.PIPE)
+        dest = subprocess.Popen(['cat'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        relay = stream.Relay(source.stdout, dest.stdin, pipe_size=2 ** 20)
+        with mock.patch.object(stream, 'set_pipe_size', return_value=None):
+            relay.start()
+            relay.join()
+        self.assertEqual(dest.stdout.read(), b'hello world')
+        self.assertTrue(source.stdout.closed and dest.stdin.closed)
+        dest.stdout.close()
+        source.wait()
+        dest.wait()
+
+    def test_mysql_per_database_dump(self):
+        """Each database is dumped into its own file skipping system schemas"""
+        from restic_compose_backup import commands, containers_db
+
+        data = fixtures.containers(containers=[{
+            'service': 'mysql',
+            'labels': {
+                'restic-compose-backup.mysql': 'true',
+                'restic-compose-backup.dump.mode': 'per-database',
+                'restic-compose-backup.dump.concurrency': '2',
+            },
+        }])()[0]
+        data['Config']['Env'] = ['MYSQL_USER=root', 'MYSQL_PASSWORD=secret']
+        container = containers_db.MysqlContainer(data)
+
+        list_databases = 'restic_compose_backup.commands.list_mysql_databases'
+        with mock.patch(list_databases, return_value=['mysql', 'sys', 'app', 'wiki']), \
+                mock.patch('restic_compose_backup.containers_db.backup_dump', return_value=0) as backup_dump:
+            self.assertEqual(container.backup(), 0)
+
+        filenames = sorted(call[0][2] for call in backup_dump.call_args_list)
+        self.assertEqual(filenames, ['/databases/mysql/app.sql', '/databases/mysql/wiki.sql'])
+        self.assertEqual(container.dump_command('app')[-2:], ['--databases', 'app'])
+
+        # A failed listing is an error and not an empty server
+        failed = commands.CommandResult(['mysql'])
+        failed.returncode = 1
+        failed.stderr.append('Access denied')
+        with mock.patch('restic_compose_backup.commands.execute', return_value=failed):
+            with self.assertRaisesRegex(RuntimeError, 'Access denied'):
+                container.list_databases()
+
+        data['Config']['Labels']['restic-compose-backup.dump.mode'] = 'per-table'
+        with mock.patch('restic_compose_backup.containers_db.backup_dump', return_value=0) as backup_dump:
+            with self.assertLogs('restic_compose_backup.containers_db', 'ERROR'):
+                self.assertEqual(containers_db.MysqlContainer(data).backup(), 1)
+        backup_dump.assert_not_called()
+
+    def test_postgres_per_database_dump(self):
+        """All databases and the globals are dumped in per-database mode"""
+        from restic_compose_backup import containers_db
+
+        data = fixtures.containers(containers=[{
+            'service': 'postgres',
+            'labels': {
+                'restic-compose-backup.postgres': 'true',
+                'restic-compose-backup.dump.mode': 'per-database',
+            },
+        }])()[0]
+        data['Config']['Env'] = ['POSTGRES_USER=postgres', 'POSTGRES_PASSWORD=secret', 'POSTGRES_DB=app']
+        container = containers_db.PostgresContainer(data)
+
+        list_databases = 'restic_compose_backup.commands.list_postgres_databases'
+        with mock.patch(list_databases, return_value=['globals', 'app']), \
+                mock.patch('restic_compose_backup.containers_db.backup_dump', return_value=0) as backup_dump:
+            self.assertEqual(container.backup(), 0)
+
+        filenames = sorted(call[0][2] for call in backup_dump.call_args_list)
+        self.assertEqual(filenames, [
+            '/databases/postgres/app.sql',
+            '/databases/postgres/globals.sql',
+            '/databases/postgres/globals/globals.sql',
+        ])
+        self.assertIn('--jobs=2', container.dump_directory_command('app', '/databases/postgres/app'))
+
+    def test_json_state_files(self):
+        """State files are replaced atomically and discarded for another repository"""
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'state', 'index.json')
+            self.assertEqual(utils.read_json(path), {})
+            self.assertTrue(utils.write_json(path, {'repository': 'repo', 'value': 1}))
+            self.assertEqual(os.listdir(os.path.dirname(path)), ['index.json'])
+            self.assertEqual(utils.read_json(path, 'repo')['value'], 1)
+            self.assertEqual(utils.read_json(path, 'other'), {})
+
+            with open(path, 'w') as fd:
+                fd.write('{broken')
+            with self.assertLogs('restic_compose_backup.utils', 'WARNING'):
+                self.assertEqual(utils.read_json(path, 'repo'), {})
+
+    def test_volume_index(self):
+        """Unchanged mounts are detected using the persisted index"""
+        import tempfile
+        from restic_compose_backup.volume_index import VolumeIndex, scan
+
+        with tempfile.TemporaryDirectory() as tmp:
+            mount = os.path.join(tmp, 'mount')
+            os.makedirs(os.path.join(mount, 'sub'))
+            with open(os.path.join(mount, 'sub', 'file'), 'w') as fd:
+                fd.write('data')
+
+            index_path = os.path.join(tmp, 'cache', 'volume_index.json')
+            index = VolumeIndex(index_path, 'repo')
+            marker = scan(mount)
+            self.assertEqual(marker['entries'], 1)
+            self.assertEqual(marker['bytes'], 4)
+            self.assertTrue(index.changed(mount, marker))
+            index.update(mount, marker)
+            index.save()
+
+            index = VolumeIndex(index_path, 'repo')
+            self.assertFalse(index.changed(mount, scan(mount)))
+            self.assertTrue(VolumeIndex(index_path, 'other-repo').changed(mount, scan(mount)))
+
+            with open(os.path.join(mount, 'new'), 'w') as fd:
+                fd.write('more data')
+            self.assertTrue(index.changed(mount, scan(mount)))
+
+    def test_volume_backup_units(self):
+        """Volumes are split into separate backups per service or mount"""
+        from restic_compose_backup import cli
+
+        containers = self.createContainers()
+        containers += [
+            {
+                'service': 'web',
+                'labels': {
+                    'restic-compose-backup.volumes': True,
+                },
+                'mounts': [
+                    {'Source': '/srv/media', 'Destination': '/srv/media', 'Type': 'bind'},
+                    {'Source': '/srv/files', 'Destination': '/srv/files', 'Type': 'bind'},
+                ]
+            },
+        ]
+        with mock.patch(list_containers_func, fixtures.containers(containers=containers)):
+            cnt = RunningContainers()
+
+        config = mock.Mock(volume_backup_mode='single', volume_change_index=False)
+        self.assertEqual(cli.volume_backup_units(config, cnt), [('/volumes', [])])
+        # Partial backups are tagged per service so the full snapshot is kept by forget
+        cnt.services = ['web']
+        self.assertEqual(cli.volume_backup_units(config, cnt), [('/volumes/web', ['service:web'])])
+        cnt.services = None
+
+        config.volume_backup_mode = 'service'
+        self.assertEqual(cli.volume_backup_units(config, cnt), [('/volumes/web', ['service:web'])])
+
+        config.volume_backup_mode = 'mount'
+        self.assertEqual(cli.volume_backup_units(config, cnt), [
+            ('/volumes/web/srv/files', ['service:web']),
+            ('/volumes/web/srv/media', ['service:web']),
+        ])
+
+    def test_discovery_cache(self):
+        """Container discovery is reused from the cache within the ttl"""
+        import tempfile
+        from restic_compose_backup.config import get_config
+
+        containers = self.createContainers()
+        containers += [{'service': 'web', 'labels': {'restic-compose-backup.volumes': True}}]
+
+        with tempfile.TemporaryDirectory() as tmp, \
+                mock.patch.object(get_config(), 'cache_dir', tmp):
+            with mock.patch(list_containers_func, fixtures.containers(containers=containers)):
+                cnt = RunningContainers(cache_ttl=60)
+            self.assertTrue(os.path.exists(os.path.join(tmp, 'discovery.json')))
+
+            with mock.patch(list_containers_func, side_effect=RuntimeError('docker unavailable')):
+                cached = RunningContainers(cache_ttl=60)
+                self.assertEqual(len(cached.containers), len(cnt.containers))
+                with self.assertRaises(RuntimeError):
+                    RunningContainers()
+
+        # Status reports live state and never uses the cache
+        from restic_compose_backup import cli
+        with mock.patch.dict(os.environ, {'DISCOVERY_CACHE_TTL': '60'}), \
+                mock.patch('sys.argv', ['rcb', 'status']), \
+                mock.patch.object(cli, 'status'), \
+                mock.patch.object(cli, 'RunningContainers') as running_containers:
+            cli.main()
+        self.assertEqual(running_containers.call_args[1]['cache_ttl'], 0)
+
+    def test_container_parsed_once(self):
+        """Labels and env vars are parsed at construction and kept in sync"""
+        from restic_compose_backup.containers import Container
+        from restic_compose_backup.containers_db import MysqlContainer
+
+        data = fixtures.containers(containers=[{
+            'service': 'mysql',
+            'labels': {'restic-compose-backup.mysql': 'true'},
+        }])()[0]
+        data['Config']['Env'] = ['MYSQL_USER=root', 'MYSQL_PASSWORD=pass=word']
+        container = Container(data)
+
+        self.assertTrue(container.database_backup_enabled)
+        self.assertFalse(container.volume_backup_enabled)
+        self.assertEqual(container.get_config_env('MYSQL_PASSWORD'), 'pass=word')
+        container.set_config_env('LOG_LEVEL', 'debug')
+        self.assertEqual(container.get_config_env('LOG_LEVEL'), 'debug')
+        self.assertIn('LOG_LEVEL=debug', container.environment)
+
+        instance = container.instance
+        self.assertIsInstance(instance, MysqlContainer)
+        self.assertIs(instance, container.instance)
+        self.assertEqual(instance.get_credentials()['password'], 'pass=word')
+        self.assertFalse(hasattr(container, '__dict__'))
+
+    def test_mount_filter_patterns(self):
+        """Glob, regex and in-mount exclude patterns"""
+        containers = self.createContainers()
+        containers += [
+            {
+                'service': 'web',
+                'labels': {
+                    'restic-compose-backup.volumes': True,
+                    'restic-compose-backup.volumes.include': '/srv/*, re:.*/(media|logs)',
+                    'restic-compose-backup.volumes.exclude': '*/logs, /srv/media/cache/*',
+                },
+                'mounts': [
+                    {'Source': '/data/media', 'Destination': '/srv/media', 'Type': 'bind'},
+                    {'Source': '/data/logs', 'Destination': '/var/logs', 'Type': 'bind'},
+                    {'Source': '/data/other', 'Destination': '/var/other', 'Type': 'bind'},
+                ]
+            },
+        ]
+        with mock.patch(list_containers_func, fixtures.containers(containers=containers)):
+            cnt = RunningContainers()
+
+        web_service = cnt.get_service('web')
+        mounts = web_service.filter_mounts()
+        self.assertEqual([mount.source for mount in mounts], ['/data/media'])
+        self.assertEqual(web_service.backup_excludes(), ['/volumes/web/srv/media/cache/*'])
+        self.assertEqual(cnt.generate_backup_excludes(), ['/volumes/web/srv/media/cache/*'])
+
+    def test_backup_progress_stream(self):
+        """restic json output is consumed line by line as structured data"""
+        from restic_compose_backup import commands
+        from restic_compose_backup.progress import BackupProgress
+
+        lines = [
+            '{"message_type":"status","percent_done":0.5,"total_files":10,"files_done":5,'
+            '"total_bytes":2000,"bytes_done":1000,"seconds_elapsed":10}',
+            'not json',
+            '{"message_type":"summary","files_new":5,"files_changed":0,"files_unmodified":5,'
+            '"data_added":1000,"total_duration":20.5,"snapshot_id":"abcd"}',
+        ]
+        progress = BackupProgress('/volumes', interval=0)
+        result = commands.run(['printf', '%s\\n'] + lines, on_stdout=progress)
+
+        self.assertEqual(result, 0)
+        self.assertEqual(progress.files_per_second, 0.5)
+        self.assertEqual(progress.bytes_per_second, 100)
+        self.assertEqual(progress.eta, 10)
+        self.assertEqual(progress.summary['snapshot_id'], 'abcd')
+
+    def test_execute_bounded_output_and_timeout(self):
+        """Only the tail of the output is kept and slow commands are terminated"""
+        import threading
+        from restic_compose_backup import commands
+
+        result = commands.execute(['seq', '1', '1000'])
+        self.assertEqual(result.returncode, 0)
+        self.assertEqual(len(result.stdout), commands.TAIL_LINES)
+        self.assertEqual(result.stdout[-1], '1000')
+        self.assertGreater(result.max_rss, 0)
+
+        result = commands.execute(['sleep', '10'], timeout=0.2)
+        self.assertTrue(result.timed_out)
+        self.assertNotEqual(result.returncode, 0)
+        self.assertLess(result.wall_time, 5)
+
+        cancel = threading.Event()
+        cancel.set()
+        result = commands.execute(['sleep', '10'], cancel=cancel)
+        self.assertTrue(result.cancelled)
+
+        # The child exits right before it's terminated. It must still be reaped by execute
+        wait4 = os.wait4
+
+        def exit_before_terminate(pid, options):
+            if not exit_before_terminate.called:
+                exit_before_terminate.called = True
+                os.waitid(os.P_PID, pid, os.WEXITED | os.WNOWAIT)
+                return 0, 0, None
+            return wait4(pid, options)
+
+        exit_before_terminate.called = False
+        with mock.patch('restic_compose_backup.commands.os.wait4', side_effect=exit_before_terminate):
+            result = commands.execute(['true'], timeout=0.0001)
+        self.assertTrue(result.timed_out)
+        self.assertEqual(result.returncode, 0)
+
+        # Captured commands keep all of stdout but only the tail of stderr
+        stdout, stderr = commands.run_capture_std(['sh', '-c', 'seq 1 1000; seq 1 1000 >&2'])
+        self.assertEqual(len(stdout.split('\n')), 1000)
+        self.assertEqual(len(stderr.split('\n')), commands.TAIL_LINES)
+
+    def test_backup_metrics(self):
+        """Phase and target metrics are exported as json and prometheus text"""
+        import tempfile
+        from restic_compose_backup.metrics import BackupMetrics
+
+        metrics = BackupMetrics('my"project')
+        with metrics.phase('check') as phase:
+            phase['exit_code'] = 0
+        metrics.add_target('/volumes/web/data', 'volume', 1.5, 0)
+        metrics.add_summary('/volumes/web/data', {'data_added': 100})
+        metrics.add_summary('mariadb', {'data_added': 50})
+        metrics.add_summary('mariadb', None)
+        metrics.add_target('mariadb', 'mariadb', 2, 1)
+        metrics.finish(False)
+
+        self.assertEqual(metrics.bytes_added, 150)
+        self.assertEqual(metrics.targets['mariadb']['bytes_added'], 50)
+
+        with tempfile.TemporaryDirectory() as directory:
+            metrics.write(directory)
+            with open(os.path.join(directory, 'backup_report.json')) as fd:
+                report = json.load(fd)
+            with open(os.path.join(directory, 'restic_compose_backup.prom')) as fd:
+                text = fd.read()
+
+        self.assertFalse(report['success'])
+        self.assertEqual(report['phases']['check']['exit_code'], 0)
+        self.assertIn('rcb_backup_success{project="my\\"project"} 0', text)
+        self.assertIn('rcb_backup_target_exit_code{project="my\\"project",target="mariadb",type="mariadb"} 1', text)
+
+        # The status phase is recorded even when it fails
+        from restic_compose_backup import cli
+        with tempfile.TemporaryDirectory() as directory, \
+                mock.patch.dict(os.environ, {'BACKUP_PROCESS_CONTAINER': 'true'}), \
+                mock.patch.object(cli, 'status', side_effect=RuntimeError('docker unavailable')):
+            with self.assertRaises(RuntimeError):
+                cli.start_backup_process(mock.Mock(metrics_dir=directory), mock.Mock(project_name='app'))
+            with open(os.path.join(directory, 'backup_report.json')) as fd:
+                report = json.load(fd)
+        self.assertFalse(report['success'])
+        self.assertEqual(report['phases']['status']['exit_code'], 1)
+
+    def test_maintenance_schedule(self):
+        """Scheduled maintenance tasks get their own crontab entry and rotate check slices"""
+        import tempfile
+        from restic_compose_backup import cron
+        from restic_compose_backup.config import Config
+        from restic_compose_backup.maintenance import MaintenanceHistory
+
+        with mock.patch.dict(os.environ, {'PRUNE_SCHEDULE': '"0 4 * * 0"', 'CHECK_SCHEDULE': 'invalid'}):
+            with self.assertRaisesRegex(ValueError, 'CHECK_SCHEDULE'):
+                Config()
+        with mock.patch.dict(os.environ, {'PRUNE_SCHEDULE': '"0 4 * * 0"', 'CHECK_SCHEDULE': ' '}):
+            config = Config()
+        self.assertEqual(cron.maintenance_schedules(config), {'prune': '0 4 * * 0'})
+        self.assertEqual(
+            cron.generate_crontab(config).splitlines()[1],
+            '0 4 * * 0 source /env.sh && rcb prune > /proc/1/fd/1',
+        )
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'maintenance.json')
+            history = MaintenanceHistory(path, 'test')
+            slices = []
+            for _ in range(4):
+                slices.append(history.next_subset(3))
+                history.advance_subset(3)
+            history.record('check', 0, 1.0, subset='1/3')
+            history.save()
+
+            history = MaintenanceHistory(path, 'test')
+            self.assertEqual(slices, [1, 2, 3, 1])
+            self.assertEqual(history.next_subset(3), 2)
+            self.assertEqual(history.subset['cycle'], 2)
+            # Entries written before several slices could be read per check
+            self.assertEqual(history.last('check')['subsets'], ['1/3'])
+            self.assertEqual(MaintenanceHistory(path, 'other').tasks, {})
+
+    def test_check_data_period(self):
+        """All slices are read within the period even when checks run less often"""
+        from restic_compose_backup.maintenance import MaintenanceHistory
+
+        history = MaintenanceHistory('/nonexistent/maintenance.json', 'test')
+        self.assertEqual(history.due_subsets(10), [1])
+        self.assertEqual(history.due_subsets(10, period=3600), [1])
+
+        # Half of the period passed so half of the slices are due
+        history.subset['cycle_started'] -= 1800
+        self.assertEqual(history.due_subsets(10, period=3600), [1, 2, 3, 4, 5])
+        for _ in range(5):
+            history.advance_subset(10)
+        self.assertEqual(history.coverage, 0.5)
+        self.assertEqual(sorted(history.subset['verified']), ['1', '2', '3', '4', '5'])
+
+        # Overdue cycles read everything that is left
+        history.subset['cycle_started'] -= 7200
+        self.assertEqual(history.due_subsets(10, period=3600), [6, 7, 8, 9, 10])
+
+        # Only the first run of a check downloads the repository metadata
+        from restic_compose_backup import cli
+        config = mock.Mock(check_with_cache='false', check_data_subsets='10', check_data_period='1')
+        history.subset['cycle_started'] -= 86400
+        extra = {}
+        with mock.patch('restic_compose_backup.restic.check', return_value=0) as check, \
+                mock.patch.object(history, 'save'):
+            self.assertEqual(cli.check(config, history, extra), 0)
+        self.assertEqual([call[1]['with_cache'] for call in check.call_args_list], [False, True, True, True, True])
+        self.assertEqual(extra['subsets'], ['6/10', '7/10', '8/10', '9/10', '10/10'])
+
+    def test_snapshot_index(self):
+        """The snapshot index is built once and updated with new and forgotten snapshots"""
+        import tempfile
+        from restic_compose_backup import restic
+        from restic_compose_backup.snapshot_index import SnapshotIndex
+
+        def snapshot(snapshot_id, time, paths, tags=None):
+            return {'id': snapshot_id, 'short_id': snapshot_id[:8], 'time': time,
+                    'hostname': 'host', 'paths': paths, 'tags': tags, 'tree': 'ignored'}
+
+        listing = [
+            snapshot('a' * 64, '2020-01-01T02:00:00Z', ['/volumes/web'], ['service:web']),
+            snapshot('b' * 64, '2020-01-02T02:00:00Z', ['/volumes/web'], ['service:web']),
+            snapshot('c' * 64, '2020-01-02T02:00:00Z', ['/databases/db/all_databases.sql']),
+        ]
+        new = snapshot('d' * 64, '2020-01-03T02:00:00Z', ['/volumes/web'], ['service:web'])
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'snapshots.json')
+            snapshots_json = 'restic_compose_backup.restic.snapshots_json'
+            with mock.patch(snapshots_json, return_value=(0, listing)) as listing_mock:
+                index = SnapshotIndex(path, 'test')
+                index.update(['ignored'])
+                listing_mock.assert_called_once_with('test')
+                index.save()
+
+            index = SnapshotIndex(path, 'test')
+            self.assertTrue(index.complete)
+            self.assertNotIn('tree', index.snapshots['a' * 64])
+            with mock.patch(snapshots_json, return_value=(0, [new])) as listing_mock:
+                index.update(['a' * 64, 'd' * 64])
+                listing_mock.assert_called_once_with('test', ids=['d' * 64])
+
+        index.remove(['b' * 64])
+        self.assertEqual([s['id'][0] for s in index.query(tag='service:web')], ['a', 'd'])
+        self.assertEqual([s['id'][0] for s in index.query(last=True)], ['c', 'd'])
+        self.assertEqual([s['id'][0] for s in index.query(path='/databases/db')], ['c'])
+        self.assertEqual(index.query(path='/volumes/we'), [])
+
+        def forget_output(cmd, on_stdout=None, **kwargs):
+            on_stdout('[{"keep": [], "remove": [{"id": "%s"}]}, {"keep": [], "remove": null}]' % ('a' * 64))
+            return 0
+
+        removed = []
+        with mock.patch('restic_compose_backup.commands.run', side_effect=forget_output):
+            restic.forget('test', '7', '4', '12', '3', removed=removed)
+        self.assertEqual(removed, ['a' * 64])
+
+        # Backups only update an index already built by the snapshots command
+        from restic_compose_backup import cli
+        from restic_compose_backup.metrics import BackupMetrics
+
+        with tempfile.TemporaryDirectory() as directory:
+            config = mock.Mock(cache_dir=directory, repository='test')
+            containers = mock.Mock(services=['web'])
+            containers.containers_for_backup.return_value = [mock.Mock()]
+            with mock.patch.object(cli, 'backup_volumes', return_value=0), \
+                    mock.patch.object(cli, 'backup_databases', return_value=False), \
+                    mock.patch(snapshots_json) as listing_mock:
+                self.assertTrue(cli.run_backup(config, containers, BackupMetrics('test')))
+            listing_mock.assert_not_called()
+
+    def test_repository_init_probe_cached(self):
+        """A successful initialization probe is remembered per repository"""
+        import tempfile
+        from restic_compose_backup import cli
+        from restic_compose_backup.config import Config
+
+        config = Config()
+        with tempfile.TemporaryDirectory() as directory:
+            config.cache_dir = directory
+            with mock.patch('restic_compose_backup.restic.is_initialized', return_value=True) as probe:
+                cli.ensure_initialized(config)
+                cli.ensure_initialized(config)
+                self.assertEqual(probe.call_count, 1)
+
+                config.repository = 'other'
+                with mock.patch('restic_compose_backup.restic.init_repo', return_value=1):
+                    probe.return_value = False
+                    cli.ensure_initialized(config)
+                    cli.ensure_initialized(config)
+                self.assertEqual(probe.call_count, 3)
+
+    def test_database_ping_retry(self):
+        """Databases are pinged concurrently and retried with backoff before a dump"""
+        from restic_compose_backup import cli
+
+        instance = mock.Mock(id='1', service_name='db', container_type='postgres')
+        instance.ping.side_effect = [2, 2, 0]
+        with mock.patch('time.sleep') as sleep:
+            self.assertTrue(cli.wait_for_database(instance, timeout=1, retries=3))
+            self.assertEqual([call.args[0] for call in sleep.call_args_list], [1, 2])
+        instance.ping.assert_called_with(timeout=1)
+
+        instance.ping.side_effect = None
+        instance.ping.return_value = 2
+        with mock.patch('time.sleep'):
+            self.assertFalse(cli.wait_for_database(instance, timeout=1, retries=2))
+
+        # Replicas of a service are reported separately
+        replica = mock.Mock(id='2', service_name='db', container_type='postgres')
+        replica.ping.return_value = 0
+        pings = cli.ping_databases([instance, replica], timeout=1)
+        self.assertEqual(pings['1']['exit_code'], 2)
+        self.assertEqual(pings['2']['exit_code'], 0)
+        self.assertGreaterEqual(pings['2']['latency'], 0)
+
+    def test_alert_dispatcher(self):
+        """Alerts are sent to all backends in parallel and batched into a digest"""
+        import threading
+        import time
+        from restic_compose_backup.alerts import AlertDispatcher
+
+        release = threading.Event()
+        fast = mock.Mock()
+        fast.name = 'fast'
+        slow = mock.Mock()
+        slow.name = 'slow'
+        slow.send.side_effect = lambda **kwargs: release.wait(5)
+
+        dispatcher = AlertDispatcher(backends=[fast, slow], timeout=0.2)
+        start = time.monotonic()
+        dispatcher.send('Something', 'body', 'INFO')
+        self.assertLess(time.monotonic() - start, 2)
+        fast.send.assert_called_once_with(subject='[INFO] Something', body='body')
+        release.set()
+
+        fast.reset_mock()
+        with dispatcher.digest():
+            dispatcher.send('First', 'one', 'INFO')
+            with dispatcher.digest():
+                dispatcher.send('Second', 'two', 'ERROR')
+            fast.send.assert_not_called()
+
+        fast.send.assert_called_once()
+        kwargs = fast.send.call_args.kwargs
+        self.assertEqual(kwargs['subject'], '[ERROR] 2 alerts: First')
+        self.assertIn('[INFO] First\none', kwargs['body'])
+        self.assertIn('[ERROR] Second\ntwo', kwargs['body'])
+
+    def test_relay_output(self):
+        """Backup process output is split into lines per stream with incremental decoding"""
+        import io
+        from restic_compose_backup import backup_runner
+
+        snowman = '☃'.encode()
+        stream = [
+            (b'first li', None),
+            (None, b'error: ' + snowman[:1]),
+            (b'ne\r\nsecond\n', None),
+            (None, snowman[1:] + b'\n'),
+            (b'third', None),
+        ]
+        fd = io.StringIO()
+        with self.assertLogs('restic_compose_backup.backup_runner', level='INFO') as logs:
+            backup_runner.relay_output(iter(stream), fd)
+
+        self.assertEqual(fd.getvalue(), 'first line\nsecond\nerror: ☃\nthird\n')
+        self.assertIn('ERROR:restic_compose_backup.backup_runner:error: ☃', logs.output)
+
+    def test_backup_worker(self):
+        """The worker runs each backup in a forked child relaying output and exit code"""
+        import io
+        import socket
+        import threading
+        from restic_compose_backup import worker
+
+        def run_backup(services, stopping):
+            # The test runner replaces sys.stdout so write to the file descriptor
+            os.write(1, 'backing up {} {}\n'.format(services, len(stopping or [])).encode())
+            # Output without a trailing newline is kept apart from the exit code
+            os.write(2, b'done')
+            exit(3)
+
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            port = probe.getsockname()[1]
+        threading.Thread(target=worker.serve, args=(port, run_backup), daemon=True).start()
+
+        for services in [None, ['web', 'db']]:
+            fd = io.StringIO()
+            stopping = [{'Id': 'abc'}] if services else None
+            self.assertEqual(worker.request_backup(port, fd, timeout=5, services=services, stopping=stopping), 3)
+            self.assertEqual(fd.getvalue(), 'backing up {} {}\ndone\n'.format(services, len(stopping or [])))
+
+        volumes = {'/srv/data': {'bind': '/volumes/web/srv/data', 'mode': 'ro'}}
+        self.assertEqual(worker.worker_hash(volumes, 'image', 'abc'), worker.worker_hash(dict(volumes), 'image', 'abc'))
+        self.assertNotEqual(worker.worker_hash(volumes, 'image', 'abc'), worker.worker_hash({}, 'image', 'abc'))
+
+    def test_backup_worker_lifecycle(self):
+        """The worker is never replaced during a backup and exited or disabled workers are removed"""
+        import tempfile
+        from restic_compose_backup import cli
+
+        containers = self.createContainers()
+        containers += [
+            {'service': 'web', 'labels': {'restic-compose-backup.volumes': True}},
+            {'service': 'backup', 'labels': {'restic-compose-backup.worker-default': 'True'}},
+        ]
+        data = fixtures.containers(containers=containers)()
+        data[-1]['State'] = {'Status': 'exited', 'Running': False}
+        cnt = RunningContainers(containers_data=data)
+        self.assertIsNone(cnt.backup_worker_container)
+        self.assertEqual(len(cnt.stale_backup_worker_containers), 1)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            config = mock.Mock(cache_dir=tmp)
+            with utils.file_lock(cli.backup_worker_lock(config)) as locked:
+                self.assertTrue(locked)
+                with mock.patch.object(cli, 'run_in_worker') as run_in_worker:
+                    with self.assertRaisesRegex(RuntimeError, 'busy'):
+                        cli.backup_in_worker(config, cnt, {})
+                run_in_worker.assert_not_called()
+
+                # Turning the worker off never removes it during a backup
+                cnt.backup_worker_container = cnt.stale_backup_worker_containers[0]
+                with mock.patch('restic_compose_backup.backup_runner.remove_container') as remove_container:
+                    cli.stop_backup_worker(config, cnt)
+                remove_container.assert_not_called()
+
+            with mock.patch('restic_compose_backup.backup_runner.remove_container') as remove_container:
+                cli.stop_backup_worker(config, cnt)
+            remove_container.assert_called_once_with(cnt.backup_worker_container.name)
+
+    def test_cron_schedule(self):
+        """Full cron syntax is parsed and the next run is computed like cron"""
+        from datetime import datetime
+        from restic_compose_backup import cron, daemon
+
+        self.assertTrue(cron.validate_schedule('*/15 1-5,22 * jan-jun mon-fri'))
+        self.assertTrue(cron.validate_schedule('@daily'))
+        self.assertFalse(cron.validate_schedule('60 * * * *'))
+        self.assertFalse(cron.validate_schedule('* * * *'))
+        self.assertFalse(cron.validate_schedule('*/0 * * * *'))
+
+        schedule = cron.CronSchedule('*/20 2-3 * * sat,7')
+        self.assertEqual(schedule.next_after(datetime(2024, 1, 1, 12, 0)), datetime(2024, 1, 6, 2, 0))
+        self.assertEqual(schedule.next_after(datetime(2024, 1, 6, 3, 40)), datetime(2024, 1, 7, 2, 0))
+        # Either the day of month or the weekday matches when both are restricted
+        schedule = cron.CronSchedule('0 0 13 * fri')
+        self.assertEqual(schedule.next_after(datetime(2024, 1, 1)), datetime(2024, 1, 5))
+        self.assertEqual(cron.CronSchedule('0 0 29 2 *').next_after(datetime(2024, 3, 1)), datetime(2028, 2, 29))
+
+        calls = []
+        job = daemon.Job('test', cron.CronSchedule('* * * * *'), lambda: calls.append(1) or exit(1))
+        job.next_run = datetime(2000, 1, 1)
+        job.run()
+        self.assertEqual(calls, [1])
+        self.assertGreater(job.next_run, datetime.now())
+
+    def test_container_registry_events(self):
+        """The registry is updated from docker events without listing containers again"""
+        from restic_compose_backup.registry import ContainerRegistry, is_stopping
+
+        containers = self.createContainers() + [
+            {'service': 'web', 'labels': {'restic-compose-backup.volumes': True}},
+        ]
+        with mock.patch(list_containers_func, fixtures.containers(containers=containers)):
+            registry = ContainerRegistry(os.environ['HOSTNAME'])
+
+        new_container = fixtures.containers(containers=[
+            {'service': 'media', 'labels': {'restic-compose-backup.volumes': True}},
+        ])()[0]
+        client = mock.Mock()
+        client.api.inspect_container.return_value = new_container
+        events = []
+        registry.listeners.append(lambda action, container, attributes: events.append(
+            (action, container.service_name, is_stopping(action, attributes))))
+
+        with mock.patch(list_containers_func, side_effect=AssertionError('no listing expected')):
+            registry.handle({'Action': 'start', 'id': new_container['Id']}, client=client)
+            registry.handle({'Action': 'exec_start: sh', 'id': new_container['Id']}, client=client)
+            registry.handle({'Action': 'kill', 'id': new_container['Id']}, client=client)
+            for signal in ['15', '1']:
+                registry.handle({
+                    'Action': 'kill',
+                    'Actor': {'ID': new_container['Id'], 'Attributes': {'signal': signal}},
+                }, client=client)
+            plan = registry.running_containers()
+            self.assertEqual(sorted(c.service_name for c in plan.containers_for_backup()), ['media', 'web'])
+            plan = registry.running_containers(services=['web'])
+            self.assertEqual([c.service_name for c in plan.containers_for_backup()], ['web'])
+
+            registry.handle({'Action': 'destroy', 'id': new_container['Id']}, client=client)
+            self.assertEqual([c.service_name for c in registry.running_containers().containers_for_backup()], ['web'])
+
+        self.assertEqual(events, [
+            ('start', 'media', False), ('kill', 'media', True), ('kill', 'media', True), ('kill', 'media', False),
+        ])
+        self.assertEqual(client.api.inspect_container.call_count, 4)
+        self.assertTrue(is_stopping('kill', {'signal': 'SIGQUIT'}))
+        self.assertFalse(is_stopping('kill', {'signal': 'SIGHUP'}))
+
+    def test_backup_stopped_service(self):
+        """A service stopped before the backup process runs is backed up from the data captured at kill"""
+        from restic_compose_backup import cli
+        from restic_compose_backup.config import Config
+        from restic_compose_backup.containers import Container
+
+        containers = self.createContainers() + [{
+            'service': 'media',
+            'labels': {'restic-compose-backup.volumes': True},
+            'mounts': [{'Source': '/srv/media', 'Destination': '/srv/media', 'Type': 'bind'}],
+        }]
+        data = fixtures.containers(containers=containers)()
+        captured = Container(data[-1]).to_dict()
+
+        # The backup command passes the captured data on to the backup process
+        with mock.patch.dict(os.environ, {'BACKUP_STOPPING_CONTAINERS': json.dumps([captured])}):
+            stopping = Config().stopping_containers
+
+        for mode in ['single', 'service']:
+            config = mock.Mock(volume_backup_mode=mode, volume_change_index='false')
+            for media in [dict(data[-1], State={'Status': 'exited', 'Running': False}), None]:
+                remaining = data[:-1] + ([media] if media else [])
+                plan = RunningContainers(containers_data=remaining, services=['media'])
+                self.assertEqual(cli.volume_backup_units(config, plan), [])
+
+                plan = RunningContainers(containers_data=remaining, services=['media'], stopping=stopping)
+                self.assertEqual(cli.volume_backup_units(config, plan), [('/volumes/media', ['service:media'])])
+                self.assertIn('/srv/media', plan.generate_backup_mounts())
+
+    def test_cli_startup(self):
+        """Importing the cli and printing the version needs no docker, config or discovery"""
+        import subprocess
+        import sys
+
+        env = {k: v for k, v in os.environ.items() if k not in ('HOSTNAME', 'RESTIC_REPOSITORY')}
+        lazy = [
+            'docker', 'requests', 'smtplib',
+            'restic_compose_backup.daemon', 'restic_compose_backup.maintenance', 'restic_compose_backup.metrics',
+            'restic_compose_backup.registry', 'restic_compose_backup.snapshot_index',
+            'restic_compose_backup.volume_index', 'restic_compose_backup.worker',
+        ]
+        code = (
+            "import sys, restic_compose_backup.cli; "
+            "print(sorted(m for m in {!r} if m in sys.modules))".format(lazy)
+        )
+        result = subprocess.run([sys.executable, '-c', code], env=env, capture_output=True, text=True)
+        self.assertEqual(result.stdout.strip(), '[]', result.stderr)
+
+        from restic_compose_backup import cli, maintenance
+        self.assertEqual(cli.MAINTENANCE_ACTIONS, maintenance.TASKS)
+
+        import restic_compose_backup
+        result = subprocess.run(
+            [sys.executable, '-m', 'restic_compose_backup.cli', 'version'],
+            env=env, capture_output=True, text=True,
+        )
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(result.stdout.strip(), restic_compose_backup.__version__)